@@ -0,0 +1,155 @@
+import glob
+import logging
+import multiprocessing
+import os
+import time
+
+from datetime import datetime, timedelta
+
+from metrics import get_summary, merge_summaries, reset, write_metrics
+from schedule_cache import hash_file
+from tides_engine import DATE_FORMAT, parse_day
+from utils import load_config
+
+logging.basicConfig(
+    format='%(levelname)s %(asctime)s %(filename)s:%(lineno)d| %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+# constants
+DEFAULT_NUM_PROCESSES = 1
+
+
+def get_dates(date_ranges):
+    # every date of the inclusive [start, end] ranges, in order and without repeats
+    dates = set()
+    for start_date_str, end_date_str in date_ranges:
+        date_obj = datetime.strptime(start_date_str, DATE_FORMAT)
+        end_date_obj = datetime.strptime(end_date_str, DATE_FORMAT)
+        while date_obj <= end_date_obj:
+            dates.add(date_obj.strftime(DATE_FORMAT))
+            date_obj += timedelta(days=1)
+    return sorted(dates)
+
+
+def get_job_groups(raw_data_folder, feed_globs, dates):
+    """
+    Return (feed_name, [date_str, ...]) groups of the (feed, date) jobs with raw data. Each group
+    is a run of consecutive dates of one feed that share a schedule zip, so one process can
+    compute the schedule of each date from a single read of the zip.
+    """
+    feed_names = set()
+    for feed_glob in feed_globs:
+        for feed_folder in glob.glob(os.path.join(raw_data_folder, feed_glob)):
+            if os.path.isdir(feed_folder):
+                feed_names.add(os.path.basename(feed_folder))
+
+    job_groups = []
+    for feed_name in sorted(feed_names):
+        previous_zip_hash = None
+        for date_str in dates:
+            gtfs_zip_path = os.path.join(raw_data_folder, feed_name, date_str, 'schedule', 'gtfs.zip')
+            if not os.path.exists(gtfs_zip_path):
+                continue
+            zip_hash = hash_file(gtfs_zip_path)
+            if zip_hash == previous_zip_hash:
+                job_groups[-1][1].append(date_str)
+            else:
+                job_groups.append((feed_name, [date_str]))
+            previous_zip_hash = zip_hash
+    return job_groups
+
+
+def run_job_group(config, feed_name, dates):
+    # runs in a worker process and returns a (date_str, elapsed seconds, snapshots, error) result
+    # for each job, along with the metrics of the group
+    reset()
+    results = []
+    for date_str in dates:
+        job_config = dict(config)
+        job_config['date'] = date_str
+        job_config['raw_data_path'] = os.path.join(config['raw_data_path'], feed_name)
+        job_config['tides_output_folder'] = os.path.join(config['tides_output_folder'], feed_name)
+        # jobs already run in parallel and pool workers can't start pools of their own
+        job_config['num_workers'] = 1
+        job_config['num_trip_update_shards'] = 1
+        job_config['keep_schedule_feed_loaded'] = True
+
+        job_start_time = time.time()
+        num_snapshots = 0
+        error = None
+        try:
+            num_snapshots = parse_day(job_config)
+        except Exception as e:
+            logger.exception(f"Failed to parse {feed_name} for {date_str}")
+            error = repr(e)
+        job_elapsed_time = time.time() - job_start_time
+        logger.info(
+            f"Parsed {feed_name} for {date_str} in {job_elapsed_time:.2f} seconds, {num_snapshots} snapshots "
+            f"({num_snapshots / max(job_elapsed_time, 1e-9):.1f} snapshots/second)"
+        )
+        results.append((date_str, job_elapsed_time, num_snapshots, error))
+    return feed_name, results, get_summary()
+
+
+def run_job_group_star(args):
+    return run_job_group(*args)
+
+
+def main():
+    backfill_start_time = time.time()
+    config = load_config('backfill.py')
+    num_processes = config.get('num_processes', DEFAULT_NUM_PROCESSES)
+    if config.get('num_workers', 1) > 1:
+        logger.warning('Ignoring num_workers, backfill jobs are parallelized with num_processes instead')
+
+    dates = get_dates(config['date_ranges'])
+    job_groups = get_job_groups(config['raw_data_path'], config['feeds'], dates)
+    num_jobs = sum(len(group_dates) for feed_name, group_dates in job_groups)
+    logger.info(f"Backfilling {num_jobs} feed days in {len(job_groups)} groups with {num_processes} processes")
+
+    # bigger groups first, so a long run of dates doesn't end up alone at the end of the backfill
+    job_groups.sort(key=lambda job_group: len(job_group[1]), reverse=True)
+    job_args = [(config, feed_name, group_dates) for feed_name, group_dates in job_groups]
+
+    num_finished_jobs = 0
+    num_snapshots = 0
+    failed_jobs = []
+    metrics_summary = get_summary()
+    if num_processes <= 1:
+        group_results = map(run_job_group_star, job_args)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(num_processes)
+        group_results = pool.imap_unordered(run_job_group_star, job_args)
+    try:
+        for feed_name, results, group_metrics_summary in group_results:
+            metrics_summary = merge_summaries(metrics_summary, group_metrics_summary)
+            for date_str, job_elapsed_time, job_num_snapshots, error in results:
+                num_finished_jobs += 1
+                num_snapshots += job_num_snapshots
+                if error is not None:
+                    failed_jobs.append((feed_name, date_str, error))
+            elapsed_time = time.time() - backfill_start_time
+            logger.info(
+                f"Finished {num_finished_jobs}/{num_jobs} feed days in {elapsed_time:.1f} seconds, "
+                f"{num_finished_jobs * 60 / elapsed_time:.1f} feed days/minute, "
+                f"{num_snapshots / elapsed_time:.1f} snapshots/second"
+            )
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    write_metrics(config, metrics_summary)
+    for feed_name, date_str, error in failed_jobs:
+        logger.error(f"Failed to parse {feed_name} for {date_str}: {error}")
+    logger.info(
+        f"Backfilled {num_finished_jobs - len(failed_jobs)} of {num_jobs} feed days in "
+        f"{time.time() - backfill_start_time:.1f} seconds"
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import tempfile
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+
+from metrics import get_summary
+from tides_engine import parse_day
+from utils import load_config
+
+logging.basicConfig(
+    format='%(levelname)s %(asctime)s %(filename)s:%(lineno)d| %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+# constants
+DEFAULT_BENCHMARKS = {
+    'vehicle_locations': ['vehicle_locations'],
+    'trips_performed': ['trips_performed']
+}
+DEFAULT_NUM_RUNS = 1
+STAGES = ['schedule_load', 'listing', 'decode', 'build', 'write']
+
+
+def get_git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_parser(config, table_names, start_method):
+    """
+    Build the given tables with parse_day and take the time of each stage from the metrics it
+    records. Runs in a fresh process so the peak RSS is that of one parser run.
+    """
+    # spawned processes start their own workers by spawning too, start them the way a parser run
+    # started from the command line would
+    multiprocessing.set_start_method(start_method, force=True)
+    start_time = time.perf_counter()
+    num_snapshots = parse_day(config, table_names)
+    elapsed_seconds = time.perf_counter() - start_time
+
+    summary = get_summary()
+    stage_seconds = {
+        stage: sum(entry['total_seconds'] for entry in summary['timers'].get(stage, [])) for stage in STAGES
+    }
+    num_entities = sum(entry['value'] for entry in summary['counters'].get('entities_processed', []))
+    return {
+        'elapsed_seconds': elapsed_seconds,
+        'stage_seconds': stage_seconds,
+        'snapshots': num_snapshots,
+        'entities': num_entities,
+        'files_per_second': num_snapshots / elapsed_seconds,
+        'entities_per_second': num_entities / elapsed_seconds,
+        # ru_maxrss is in kilobytes on linux
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'peak_worker_rss_mb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+        # the counters and timers recorded by the parser itself, like dedupe hits and rows written
+        'metrics': summary
+    }
+
+
+def run_benchmark(config, table_names):
+    # each run gets an empty schedule cache and output folder, so runs are comparable
+    run_folder = tempfile.mkdtemp(prefix='tides-benchmark-')
+    run_config = dict(config)
+    run_config['schedule_cache_folder'] = os.path.join(run_folder, 'schedule_cache')
+    run_config['tides_output_folder'] = os.path.join(run_folder, 'output')
+    # checkpoints are only saved if the config asks for them
+    run_config.setdefault('checkpoint_interval_seconds', None)
+    # logging every file would otherwise be a good part of what is measured
+    run_config.setdefault('quiet', True)
+    try:
+        # spawn rather than fork, so nothing loaded by a previous run counts towards the peak RSS.
+        # Unlike multiprocessing pool workers, executor workers can start the parser's own decode
+        # and shard workers.
+        with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as executor:
+            future = executor.submit(run_parser, run_config, table_names, multiprocessing.get_start_method())
+            return future.result()
+    finally:
+        shutil.rmtree(run_folder, ignore_errors=True)
+
+
+def log_comparison(results, baseline_results_path):
+    with open(baseline_results_path) as f:
+        baseline_results = json.load(f)
+    logger.info(f"Comparing with {baseline_results_path} (commit {baseline_results.get('git_commit')})")
+    for benchmark_name, benchmark_results in results['benchmarks'].items():
+        baseline = baseline_results['benchmarks'].get(benchmark_name)
+        if baseline is None:
+            continue
+        logger.info(
+            f"{benchmark_name}: files/second {benchmark_results['files_per_second'] / baseline['files_per_second']:.2f}x, "
+            f"peak RSS {benchmark_results['peak_rss_mb'] / baseline['peak_rss_mb']:.2f}x of baseline"
+        )
+
+
+def main():
+    config = load_config('benchmark.py')
+    num_runs = config.get('num_runs', DEFAULT_NUM_RUNS)
+    results = {
+        'git_commit': get_git_commit(),
+        'created_at': datetime.now(timezone.utc).isoformat(),
+        'python_version': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'config': config,
+        'benchmarks': {}
+    }
+
+    for benchmark_name, table_names in config.get('benchmarks', DEFAULT_BENCHMARKS).items():
+        runs = []
+        for run_number in range(num_runs):
+            run = run_benchmark(config, table_names)
+            logger.info(
+                f"{benchmark_name} run {run_number + 1}/{num_runs}: {run['elapsed_seconds']:.2f} seconds, "
+                f"{run['files_per_second']:.1f} files/second, {run['entities_per_second']:.0f} entities/second, "
+                f"peak RSS {run['peak_rss_mb']:.1f} MB, stages "
+                + ', '.join(f"{stage} {seconds:.2f}s" for stage, seconds in run['stage_seconds'].items())
+            )
+            runs.append(run)
+
+        # the fastest run is the one least disturbed by everything else on the machine
+        best_run = min(runs, key=lambda run: run['elapsed_seconds'])
+        results['benchmarks'][benchmark_name] = dict(best_run, tables=table_names, runs=runs)
+
+    with open(config['results_path'], 'w') as f:
+        json.dump(results, f, indent=2)
+    logger.info(f"Saved benchmark results to {config['results_path']}")
+
+    if config.get('baseline_results_path'):
+        log_comparison(results, config['baseline_results_path'])
+
+
+if __name__ == '__main__':
+    main()
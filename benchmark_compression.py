@@ -0,0 +1,182 @@
+### Compares the size and read throughput of raw and zstd compressed snapshots of a day of data
+
+import json
+import logging
+import os
+import shutil
+import time
+
+from datetime import datetime, timezone
+
+from benchmark import get_git_commit
+from rt_compression import COMPRESSED_FILE_EXTENSION, DEFAULT_COMPRESSION_LEVEL, DEFAULT_DICTIONARY_SIZE, \
+    DEFAULT_DICTIONARY_TRAINING_SAMPLES, DICTIONARY_FOLDER_NAME, SnapshotCompressor, global_decompressors, \
+    require_zstandard, zstandard
+from rt_extract import extract_trip_updates, extract_vehicle_positions
+from rt_storage import SNAPSHOT_FILE_EXTENSION, SnapshotReader
+from tides_engine import FOLDER_NAMES, TRIP_UPDATES_FOLDER_NAME, VEHICLE_POSITIONS_FOLDER_NAME
+from utils import create_folder, load_config
+
+logging.basicConfig(
+    format='%(levelname)s %(asctime)s %(filename)s:%(lineno)d| %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+# constants
+EXTRACT_FUNCS = {
+    VEHICLE_POSITIONS_FOLDER_NAME: extract_vehicle_positions,
+    TRIP_UPDATES_FOLDER_NAME: extract_trip_updates
+}
+DEFAULT_NUM_RUNS = 3
+RAW_FOLDER_NAME = 'raw'
+COMPRESSED_FOLDER_NAME = 'zstd'
+
+
+def get_folder_size(paths):
+    return sum(os.path.getsize(path) for path in paths)
+
+
+def prepare_snapshots(config, url_type, work_folder):
+    """
+    Copy the day's snapshots of a url type to `<work_folder>/raw` and save them compressed, like
+    the downloader does, to `<work_folder>/zstd`. Returns the paths of both copies and the size of
+    the snapshots compressed without a dictionary.
+    """
+    source_folder = os.path.join(config['raw_data_path'], config['date'], url_type)
+    filenames = sorted(
+        filename for filename in os.listdir(source_folder) if filename.endswith(SNAPSHOT_FILE_EXTENSION)
+    )
+    feed_name = os.path.basename(os.path.normpath(config['raw_data_path']))
+    raw_folder = os.path.join(work_folder, RAW_FOLDER_NAME, feed_name, config['date'], url_type)
+    compressed_folder = os.path.join(work_folder, COMPRESSED_FOLDER_NAME, feed_name, config['date'], url_type)
+    create_folder(raw_folder)
+    create_folder(compressed_folder)
+
+    level = config.get('compression_level', DEFAULT_COMPRESSION_LEVEL)
+    compressor = SnapshotCompressor(
+        os.path.join(work_folder, COMPRESSED_FOLDER_NAME, feed_name, DICTIONARY_FOLDER_NAME),
+        url_type,
+        level,
+        config.get('dictionary_size', DEFAULT_DICTIONARY_SIZE),
+        config.get('dictionary_training_samples', DEFAULT_DICTIONARY_TRAINING_SAMPLES)
+    )
+    plain_compressor = zstandard.ZstdCompressor(level=level)
+    raw_paths = []
+    compressed_paths = []
+    num_plain_compressed_bytes = 0
+    for filename in filenames:
+        with open(os.path.join(source_folder, filename), 'rb') as f:
+            payload = f.read()
+        raw_path = os.path.join(raw_folder, filename)
+        with open(raw_path, 'wb') as f:
+            f.write(payload)
+        compressed_path = os.path.join(compressed_folder, f"{filename}{COMPRESSED_FILE_EXTENSION}")
+        with open(compressed_path, 'wb') as f:
+            f.write(compressor.compress(payload))
+        num_plain_compressed_bytes += len(plain_compressor.compress(payload))
+        raw_paths.append(raw_path)
+        compressed_paths.append(compressed_path)
+    return raw_paths, compressed_paths, num_plain_compressed_bytes
+
+
+def drop_from_page_cache(paths):
+    # only evicts clean pages, so flush them first. Files on tmpfs can't be evicted.
+    for path in paths:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+
+def time_reads(paths, extract_func, cold_cache):
+    if cold_cache:
+        drop_from_page_cache(paths)
+    # dictionaries are loaded again like in a fresh parser process
+    global_decompressors.clear()
+    reader = SnapshotReader()
+    num_payload_bytes = 0
+    num_entities = 0
+    start_time = time.perf_counter()
+    for path in paths:
+        payload = reader.read(path)
+        num_payload_bytes += len(payload)
+        num_entities += len(extract_func(payload)[1])
+    elapsed_seconds = time.perf_counter() - start_time
+    reader.close()
+    return {
+        'elapsed_seconds': elapsed_seconds,
+        'files_per_second': len(paths) / elapsed_seconds,
+        'stored_mb_per_second': get_folder_size(paths) / elapsed_seconds / 1e6,
+        'payload_mb_per_second': num_payload_bytes / elapsed_seconds / 1e6,
+        'entities': num_entities
+    }
+
+
+def benchmark_url_type(config, url_type, work_folder):
+    raw_paths, compressed_paths, num_plain_compressed_bytes = prepare_snapshots(config, url_type, work_folder)
+    num_raw_bytes = get_folder_size(raw_paths)
+    num_compressed_bytes = get_folder_size(compressed_paths)
+    results = {
+        'snapshots': len(raw_paths),
+        'raw_bytes': num_raw_bytes,
+        'compressed_bytes': num_compressed_bytes,
+        'compressed_without_dictionary_bytes': num_plain_compressed_bytes,
+        'compression_ratio': num_raw_bytes / num_compressed_bytes,
+        'compression_ratio_without_dictionary': num_raw_bytes / num_plain_compressed_bytes
+    }
+    logger.info(
+        f"{url_type}: {len(raw_paths)} snapshots, {num_raw_bytes / 1e6:.1f} MB raw, "
+        f"{num_compressed_bytes / 1e6:.1f} MB compressed ({results['compression_ratio']:.1f}x), "
+        f"{results['compression_ratio_without_dictionary']:.1f}x without a dictionary"
+    )
+
+    extract_func = EXTRACT_FUNCS[url_type]
+    num_runs = config.get('num_runs', DEFAULT_NUM_RUNS)
+    for cache in ['cold', 'warm']:
+        for name, paths in [('raw', raw_paths), ('compressed', compressed_paths)]:
+            runs = [time_reads(paths, extract_func, cache == 'cold') for _ in range(num_runs)]
+            # the fastest run is the one least disturbed by everything else on the machine
+            best_run = min(runs, key=lambda run: run['elapsed_seconds'])
+            results[f"{cache}_{name}"] = best_run
+            logger.info(
+                f"{url_type} {cache} cache {name}: {best_run['files_per_second']:.1f} files/second, "
+                f"{best_run['stored_mb_per_second']:.1f} MB/second read, "
+                f"{best_run['payload_mb_per_second']:.1f} MB/second of payloads"
+            )
+    return results
+
+
+def main():
+    config = load_config('benchmark_compression.py')
+    require_zstandard()
+    results = {
+        'git_commit': get_git_commit(),
+        'created_at': datetime.now(timezone.utc).isoformat(),
+        'zstandard_version': zstandard.__version__,
+        'config': config,
+        'url_types': {}
+    }
+
+    # keep the copies on the same disk as the raw data by default, as /tmp is often tmpfs where
+    # the page cache can't be dropped
+    # the work folder is removed afterwards, so refuse to reuse one that holds anything else
+    work_folder = config.get('work_folder', 'compression_benchmark')
+    if os.path.isdir(work_folder) and len(os.listdir(work_folder)) > 0:
+        raise ValueError(f"The work folder ({work_folder}) must be missing or empty")
+    create_folder(work_folder)
+    try:
+        for url_type in config.get('url_types', FOLDER_NAMES):
+            results['url_types'][url_type] = benchmark_url_type(config, url_type, work_folder)
+    finally:
+        shutil.rmtree(work_folder, ignore_errors=True)
+
+    with open(config['results_path'], 'w') as f:
+        json.dump(results, f, indent=2)
+    logger.info(f"Saved compression benchmark results to {config['results_path']}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+### A script to roll the raw GTFS-RT snapshots of a finished day into one segment archive per
+# url type
+
+import logging
+import os
+import time
+
+from rt_storage import compact_folder
+from utils import load_config
+
+logging.basicConfig(
+    format='%(levelname)s %(asctime)s %(filename)s:%(lineno)d| %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+RT_FOLDER_NAMES = ['service_alerts_url', 'trip_updates_url', 'vehicle_positions_url']
+
+
+def main():
+    script_start_time = time.time()
+    config = load_config('compact_raw_data.py')
+    raw_data_folder = config['raw_data_path']
+    date_str = config['date']
+    remove_files = not config.get('keep_original_files', False)
+
+    for folder_name in RT_FOLDER_NAMES:
+        folder = os.path.join(raw_data_folder, date_str, folder_name)
+        if not os.path.exists(folder):
+            continue
+        logger.info(f"Compacting {folder}")
+        num_snapshots = compact_folder(folder, remove_files=remove_files)
+        logger.info(f"Wrote {num_snapshots} snapshots to the segment for {folder}")
+
+    script_end_time = time.time()
+    script_elapsed_time = script_end_time - script_start_time
+    logger.info(f"Compacting data for {date_str} took {script_elapsed_time:.4f} seconds")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,18 +1,36 @@
 ### A script to continually download and save multiple GTFS files to folders organized by
 # feed and date
 
+import csv
+import hashlib
+import io
+import json
 import logging
 import os
 import shutil
+import sys
+import threading
 import time
+import zipfile
 
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from urllib.parse import urlparse
 
-import gtfs_kit
 import requests
 import schedule
 import pytz
 
+from google.transit import gtfs_realtime_pb2
+from requests.adapters import HTTPAdapter
+
+from metrics import increment, observe, write_metrics
+from poll_schedule import DEFAULT_INITIAL_POLL_INTERVAL_SECONDS, DEFAULT_MAX_POLL_INTERVAL_SECONDS, \
+    DEFAULT_MIN_POLL_INTERVAL_SECONDS, AdaptivePollSchedule
+from rt_compression import COMPRESSED_FILE_EXTENSION, COMPRESSIONS, DEFAULT_COMPRESSION_LEVEL, \
+    DEFAULT_DICTIONARY_SIZE, DEFAULT_DICTIONARY_TRAINING_SAMPLES, DICTIONARY_FOLDER_NAME, SnapshotCompressor, \
+    require_zstandard
+from rt_storage import append_manifest_row, compact_folder
 from utils import create_folder, load_config
 
 logging.basicConfig(
@@ -23,146 +41,568 @@ logger = logging.getLogger(__name__)
 
 # constants
 RT_URLS = ['service_alerts_url', 'trip_updates_url', 'vehicle_positions_url']
+# the main loop wakes up at least this often for the other scheduled jobs
+MAX_SLEEP_SECONDS = 1
+DEFAULT_MAX_WORKERS = 32
+DEFAULT_MAX_CONNECTIONS_PER_HOST = 4
+DEFAULT_REQUEST_TIMEOUT_SECONDS = 10
+SCHEDULE_STORE_FOLDER_NAME = 'schedule_store'
+SCHEDULE_STORE_STATE_FILENAME = 'latest.json'
 
 # globals
 global_feeds = {}
 global_save_folder = 'saved_data'
-
-
-def download_file(url, save_filename):
-    logger.info(f"Downloading from {url}")
+global_max_workers = DEFAULT_MAX_WORKERS
+global_max_connections_per_host = DEFAULT_MAX_CONNECTIONS_PER_HOST
+global_request_timeout = DEFAULT_REQUEST_TIMEOUT_SECONDS
+global_dedupe_header_timestamp = False
+global_compact_finished_days = False
+# quiet downloaders don't log every fetch
+global_quiet = False
+global_config = {}
+global_config_path = None
+# modification time of the config file when it was last loaded
+global_config_mtime = None
+global_config_lock = threading.Lock()
+# the scheduler's jobs are added to from the config thread while the main loop runs them
+global_schedule_lock = threading.Lock()
+# timezones that have daily schedule download and compaction jobs
+global_scheduled_timezones = set()
+global_executor = None
+global_sessions = {}
+global_sessions_lock = threading.Lock()
+global_min_poll_interval = DEFAULT_MIN_POLL_INTERVAL_SECONDS
+global_max_poll_interval = DEFAULT_MAX_POLL_INTERVAL_SECONDS
+global_initial_poll_interval = DEFAULT_INITIAL_POLL_INTERVAL_SECONDS
+# snapshots are saved uncompressed unless set to one of COMPRESSIONS
+global_compression = None
+global_compression_level = DEFAULT_COMPRESSION_LEVEL
+global_dictionary_size = DEFAULT_DICTIONARY_SIZE
+global_dictionary_training_samples = DEFAULT_DICTIONARY_TRAINING_SAMPLES
+# (feed name, url type) keys to the SnapshotCompressor of each polled url
+global_compressors = {}
+global_compressors_lock = threading.Lock()
+# (feed name, url type) keys to the AdaptivePollSchedule of the url
+global_poll_schedules = {}
+# set when a poll finishes, so its next poll is scheduled without waiting out the main loop's sleep
+global_poll_finished = threading.Event()
+# conditional request validators and the last saved content for each url
+global_url_states = {}
+global_url_states_lock = threading.Lock()
+
+
+def get_session(url):
+    # reuse one keep-alive session per host so that repeated polls don't pay for a new
+    # TCP/TLS handshake every few seconds
+    host = urlparse(url).netloc
+    with global_sessions_lock:
+        session = global_sessions.get(host)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=global_max_connections_per_host,
+                pool_block=True
+            )
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            global_sessions[host] = session
+        return session
+
+
+def get_executor():
+    global global_executor
+
+    if global_executor is None:
+        global_executor = ThreadPoolExecutor(max_workers=global_max_workers, thread_name_prefix='fetch')
+    return global_executor
+
+
+def get_url_state(url):
+    with global_url_states_lock:
+        return global_url_states.setdefault(url, {
+            'etag': None,
+            'last_modified': None,
+            'content_hash': None,
+            'header_timestamp': None
+        })
+
+
+def fetch_if_changed(url, feed_name=None, url_type=None):
+    """
+    Download the url and return a tuple of (content, content_hash), or None if the download
+    failed or the payload is unchanged since the last successful fetch of the same url. The
+    latency and result of each download are recorded by feed and url type.
+    """
+    if not global_quiet:
+        logger.info(f"Downloading from {url}")
+    url_state = get_url_state(url)
+
+    # ask the server to skip the body if nothing changed since the last fetch
+    headers = {}
+    if url_state['etag'] is not None:
+        headers['If-None-Match'] = url_state['etag']
+    if url_state['last_modified'] is not None:
+        headers['If-Modified-Since'] = url_state['last_modified']
+
+    request_start_time = time.perf_counter()
     try:
-        response = requests.get(url, timeout=10, stream=True)
+        response = get_session(url).get(url, headers=headers, timeout=global_request_timeout)
+        if response.status_code == 304:
+            observe('download', time.perf_counter() - request_start_time, feed=feed_name, url_type=url_type)
+            increment('downloads', feed=feed_name, url_type=url_type, result='unmodified')
+            if not global_quiet:
+                logger.info(f"Skipping unmodified response from {url}")
+            return None
         response.raise_for_status()  # Check if the request was successful
-
-        with open(save_filename, 'wb') as file:
-            for chunk in response.iter_content(chunk_size=8192):
-                file.write(chunk)
-
-        logger.info(f"File saved successfully to {save_filename}")
+        content = response.content
     except requests.exceptions.RequestException as e:
+        increment('downloads', feed=feed_name, url_type=url_type, result='failed')
         logger.error(f"Failed to download from URL ({url}): {e}")
+        return None
+    observe('download', time.perf_counter() - request_start_time, feed=feed_name, url_type=url_type)
+
+    url_state['etag'] = response.headers.get('ETag')
+    url_state['last_modified'] = response.headers.get('Last-Modified')
+
+    # servers without validators still often return byte-identical payloads
+    content_hash = hashlib.sha256(content).hexdigest()
+    if content_hash == url_state['content_hash']:
+        increment('downloads', feed=feed_name, url_type=url_type, result='unchanged')
+        if not global_quiet:
+            logger.info(f"Skipping unchanged content from {url}")
+        return None
+
+    increment('downloads', feed=feed_name, url_type=url_type, result='changed')
+    increment('downloaded_bytes', len(content), feed=feed_name, url_type=url_type)
+    url_state['content_hash'] = content_hash
+    return content, content_hash
+
+
+def parse_feed_summary(content):
+    # returns the header timestamp and number of entities of a GTFS-RT payload
+    message = gtfs_realtime_pb2.FeedMessage()
+    message.ParseFromString(content)
+    return message.header.timestamp, len(message.entity)
+
+
+def write_file(save_filename, content):
+    # write to a temporary file first so that readers never see a partially written file
+    tmp_filename = f"{save_filename}.tmp"
+    with open(tmp_filename, 'wb') as file:
+        file.write(content)
+    os.replace(tmp_filename, save_filename)
+
+
+def get_compressor(feed_name, url_type):
+    key = (feed_name, url_type)
+    with global_compressors_lock:
+        compressor = global_compressors.get(key)
+        if compressor is None:
+            compressor = global_compressors[key] = SnapshotCompressor(
+                os.path.join(global_save_folder, feed_name, DICTIONARY_FOLDER_NAME),
+                url_type,
+                global_compression_level,
+                global_dictionary_size,
+                global_dictionary_training_samples
+            )
+        return compressor
+
+
+def download_rt_file(url, save_filename, fetch_time, feed_name=None, url_type=None):
+    # returns the (save_filename, header_timestamp) of a saved snapshot, or None if there was
+    # nothing new to save
+    result = fetch_if_changed(url, feed_name, url_type)
+    if result is None:
+        return None
+
+    content, content_hash = result
+    try:
+        header_timestamp, entity_count = parse_feed_summary(content)
+    except Exception as e:
+        logger.error(f"Failed to parse GTFS-RT payload from URL ({url}): {e}")
+        header_timestamp, entity_count = None, None
+
+    url_state = get_url_state(url)
+    if global_dedupe_header_timestamp and header_timestamp is not None:
+        # some producers rewrite the payload without publishing new data, so also treat an
+        # unchanged FeedHeader timestamp as an unchanged feed
+        if header_timestamp == url_state['header_timestamp']:
+            increment('downloads_skipped_unchanged_header', feed=feed_name, url_type=url_type)
+            if not global_quiet:
+                logger.info(f"Skipping content with unchanged header timestamp from {url}")
+            return None
+        url_state['header_timestamp'] = header_timestamp
+
+    saved_content = content
+    if global_compression is not None and feed_name is not None:
+        # the hash stays that of the payload as served, for comparing with later fetches
+        saved_content = get_compressor(feed_name, url_type).compress(content)
+        save_filename = f"{save_filename}{COMPRESSED_FILE_EXTENSION}"
+        increment('compressed_bytes', len(saved_content), feed=feed_name, url_type=url_type)
+    write_file(save_filename, saved_content)
+    if not global_quiet:
+        logger.info(f"File saved successfully to {save_filename}")
 
-
-def download_and_process_config():
-    global global_feeds, global_save_folder
-
-    logger.info('downloading and processing config')
-    config = load_config('downloader.py')
+    # index the snapshot so the parsers can find files in their analysis window without
+    # listing and decoding the whole folder. Unparseable payloads are kept on disk but left
+    # out of the manifest.
+    if header_timestamp is not None:
+        append_manifest_row(os.path.dirname(save_filename), {
+            'filename': os.path.basename(save_filename),
+            'fetch_time': fetch_time,
+            'header_timestamp': header_timestamp,
+            'size': len(saved_content),
+            'content_hash': content_hash,
+            'entity_count': entity_count
+        })
+    return save_filename, header_timestamp
+
+
+def download_schedule_file(url, feed_save_folder, schedule_folder=None):
+    """
+    Download a GTFS schedule zip into the feed's content-addressed schedule store and hardlink
+    it into the given date's schedule folder, if any. Returns the path of the stored zip, or None
+    if no version of the schedule has ever been downloaded successfully.
+    """
+    store_folder = os.path.join(feed_save_folder, SCHEDULE_STORE_FOLDER_NAME)
+    create_folder(store_folder)
+    state_path = os.path.join(store_folder, SCHEDULE_STORE_STATE_FILENAME)
+
+    # restore the validators of the latest stored zip so that a restarted downloader doesn't
+    # fetch an unchanged schedule again
+    url_state = get_url_state(url)
+    if url_state['content_hash'] is None and os.path.exists(state_path):
+        with open(state_path, 'r') as f:
+            stored_state = json.load(f)
+        if stored_state.get('url') == url:
+            url_state.update({key: stored_state.get(key) for key in url_state.keys()})
+
+    result = fetch_if_changed(url, os.path.basename(feed_save_folder), 'schedule_url')
+    if result is not None:
+        content, content_hash = result
+        stored_path = os.path.join(store_folder, f"{content_hash}.zip")
+        if not os.path.exists(stored_path):
+            write_file(stored_path, content)
+            logger.info(f"Stored new schedule version at {stored_path}")
+        with open(state_path, 'w') as f:
+            json.dump({'url': url, **url_state}, f)
+
+    if url_state['content_hash'] is None:
+        return None
+
+    stored_path = os.path.join(store_folder, f"{url_state['content_hash']}.zip")
+    if schedule_folder is not None:
+        create_folder(schedule_folder)
+        link_file(stored_path, os.path.join(schedule_folder, 'gtfs.zip'))
+    return stored_path
+
+
+def link_file(source_path, destination_path):
+    if os.path.exists(destination_path):
+        if os.path.samefile(source_path, destination_path):
+            return
+        os.remove(destination_path)
+    try:
+        os.link(source_path, destination_path)
+    except OSError:
+        # fall back to a copy on filesystems that don't support hardlinks
+        shutil.copy(source_path, destination_path)
+
+
+def read_agency_timezone(gtfs_zip_path):
+    # only read agency.txt, loading the whole feed just for the timezone takes minutes for big feeds
+    with zipfile.ZipFile(gtfs_zip_path) as gtfs_zip:
+        with gtfs_zip.open('agency.txt') as f:
+            for row in csv.DictReader(io.TextIOWrapper(f, encoding='utf-8-sig')):
+                # feeds are added to the timezone the first agency is associated with
+                return row['agency_timezone'].strip()
+    raise ValueError(f"No agencies found in {gtfs_zip_path}")
+
+
+def apply_config(config):
+    global global_save_folder, global_max_workers, global_max_connections_per_host, global_request_timeout, \
+        global_dedupe_header_timestamp, global_compact_finished_days, global_quiet, global_config, \
+        global_min_poll_interval, global_max_poll_interval, global_initial_poll_interval, global_compression, \
+        global_compression_level, global_dictionary_size, global_dictionary_training_samples
+
+    # validate before applying anything, so an invalid reloaded config leaves the previous one
+    compression = config.get('compression')
+    if compression is not None:
+        if compression not in COMPRESSIONS:
+            raise ValueError(f"Unknown compression {compression}, expected one of {COMPRESSIONS}")
+        require_zstandard()
+
+    global_quiet = config.get('quiet', False)
     global_save_folder = config['save_folder']
     create_folder(global_save_folder)
 
-    found_feed_names = set()
-    fetch_timezones = set()
+    # fetch engine settings only take effect before the first poll creates the pool
+    global_max_workers = config.get('max_workers', DEFAULT_MAX_WORKERS)
+    global_max_connections_per_host = config.get('max_connections_per_host', DEFAULT_MAX_CONNECTIONS_PER_HOST)
+    global_request_timeout = config.get('request_timeout_seconds', DEFAULT_REQUEST_TIMEOUT_SECONDS)
+    global_dedupe_header_timestamp = config.get('dedupe_header_timestamp', False)
+    global_compact_finished_days = config.get('compact_finished_days', False)
+    # poll intervals apply to urls polled for the first time or whose url changed
+    global_min_poll_interval = config.get('min_poll_interval_seconds', DEFAULT_MIN_POLL_INTERVAL_SECONDS)
+    global_max_poll_interval = config.get('max_poll_interval_seconds', DEFAULT_MAX_POLL_INTERVAL_SECONDS)
+    global_initial_poll_interval = config.get('initial_poll_interval_seconds', DEFAULT_INITIAL_POLL_INTERVAL_SECONDS)
+    # the compression level and dictionary settings apply to urls first saved compressed since the
+    # downloader started
+    global_compression = compression
+    global_compression_level = config.get('compression_level', DEFAULT_COMPRESSION_LEVEL)
+    global_dictionary_size = config.get('dictionary_size', DEFAULT_DICTIONARY_SIZE)
+    global_dictionary_training_samples = config.get(
+        'dictionary_training_samples',
+        DEFAULT_DICTIONARY_TRAINING_SAMPLES
+    )
+    global_config = config
+
+
+def add_feed(name, urls):
+    """
+    Download the initial schedule of a new feed and start polling it. Returns False if the feed
+    can't be added yet.
+    """
+    logger.info(f"Processing new feed: {name}")
+
+    # create feed save folder
+    feed_save_folder = os.path.join(global_save_folder, name)
+    create_folder(feed_save_folder)
+
+    # download initial schedule feed
+    initial_gtfs_schedule_path = download_schedule_file(urls['schedule_url'], feed_save_folder)
+    if initial_gtfs_schedule_path is None:
+        logger.error(f"Unable to process new feed {name} without a schedule, will retry later")
+        return False
 
-    for feed_config in global_feeds.values():
-        fetch_timezones.add(feed_config['timezone'])
-
-    for name, urls in config['feeds'].items():
-        found_feed_names.add(name)
-        if name not in global_feeds:
-            logger.info(f"Processing new feed: {name}")
-            global_feeds[name] = {}
-
-            # create feed save folder
-            feed_save_folder = os.path.join(global_save_folder, name)
-            create_folder(feed_save_folder)
+    try:
+        agency_timezone = read_agency_timezone(initial_gtfs_schedule_path)
+    except Exception as e:
+        logger.error(f"Unable to read the timezone of new feed {name}, will retry later: {e}")
+        return False
+
+    with global_schedule_lock:
+        if agency_timezone not in global_scheduled_timezones:
+            schedule.every().day.at('02:30', agency_timezone).do(
+                run_in_thread, download_schedule_files_for_timezone, timezone=agency_timezone)
+            schedule.every().day.at('02:30', agency_timezone).do(
+                run_in_thread, compact_finished_days_for_timezone, timezone=agency_timezone)
+            global_scheduled_timezones.add(agency_timezone)
+
+    # link initial file into the appropriate date folder for the agency timezone
+    now = datetime.now(pytz.timezone(agency_timezone))
+    schedule_folder = os.path.join(feed_save_folder, f"{now:%Y-%m-%d}", 'schedule')
+    create_folder(schedule_folder)
+    link_file(initial_gtfs_schedule_path, os.path.join(schedule_folder, 'gtfs.zip'))
+
+    # publish the feed config only once it's complete, so a poll never sees a half-processed feed
+    global_feeds[name] = {'timezone': agency_timezone, 'urls': urls}
+    logger.info(f"Finished processing new feed: {name}")
+    return True
 
-            # download initial schedule feed
-            initial_gtfs_schedule_path = os.path.join(feed_save_folder, 'init_gtfs_schedule.zip')
-            download_file(urls['schedule_url'], initial_gtfs_schedule_path)
 
-            # add feed to the timezone the first agency is associated with
-            feed = gtfs_kit.read_feed(initial_gtfs_schedule_path, 'm')
+def download_and_process_config():
+    """
+    Reload the config if it changed and add its new feeds. Runs on its own thread, so realtime
+    polls keep going while the schedule of a new feed is downloaded. Feeds that couldn't be
+    added are retried on the next run.
+    """
+    global global_config_mtime
 
-            agency_timezone = feed.agency.at[0, 'agency_timezone']
-            global_feeds[name]['timezone'] = agency_timezone
+    # a run that is still adding feeds already covers this one
+    if not global_config_lock.acquire(blocking=False):
+        return
 
-            if agency_timezone not in fetch_timezones:
-                # schedule
-                schedule.every().day.at('02:30', agency_timezone).do(
-                    download_schedule_files_for_timezone, timezone=agency_timezone)
-                fetch_timezones.add(agency_timezone)
+    try:
+        config_mtime = os.stat(global_config_path).st_mtime_ns
+        if config_mtime != global_config_mtime:
+            logger.info('Loading changed config')
+            try:
+                with open(global_config_path, 'r') as f:
+                    config = json.load(f)
+                apply_config(config)
+            except (ImportError, ValueError) as e:
+                # probably caught while being saved, try again on the next run
+                logger.error(f"Unable to load config, keeping the previous one: {e}")
+                return
+            global_config_mtime = config_mtime
+
+        feed_urls = global_config['feeds']
+        for name, urls in feed_urls.items():
+            if name in global_feeds:
+                global_feeds[name]['urls'] = urls
+            else:
+                add_feed(name, urls)
+
+        # remove feeds no longer present
+        for feed_name in list(global_feeds.keys()):
+            if feed_name not in feed_urls:
+                logger.info(f"Removing feed: {feed_name}")
+                del global_feeds[feed_name]
+    finally:
+        global_config_lock.release()
+
+
+def get_rt_save_filename(feed_name, timezone, url_type, fetch_time):
+    now = datetime.fromtimestamp(fetch_time, pytz.timezone(timezone))
+    # add timestamp to account for daylight savings time transitions
+    formatted_request_time = f"{int(now.timestamp())}-{now:%Y-%m-%d-%H-%M-%S}"
+    feed_date_url_type_save_folder = os.path.join(global_save_folder, feed_name, f"{now:%Y-%m-%d}", url_type)
+    create_folder(feed_date_url_type_save_folder)
+    return os.path.join(feed_date_url_type_save_folder, f"{formatted_request_time}.pb")
+
+
+def poll_rt_url(feed_name, timezone, url_type, poll_schedule):
+    # runs on the fetch pool and schedules the url's next poll from what this one found
+    fetch_time = time.time()
+    try:
+        result = download_rt_file(
+            poll_schedule.url,
+            get_rt_save_filename(feed_name, timezone, url_type, fetch_time),
+            int(fetch_time),
+            feed_name,
+            url_type
+        )
+        previous_update_interval = poll_schedule.get_update_interval()
+        if result is None:
+            poll_schedule.record_miss(fetch_time)
+        else:
+            poll_schedule.record_update(fetch_time, result[1])
+        update_interval = poll_schedule.get_update_interval()
+        if update_interval != previous_update_interval:
+            logger.info(f"Polling {feed_name} {url_type} for updates every {update_interval} seconds")
+    except Exception:
+        logger.exception(f"Failed to poll {feed_name} {url_type}")
+        poll_schedule.record_failure(fetch_time)
+    finally:
+        poll_schedule.in_flight = False
+        global_poll_finished.set()
+
+
+def poll_due_rt_urls():
+    """
+    Start a poll on the fetch pool for every realtime url whose next poll is due, and return the
+    number of seconds until the next one is.
+    """
+    now = time.time()
+    next_poll_time = now + global_max_poll_interval
+    polled_keys = set()
+
+    for name, feed_config in list(global_feeds.items()):
+        for url_type in RT_URLS:
+            if url_type not in feed_config['urls']:
+                continue
+            key = (name, url_type)
+            polled_keys.add(key)
+            url = feed_config['urls'][url_type]
+            poll_schedule = global_poll_schedules.get(key)
+            if poll_schedule is None or poll_schedule.url != url:
+                poll_schedule = global_poll_schedules[key] = AdaptivePollSchedule(
+                    url,
+                    global_min_poll_interval,
+                    global_max_poll_interval,
+                    global_initial_poll_interval
+                )
 
-            # copy initial file to appropriate date folder
-            now = datetime.now(pytz.timezone(agency_timezone))
-            schedule_folder = os.path.join(feed_save_folder, f"{now:%Y-%m-%d}", 'schedule')
-            create_folder(schedule_folder)
-            shutil.copy(initial_gtfs_schedule_path, os.path.join(schedule_folder, 'gtfs.zip'))
-            logger.info(f"Finished processing new feed: {name}")
+            # a url is only polled once at a time, a slow poll delays the next one instead
+            if poll_schedule.in_flight:
+                continue
+            if poll_schedule.next_poll_time <= now:
+                observe('poll_delay', now - poll_schedule.next_poll_time, feed=name, url_type=url_type)
+                poll_schedule.in_flight = True
+                get_executor().submit(poll_rt_url, name, feed_config['timezone'], url_type, poll_schedule)
+            else:
+                next_poll_time = min(next_poll_time, poll_schedule.next_poll_time)
 
-        global_feeds[name]['urls'] = urls
+    # forget the schedules of removed feeds and urls
+    for key in list(global_poll_schedules.keys()):
+        if key not in polled_keys:
+            del global_poll_schedules[key]
 
-    # remove feeds no longer present
-    for feed_name in global_feeds.keys():
-        if feed_name not in found_feed_names:
-            logger.info(f"Removing feed: {feed_name}")
-            del global_feeds[feed_name]
+    return next_poll_time - now
 
-    logger.info('Finished processing config')
-    
 
-def download_rt_files():
+def download_schedule_files_for_timezone(timezone):
     global global_feeds, global_save_folder
 
-    logger.info('Begin downloading rt files')
+    logger.info('Begin downloading schedule files')
+
+    now = datetime.now(pytz.timezone(timezone))
+    feed_date = f"{now:%Y-%m-%d}"
 
     for name, feed_config in global_feeds.items():
-        now = datetime.now(pytz.timezone(feed_config['timezone']))
-        # add timestamp to account for daylight savings time transitions
-        formatted_request_time = f"{int(now.timestamp())}-{now:%Y-%m-%d-%H-%M-%S}"
-        feed_date_save_folder = os.path.join(global_save_folder, name, f"{now:%Y-%m-%d}")
+        if feed_config['timezone'] != timezone:
+            continue
 
-        for url_type in RT_URLS:
-            if url_type in feed_config['urls']:
-                feed_date_url_type_save_folder = os.path.join(feed_date_save_folder, url_type)
-                create_folder(feed_date_url_type_save_folder)
-                download_file(
-                    feed_config['urls'][url_type],
-                    os.path.join(feed_date_url_type_save_folder, f"{formatted_request_time}.pb")
-                )
+        feed_save_folder = os.path.join(global_save_folder, name)
+        download_schedule_file(
+            feed_config['urls']['schedule_url'],
+            feed_save_folder,
+            os.path.join(feed_save_folder, feed_date, 'schedule')
+        )
 
-    logger.info('Finished downloading rt files')
+    logger.info('Finished downloading schedule files')
 
 
-def download_schedule_files_for_timezone(timezone):
+def compact_finished_days_for_timezone(timezone):
     global global_feeds, global_save_folder
 
-    logger.info('Begin downloading schedule files')
+    if not global_compact_finished_days:
+        return
 
+    logger.info('Begin compacting finished days')
+
+    # no more snapshots are saved to yesterday's folders once the date has rolled over
     now = datetime.now(pytz.timezone(timezone))
-    feed_date = f"{now:%Y-%m-%d}"
+    finished_date = f"{now - timedelta(days=1):%Y-%m-%d}"
 
-    for name, feed_config in global_feeds.items():
+    for name, feed_config in list(global_feeds.items()):
         if feed_config['timezone'] != timezone:
             continue
 
-        feed_date_url_type_save_folder = os.path.join(global_save_folder, name, feed_date, 'schedule')
-        create_folder(feed_date_url_type_save_folder)
-        download_file(
-            feed_config['urls']['schedule_url'],
-            os.path.join(feed_date_url_type_save_folder, 'gtfs.zip')
-        )
+        for url_type in RT_URLS:
+            folder = os.path.join(global_save_folder, name, finished_date, url_type)
+            if os.path.exists(folder):
+                compact_folder(folder)
+
+    logger.info('Finished compacting finished days')
+
+
+def run_poll_loop(end_time=None):
+    # realtime urls are polled on the fetch pool whenever their adaptive schedule says an update
+    # is expected, the other jobs run on the scheduler. Runs forever without an end time.
+    while end_time is None or time.time() < end_time:
+        with global_schedule_lock:
+            schedule.run_pending()
+        global_poll_finished.clear()
+        seconds_until_next_poll = poll_due_rt_urls()
+        global_poll_finished.wait(min(seconds_until_next_poll, MAX_SLEEP_SECONDS))
 
-    logger.info('Finished downloading schedule files')
+
+def run_in_thread(job_func, **kwargs):
+    threading.Thread(target=job_func, kwargs=kwargs, daemon=True).start()
 
 
 def main():
-    # first load and process config to save initial schedule files and also schedule future
-    # schedule feed downloads
-    download_and_process_config()
-
-    # schedule rt file downloads for every 20 seconds
-    schedule.every().minute.at(':00').do(download_rt_files)
-    schedule.every().minute.at(':20').do(download_rt_files)
-    schedule.every().minute.at(':40').do(download_rt_files)
-
-    # update config every minute
-    schedule.every().minute.at(':45').do(download_and_process_config)
-    
-    while True:
-        schedule.run_pending()
-        time.sleep(1)
+    global global_config_path, global_config_mtime
+
+    # check the usage and config before starting anything
+    config = load_config('downloader.py')
+    global_config_path = sys.argv[1]
+    global_config_mtime = os.stat(global_config_path).st_mtime_ns
+    apply_config(config)
+
+    # load the config's feeds, saving their initial schedule files and scheduling future schedule
+    # feed downloads, then check for config changes every minute. Polling starts with each feed
+    # as soon as it has been added.
+    run_in_thread(download_and_process_config)
+    schedule.every().minute.at(':45').do(run_in_thread, download_and_process_config)
+
+    # export metrics every minute, if configured
+    schedule.every().minute.at(':50').do(lambda: write_metrics(global_config))
+
+    run_poll_loop()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,27 @@
+import logging
+import time
+
+from metrics import write_metrics
+from tides_engine import follow_day
+from utils import load_config
+
+logging.basicConfig(
+    format='%(levelname)s %(asctime)s %(filename)s:%(lineno)d| %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+
+def main():
+    script_start_time = time.time()
+    config = load_config('follow_day.py')
+    follow_day(config)
+    write_metrics(config)
+
+    script_end_time = time.time()
+    script_elapsed_time = script_end_time - script_start_time
+    logger.info(f"Following data for {config['date']} took {script_elapsed_time:.4f} seconds")
+
+
+if __name__ == '__main__':
+    main()
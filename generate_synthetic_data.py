@@ -0,0 +1,283 @@
+import csv
+import hashlib
+import io
+import logging
+import os
+import random
+import zipfile
+
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+
+from google.transit import gtfs_realtime_pb2
+
+from rt_storage import MANIFEST_FILENAME, MANIFEST_HEADER
+from utils import load_config, create_folder
+
+logging.basicConfig(
+    format='%(levelname)s %(asctime)s %(filename)s:%(lineno)d| %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+# constants
+DEFAULT_SEED = 1
+DEFAULT_TIMEZONE = 'America/Los_Angeles'
+DEFAULT_NUM_VEHICLES = 50
+DEFAULT_NUM_TRIPS = 400
+DEFAULT_NUM_ROUTES = 10
+DEFAULT_STOPS_PER_TRIP = 30
+DEFAULT_SECONDS_BETWEEN_STOPS = 120
+DEFAULT_POLL_INTERVAL_SECONDS = 20
+DEFAULT_VEHICLE_REPORT_INTERVAL_SECONDS = 30
+SERVICE_START_SECONDS = 5 * 60 * 60
+SERVICE_END_SECONDS = 24 * 60 * 60
+# snapshots are generated from an hour before the first trip to an hour after the last one
+SNAPSHOT_PADDING_SECONDS = 60 * 60
+# fixed zip entry times keep the generated zip byte-for-byte deterministic
+ZIP_DATE_TIME = (2020, 1, 1, 0, 0, 0)
+
+
+def seconds_to_gtfs_time(seconds):
+    return f"{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+
+
+def generate_schedule(rng, num_trips, num_routes, stops_per_trip, seconds_between_stops):
+    """
+    Return (stops, trips) of a synthetic schedule. Each route runs back and forth along its own
+    line of stops, and trips are spread evenly over the service day. Trips are (trip_id,
+    route_id, block_id, start_seconds, [stop_id, ...]) tuples.
+    """
+    stops = {}
+    route_stop_ids = {}
+    for route_index in range(num_routes):
+        route_id = f"R{route_index}"
+        route_stop_ids[route_id] = []
+        origin_lat = 37.6 + rng.random() * 0.2
+        origin_lon = -122.5 + rng.random() * 0.2
+        for stop_index in range(stops_per_trip):
+            stop_id = f"{route_id}S{stop_index}"
+            stops[stop_id] = (origin_lat + stop_index * 0.004, origin_lon + stop_index * 0.003)
+            route_stop_ids[route_id].append(stop_id)
+
+    trips = []
+    trip_duration = (stops_per_trip - 1) * seconds_between_stops
+    service_seconds = SERVICE_END_SECONDS - SERVICE_START_SECONDS - trip_duration
+    for trip_index in range(num_trips):
+        route_id = f"R{trip_index % num_routes}"
+        stop_ids = route_stop_ids[route_id]
+        if trip_index // num_routes % 2 == 1:
+            stop_ids = stop_ids[::-1]
+        start_seconds = SERVICE_START_SECONDS + service_seconds * trip_index // max(num_trips - 1, 1)
+        trips.append((f"T{trip_index}", route_id, f"B{trip_index % 37}", start_seconds, stop_ids))
+    return stops, trips
+
+
+def write_gtfs_zip(zip_path, timezone, date_obj, stops, trips, seconds_between_stops):
+    files = {
+        'agency.txt': [
+            ['agency_id', 'agency_name', 'agency_url', 'agency_timezone'],
+            ['SYN', 'Synthetic Transit', 'https://example.com', timezone]
+        ],
+        'calendar.txt': [
+            [
+                'service_id', 'monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday',
+                'start_date', 'end_date'
+            ],
+            [
+                'ALL', 1, 1, 1, 1, 1, 1, 1,
+                (date_obj - timedelta(days=365)).strftime('%Y%m%d'), (date_obj + timedelta(days=365)).strftime('%Y%m%d')
+            ]
+        ],
+        'routes.txt': [['route_id', 'agency_id', 'route_short_name', 'route_type']] + [
+            [route_id, 'SYN', route_id, 3] for route_id in sorted({trip[1] for trip in trips})
+        ],
+        'stops.txt': [['stop_id', 'stop_name', 'stop_lat', 'stop_lon']] + [
+            [stop_id, stop_id, f"{lat:.6f}", f"{lon:.6f}"] for stop_id, (lat, lon) in stops.items()
+        ],
+        'trips.txt': [['route_id', 'service_id', 'trip_id', 'shape_id', 'block_id']] + [
+            [route_id, 'ALL', trip_id, f"SH{route_id}", block_id] for trip_id, route_id, block_id, _, _ in trips
+        ],
+        'stop_times.txt': [['trip_id', 'arrival_time', 'departure_time', 'stop_id', 'stop_sequence']] + [
+            [
+                trip_id,
+                seconds_to_gtfs_time(start_seconds + index * seconds_between_stops),
+                seconds_to_gtfs_time(start_seconds + index * seconds_between_stops),
+                stop_id,
+                index + 1
+            ]
+            for trip_id, _, _, start_seconds, stop_ids in trips
+            for index, stop_id in enumerate(stop_ids)
+        ]
+    }
+
+    create_folder(os.path.dirname(zip_path))
+    with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as z:
+        for filename, rows in files.items():
+            text = io.StringIO()
+            csv.writer(text, lineterminator='\n').writerows(rows)
+            z.writestr(zipfile.ZipInfo(filename, date_time=ZIP_DATE_TIME), text.getvalue())
+
+
+def build_snapshots(timestamp, day_start_timestamp, stops, trips, trip_delays, num_vehicles,
+                    seconds_between_stops, vehicle_report_interval_seconds):
+    vehicle_positions = gtfs_realtime_pb2.FeedMessage()
+    vehicle_positions.header.gtfs_realtime_version = '2.0'
+    trip_updates = gtfs_realtime_pb2.FeedMessage()
+    trip_updates.header.gtfs_realtime_version = '2.0'
+    # producers publish a little after the data was gathered
+    vehicle_positions.header.timestamp = trip_updates.header.timestamp = timestamp - 3
+
+    vehicles_on_trips = set()
+    for trip_index, (trip_id, route_id, block_id, start_seconds, stop_ids) in enumerate(trips):
+        vehicle_id = f"V{trip_index % num_vehicles}"
+        delay = trip_delays[trip_id]
+        trip_start_timestamp = day_start_timestamp + start_seconds + delay
+        trip_end_timestamp = trip_start_timestamp + (len(stop_ids) - 1) * seconds_between_stops
+        if vehicle_id in vehicles_on_trips or \
+                not trip_start_timestamp - seconds_between_stops <= timestamp <= trip_end_timestamp:
+            continue
+        vehicles_on_trips.add(vehicle_id)
+
+        # vehicles report less often than the feed is polled, so pings repeat across snapshots
+        report_timestamp = timestamp - timestamp % vehicle_report_interval_seconds
+        progress = max(0, report_timestamp - trip_start_timestamp) / seconds_between_stops
+        stop_index = min(int(progress), len(stop_ids) - 1)
+        next_stop_index = min(stop_index + 1, len(stop_ids) - 1)
+        fraction = progress - int(progress) if stop_index != next_stop_index else 0
+        lat = stops[stop_ids[stop_index]][0] * (1 - fraction) + stops[stop_ids[next_stop_index]][0] * fraction
+        lon = stops[stop_ids[stop_index]][1] * (1 - fraction) + stops[stop_ids[next_stop_index]][1] * fraction
+
+        entity = vehicle_positions.entity.add()
+        entity.id = vehicle_id
+        vehicle = entity.vehicle
+        vehicle.vehicle.id = vehicle_id
+        vehicle.trip.trip_id = trip_id
+        vehicle.trip.route_id = route_id
+        vehicle.timestamp = report_timestamp
+        vehicle.position.latitude = lat
+        vehicle.position.longitude = lon
+        vehicle.position.bearing = 45
+        vehicle.position.speed = 0 if fraction == 0 else 8.5
+        vehicle.current_stop_sequence = next_stop_index + 1
+        vehicle.stop_id = stop_ids[next_stop_index]
+        vehicle.current_status = (
+            gtfs_realtime_pb2.VehiclePosition.STOPPED_AT if fraction == 0 else
+            gtfs_realtime_pb2.VehiclePosition.IN_TRANSIT_TO
+        )
+
+        entity = trip_updates.entity.add()
+        entity.id = trip_id
+        trip_update = entity.trip_update
+        trip_update.trip.trip_id = trip_id
+        trip_update.trip.route_id = route_id
+        trip_update.vehicle.id = vehicle_id
+        trip_update.timestamp = report_timestamp
+        for index in range(next_stop_index if fraction > 0 else stop_index, len(stop_ids)):
+            stop_time_update = trip_update.stop_time_update.add()
+            stop_time_update.stop_sequence = index + 1
+            stop_time_update.stop_id = stop_ids[index]
+            stop_time_update.arrival.time = trip_start_timestamp + index * seconds_between_stops
+            stop_time_update.departure.time = trip_start_timestamp + index * seconds_between_stops
+
+    # vehicles that aren't on a trip still report their position
+    for vehicle_index in range(num_vehicles):
+        vehicle_id = f"V{vehicle_index}"
+        if vehicle_id in vehicles_on_trips:
+            continue
+        entity = vehicle_positions.entity.add()
+        entity.id = vehicle_id
+        entity.vehicle.vehicle.id = vehicle_id
+        entity.vehicle.timestamp = timestamp - timestamp % (vehicle_report_interval_seconds * 4)
+        entity.vehicle.position.latitude = 37.5 + vehicle_index * 0.001
+        entity.vehicle.position.longitude = -122.6
+
+    return vehicle_positions, trip_updates
+
+
+def main():
+    config = load_config('generate_synthetic_data.py')
+    rng = random.Random(config.get('seed', DEFAULT_SEED))
+    timezone = config.get('timezone', DEFAULT_TIMEZONE)
+    tz = ZoneInfo(timezone)
+    date_str = config['date']
+    date_obj = datetime.strptime(date_str, '%Y-%m-%d')
+    feed_folder = os.path.join(config['raw_data_path'], config.get('feed_name', 'Synthetic_Feed'))
+    num_vehicles = config.get('num_vehicles', DEFAULT_NUM_VEHICLES)
+    seconds_between_stops = config.get('seconds_between_stops', DEFAULT_SECONDS_BETWEEN_STOPS)
+    poll_interval_seconds = config.get('poll_interval_seconds', DEFAULT_POLL_INTERVAL_SECONDS)
+    vehicle_report_interval_seconds = config.get(
+        'vehicle_report_interval_seconds',
+        DEFAULT_VEHICLE_REPORT_INTERVAL_SECONDS
+    )
+
+    stops, trips = generate_schedule(
+        rng,
+        config.get('num_trips', DEFAULT_NUM_TRIPS),
+        config.get('num_routes', DEFAULT_NUM_ROUTES),
+        config.get('stops_per_trip', DEFAULT_STOPS_PER_TRIP),
+        seconds_between_stops
+    )
+    trip_delays = {trip[0]: rng.randint(-60, 600) for trip in trips}
+    write_gtfs_zip(
+        os.path.join(feed_folder, date_str, 'schedule', 'gtfs.zip'),
+        timezone,
+        date_obj,
+        stops,
+        trips,
+        seconds_between_stops
+    )
+    logger.info(f"Wrote a schedule of {len(trips)} trips and {len(stops)} stops")
+
+    day_start_timestamp = int(date_obj.replace(tzinfo=tz).timestamp())
+    first_timestamp = day_start_timestamp + min(trip[3] for trip in trips) - SNAPSHOT_PADDING_SECONDS
+    trip_duration = (config.get('stops_per_trip', DEFAULT_STOPS_PER_TRIP) - 1) * seconds_between_stops
+    last_timestamp = day_start_timestamp + max(trip[3] for trip in trips) + trip_duration + 600 + \
+        SNAPSHOT_PADDING_SECONDS
+
+    # snapshots are saved like the downloader saves them, in the folder of their local fetch date
+    # with a manifest per folder
+    manifest_files = {}
+    num_snapshots = 0
+    for timestamp in range(first_timestamp, last_timestamp, poll_interval_seconds):
+        local_datetime = datetime.fromtimestamp(timestamp, tz)
+        filename = f"{timestamp}-{local_datetime:%Y-%m-%d-%H-%M-%S}.pb"
+        messages = build_snapshots(
+            timestamp,
+            day_start_timestamp,
+            stops,
+            trips,
+            trip_delays,
+            num_vehicles,
+            seconds_between_stops,
+            vehicle_report_interval_seconds
+        )
+        for url_type, message in zip(['vehicle_positions_url', 'trip_updates_url'], messages):
+            folder = os.path.join(feed_folder, f"{local_datetime:%Y-%m-%d}", url_type)
+            if folder not in manifest_files:
+                create_folder(folder)
+                manifest_file = open(os.path.join(folder, MANIFEST_FILENAME), mode='w', newline='')
+                manifest_writer = csv.DictWriter(manifest_file, fieldnames=MANIFEST_HEADER)
+                manifest_writer.writeheader()
+                manifest_files[folder] = (manifest_file, manifest_writer)
+
+            content = message.SerializeToString()
+            with open(os.path.join(folder, filename), 'wb') as f:
+                f.write(content)
+            manifest_files[folder][1].writerow({
+                'filename': filename,
+                'fetch_time': timestamp,
+                'header_timestamp': message.header.timestamp,
+                'size': len(content),
+                'content_hash': hashlib.sha256(content).hexdigest(),
+                'entity_count': len(message.entity)
+            })
+        num_snapshots += 1
+
+    for manifest_file, manifest_writer in manifest_files.values():
+        manifest_file.close()
+    logger.info(f"Wrote {num_snapshots} snapshots of each feed type to {feed_folder}")
+
+
+if __name__ == '__main__':
+    main()
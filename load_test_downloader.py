@@ -0,0 +1,459 @@
+### Measures how many feeds one downloader process can poll on time, against a local HTTP server
+# serving synthetic realtime feeds
+
+import glob
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import tempfile
+import threading
+import time
+
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy
+
+from google.transit import gtfs_realtime_pb2
+
+import downloader
+import metrics
+
+from benchmark import get_git_commit
+from generate_synthetic_data import DEFAULT_TIMEZONE, generate_schedule, write_gtfs_zip
+from rt_storage import read_manifest
+from utils import load_config
+
+logging.basicConfig(
+    format='%(levelname)s %(asctime)s %(filename)s:%(lineno)d| %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+# constants
+DEFAULT_SEED = 1
+DEFAULT_NUM_FEEDS = 200
+DEFAULT_URL_TYPES = ['trip_updates_url', 'vehicle_positions_url']
+DEFAULT_REFRESH_SECONDS = [10, 15, 20, 30]
+DEFAULT_PAYLOAD_BYTES = [20000, 200000]
+DEFAULT_LATENCY_MS = [20, 300]
+DEFAULT_ERROR_RATE = 0.01
+DEFAULT_NUM_SERVER_PROCESSES = 2
+DEFAULT_WARMUP_SECONDS = 60
+DEFAULT_DURATION_SECONDS = 300
+# the adaptive schedules need a few updates of every url before they poll on time
+MIN_WARMUP_UPDATES = 3
+SCHEDULE_NUM_TRIPS = 20
+SCHEDULE_NUM_ROUTES = 2
+SCHEDULE_STOPS_PER_TRIP = 10
+SCHEDULE_SECONDS_BETWEEN_STOPS = 120
+# building the payloads of big feeds takes a while
+SERVER_START_TIMEOUT_SECONDS = 120
+
+
+def build_feeds(config):
+    """
+    Return the synthetic feeds of the config by name. Each feed gets a refresh cadence from
+    `refresh_seconds`, a random phase within it and a payload size within `payload_bytes`, and
+    is served by one of `num_hosts` local servers.
+    """
+    rng = random.Random(config.get('seed', DEFAULT_SEED))
+    num_feeds = config.get('num_feeds', DEFAULT_NUM_FEEDS)
+    num_hosts = config.get('num_hosts', num_feeds)
+    min_payload_bytes, max_payload_bytes = config.get('payload_bytes', DEFAULT_PAYLOAD_BYTES)
+    min_latency_ms, max_latency_ms = config.get('latency_ms', DEFAULT_LATENCY_MS)
+    feeds = {}
+    for feed_index in range(num_feeds):
+        cadence_seconds = rng.choice(config.get('refresh_seconds', DEFAULT_REFRESH_SECONDS))
+        feeds[f"Load_Test_Feed_{feed_index}"] = {
+            'host_index': feed_index % num_hosts,
+            'cadence_seconds': cadence_seconds,
+            'phase_seconds': rng.randrange(cadence_seconds),
+            'payload_bytes': rng.randint(min_payload_bytes, max_payload_bytes),
+            'min_latency_seconds': min_latency_ms / 1000,
+            'max_latency_seconds': max_latency_ms / 1000,
+            'error_rate': config.get('error_rate', DEFAULT_ERROR_RATE)
+        }
+    return feeds
+
+
+def get_published_timestamp(feed, timestamp):
+    # header timestamp of the newest update published by a feed at a time. Updates are published
+    # every cadence seconds, offset by the feed's phase.
+    cadence_seconds = feed['cadence_seconds']
+    phase_seconds = feed['phase_seconds']
+    return int((timestamp - phase_seconds) // cadence_seconds * cadence_seconds + phase_seconds)
+
+
+def build_entities(url_type, payload_bytes, rng):
+    # returns a serialized FeedMessage of about payload_bytes of entities of the url type, without
+    # a header. A serialized header message put in front of it makes a complete FeedMessage.
+    message = gtfs_realtime_pb2.FeedMessage()
+    num_bytes = 0
+    while num_bytes < payload_bytes:
+        entity = message.entity.add()
+        entity.id = str(len(message.entity))
+        if url_type == 'vehicle_positions_url':
+            entity.vehicle.vehicle.id = entity.id
+            entity.vehicle.trip.trip_id = f"T{rng.randrange(SCHEDULE_NUM_TRIPS)}"
+            entity.vehicle.position.latitude = 37.6 + rng.random() * 0.2
+            entity.vehicle.position.longitude = -122.5 + rng.random() * 0.2
+            entity.vehicle.timestamp = 1700000000 + rng.randrange(3600)
+        elif url_type == 'trip_updates_url':
+            entity.trip_update.trip.trip_id = f"T{rng.randrange(SCHEDULE_NUM_TRIPS)}"
+            entity.trip_update.vehicle.id = entity.id
+            for stop_index in range(SCHEDULE_STOPS_PER_TRIP):
+                stop_time_update = entity.trip_update.stop_time_update.add()
+                stop_time_update.stop_sequence = stop_index + 1
+                stop_time_update.arrival.time = 1700000000 + rng.randrange(3600)
+        else:
+            entity.alert.header_text.translation.add().text = f"Load test alert {entity.id}"
+        # each entity also takes a tag and length byte or two
+        num_bytes += entity.ByteSize() + 3
+    return message.SerializePartialToString()
+
+
+class FeedRequestHandler(BaseHTTPRequestHandler):
+    """
+    Serves `/<feed name>/<url type>` like a realtime producer would: after a random latency,
+    fails with the feed's error rate, and otherwise returns the newest update with an ETag,
+    or 304 if the client already has it. `/<feed name>/schedule_url` returns the GTFS zip.
+    """
+    # keep-alive connections, like most producers
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        path_parts = self.path.strip('/').split('/')
+        feed = self.server.feeds.get(path_parts[0]) if len(path_parts) == 2 else None
+        if feed is None:
+            self.send_body(404, b'')
+            return
+
+        time.sleep(random.uniform(feed['min_latency_seconds'], feed['max_latency_seconds']))
+        url_type = path_parts[1]
+        if url_type == 'schedule_url':
+            self.send_body(200, self.server.schedule_zip, 'application/zip')
+            return
+        entities = self.server.entities.get((path_parts[0], url_type))
+        if entities is None:
+            self.send_body(404, b'')
+            return
+        if random.random() < feed['error_rate']:
+            self.send_body(500, b'')
+            return
+
+        header_timestamp = get_published_timestamp(feed, time.time())
+        etag = f'"{header_timestamp}"'
+        if self.headers.get('If-None-Match') == etag:
+            self.send_body(304, None, etag=etag)
+            return
+        message = gtfs_realtime_pb2.FeedMessage()
+        message.header.gtfs_realtime_version = '2.0'
+        message.header.timestamp = header_timestamp
+        self.send_body(200, message.SerializeToString() + entities, 'application/x-protobuf', etag)
+
+    def send_body(self, status, body, content_type=None, etag=None):
+        self.send_response(status)
+        if content_type is not None:
+            self.send_header('Content-Type', content_type)
+        if etag is not None:
+            self.send_header('ETag', etag)
+        if body is not None:
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if body:
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # every request would otherwise be logged
+        pass
+
+
+def serve_feeds(feeds, url_types, host_indexes, schedule_zip, seed, port_queue):
+    """
+    Start a server on a free local port for each host index and serve the feeds of those hosts
+    until the process is terminated. The (host index, port) of each server is put on the queue.
+    """
+    rng = random.Random(seed)
+    host_feeds = {host_index: {} for host_index in host_indexes}
+    for name, feed in feeds.items():
+        if feed['host_index'] in host_feeds:
+            host_feeds[feed['host_index']][name] = feed
+    # the entities of each url are built once, only the header changes with every update
+    entities = {
+        (name, url_type): build_entities(url_type, feed['payload_bytes'], rng)
+        for current_feeds in host_feeds.values()
+        for name, feed in current_feeds.items()
+        for url_type in url_types
+    }
+
+    for host_index in host_indexes:
+        server = ThreadingHTTPServer(('127.0.0.1', 0), FeedRequestHandler)
+        server.daemon_threads = True
+        server.feeds = host_feeds[host_index]
+        server.entities = entities
+        server.schedule_zip = schedule_zip
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        port_queue.put((host_index, server.server_address[1]))
+    threading.Event().wait()
+
+
+def start_servers(config, feeds, url_types, schedule_zip):
+    """
+    Serve the feeds from `num_server_processes` processes, so the server's CPU use doesn't count
+    towards the downloader's and one process doesn't limit the throughput. Returns the processes
+    and the port of each host index.
+    """
+    num_hosts = len({feed['host_index'] for feed in feeds.values()})
+    num_processes = min(config.get('num_server_processes', DEFAULT_NUM_SERVER_PROCESSES), num_hosts)
+    context = multiprocessing.get_context('spawn')
+    port_queue = context.Queue()
+    processes = []
+    for process_index in range(num_processes):
+        process = context.Process(
+            target=serve_feeds,
+            args=(
+                feeds,
+                url_types,
+                list(range(process_index, num_hosts, num_processes)),
+                schedule_zip,
+                config.get('seed', DEFAULT_SEED) + process_index,
+                port_queue
+            ),
+            daemon=True
+        )
+        process.start()
+        processes.append(process)
+    host_ports = dict(port_queue.get(timeout=SERVER_START_TIMEOUT_SECONDS) for _ in range(num_hosts))
+    return processes, host_ports
+
+
+def build_schedule_zip(config, work_folder):
+    rng = random.Random(config.get('seed', DEFAULT_SEED))
+    stops, trips = generate_schedule(
+        rng,
+        SCHEDULE_NUM_TRIPS,
+        SCHEDULE_NUM_ROUTES,
+        SCHEDULE_STOPS_PER_TRIP,
+        SCHEDULE_SECONDS_BETWEEN_STOPS
+    )
+    zip_path = os.path.join(work_folder, 'gtfs.zip')
+    write_gtfs_zip(
+        zip_path,
+        config.get('timezone', DEFAULT_TIMEZONE),
+        datetime.now().date(),
+        stops,
+        trips,
+        SCHEDULE_SECONDS_BETWEEN_STOPS
+    )
+    with open(zip_path, 'rb') as f:
+        return f.read()
+
+
+def get_feed_urls(feed, url_types, host_ports, feed_name):
+    base_url = f"http://127.0.0.1:{host_ports[feed['host_index']]}/{feed_name}"
+    urls = {'schedule_url': f"{base_url}/schedule_url"}
+    for url_type in url_types:
+        urls[url_type] = f"{base_url}/{url_type}"
+    return urls
+
+
+def read_saved_snapshots(save_folder, feed_name, url_type):
+    # returns the manifest rows of every snapshot saved for a url, of any date
+    rows = []
+    for folder in glob.glob(os.path.join(save_folder, feed_name, '*', url_type)):
+        rows.extend(read_manifest(folder) or [])
+    return rows
+
+
+def get_counter_total(summary, name, **labels):
+    return sum(
+        entry['value'] for entry in summary['counters'].get(name, [])
+        if all(entry['labels'].get(key) == value for key, value in labels.items())
+    )
+
+
+def summarize_lags(lags):
+    if len(lags) == 0:
+        return None
+    return {
+        'mean': float(numpy.mean(lags)),
+        'p50': float(numpy.percentile(lags, 50)),
+        'p95': float(numpy.percentile(lags, 95)),
+        'max': float(numpy.max(lags))
+    }
+
+
+def analyze_url_type(feeds, url_type, save_folder, summary, measure_start_time, measure_end_time):
+    """
+    Compare the updates published by every feed during the measured window with what the
+    downloader saved. A slot is an update whose whole lifetime falls in the window, and it's
+    dropped if it was never saved. Update lags are from the publish time to the fetch time of the
+    saved snapshot, to the second.
+    """
+    measured_seconds = measure_end_time - measure_start_time
+    num_slots = 0
+    num_captured_slots = 0
+    lags = []
+    poll_intervals = []
+    published_intervals = []
+    for feed_name, feed in feeds.items():
+        saved_fetch_times = {}
+        for row in read_saved_snapshots(save_folder, feed_name, url_type):
+            saved_fetch_times.setdefault(row['header_timestamp'], row['fetch_time'])
+
+        cadence_seconds = feed['cadence_seconds']
+        published_timestamp = get_published_timestamp(feed, measure_start_time - 1) + cadence_seconds
+        while published_timestamp + cadence_seconds <= measure_end_time:
+            num_slots += 1
+            if published_timestamp in saved_fetch_times:
+                num_captured_slots += 1
+                lags.append(saved_fetch_times[published_timestamp] - published_timestamp)
+            published_timestamp += cadence_seconds
+
+        num_polls = get_counter_total(summary, 'downloads', feed=feed_name, url_type=url_type)
+        if num_polls > 0:
+            poll_intervals.append(measured_seconds / num_polls)
+        published_intervals.append(cadence_seconds)
+
+    poll_delays = [
+        entry for entry in summary['timers'].get('poll_delay', []) if entry['labels'].get('url_type') == url_type
+    ]
+    num_polls = get_counter_total(summary, 'downloads', url_type=url_type)
+    return {
+        'urls': len(feeds),
+        'slots': num_slots,
+        'captured_slots': num_captured_slots,
+        'dropped_slots': num_slots - num_captured_slots,
+        'dropped_slot_fraction': (num_slots - num_captured_slots) / num_slots if num_slots > 0 else None,
+        'mean_published_interval_seconds': float(numpy.mean(published_intervals)) if published_intervals else None,
+        'mean_poll_interval_seconds': float(numpy.mean(poll_intervals)) if poll_intervals else None,
+        'polls_per_second': num_polls / measured_seconds,
+        'polls_by_result': {
+            result: get_counter_total(summary, 'downloads', url_type=url_type, result=result)
+            for result in ['changed', 'unmodified', 'unchanged', 'failed']
+        },
+        'update_lag_seconds': summarize_lags(lags),
+        'mean_poll_delay_seconds': (
+            sum(entry['total_seconds'] for entry in poll_delays) / sum(entry['count'] for entry in poll_delays)
+            if poll_delays else None
+        ),
+        'max_poll_delay_seconds': max((entry['max_seconds'] for entry in poll_delays), default=None),
+        'downloaded_bytes_per_second': get_counter_total(summary, 'downloaded_bytes', url_type=url_type)
+        / measured_seconds
+    }
+
+
+def run_load_test(config, work_folder):
+    url_types = config.get('url_types', DEFAULT_URL_TYPES)
+    feeds = build_feeds(config)
+    processes, host_ports = start_servers(config, feeds, url_types, build_schedule_zip(config, work_folder))
+    try:
+        # the downloader runs in this process like it would on its own, with its settings from the
+        # `downloader` section of the config
+        save_folder = os.path.join(work_folder, 'saved_data')
+        downloader_config = dict(config.get('downloader', {}))
+        downloader_config['save_folder'] = save_folder
+        downloader_config.setdefault('quiet', True)
+        downloader.apply_config(downloader_config)
+        for feed_name, feed in feeds.items():
+            downloader.add_feed(feed_name, get_feed_urls(feed, url_types, host_ports, feed_name))
+        logger.info(f"Serving {len(feeds)} feeds from {len(host_ports)} local hosts, starting to poll")
+
+        warmup_seconds = max(
+            config.get('warmup_seconds', DEFAULT_WARMUP_SECONDS),
+            MIN_WARMUP_UPDATES * max(feed['cadence_seconds'] for feed in feeds.values())
+        )
+        downloader.run_poll_loop(time.time() + warmup_seconds)
+
+        # only the metrics and CPU time of the measured window count
+        metrics.reset()
+        measure_start_time = time.time()
+        start_cpu_seconds = time.process_time()
+        downloader.run_poll_loop(measure_start_time + config.get('duration_seconds', DEFAULT_DURATION_SECONDS))
+        measure_end_time = time.time()
+        cpu_seconds = time.process_time() - start_cpu_seconds
+        summary = metrics.get_summary()
+
+        # let the polls already sent finish before their server goes away
+        downloader.get_executor().shutdown(wait=True, cancel_futures=True)
+    finally:
+        for process in processes:
+            process.terminate()
+            process.join()
+
+    measured_seconds = measure_end_time - measure_start_time
+    results = {
+        'measured_seconds': measured_seconds,
+        'warmup_seconds': warmup_seconds,
+        'feeds': len(feeds),
+        'hosts': len(host_ports),
+        'downloader_cpu_seconds': cpu_seconds,
+        # 100% is one core
+        'downloader_cpu_percent': cpu_seconds / measured_seconds * 100,
+        # ru_maxrss is in kilobytes on linux
+        'downloader_peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'server_cpu_seconds': resource.getrusage(resource.RUSAGE_CHILDREN).ru_utime +
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_stime,
+        'downloaded_bytes_per_second': get_counter_total(summary, 'downloaded_bytes') / measured_seconds,
+        'url_types': {
+            url_type: analyze_url_type(feeds, url_type, save_folder, summary, measure_start_time, measure_end_time)
+            for url_type in url_types
+        },
+        'metrics': summary
+    }
+    num_slots = sum(url_type_results['slots'] for url_type_results in results['url_types'].values())
+    num_dropped_slots = sum(url_type_results['dropped_slots'] for url_type_results in results['url_types'].values())
+    results['slots'] = num_slots
+    results['dropped_slots'] = num_dropped_slots
+    results['dropped_slot_fraction'] = num_dropped_slots / num_slots if num_slots > 0 else None
+    return results
+
+
+def main():
+    config = load_config('load_test_downloader.py')
+    results = {
+        'git_commit': get_git_commit(),
+        'created_at': datetime.now(timezone.utc).isoformat(),
+        'python_version': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'config': config
+    }
+
+    # the work folder is removed afterwards, so refuse to reuse one that holds anything else
+    work_folder = config.get('work_folder') or tempfile.mkdtemp(prefix='tides-load-test-')
+    if os.path.isdir(work_folder) and len(os.listdir(work_folder)) > 0:
+        raise ValueError(f"The work folder ({work_folder}) must be missing or empty")
+    os.makedirs(work_folder, exist_ok=True)
+    try:
+        results.update(run_load_test(config, work_folder))
+    finally:
+        shutil.rmtree(work_folder, ignore_errors=True)
+
+    for url_type, url_type_results in results['url_types'].items():
+        update_lags = url_type_results['update_lag_seconds'] or {}
+        logger.info(
+            f"{url_type}: {url_type_results['dropped_slots']} of {url_type_results['slots']} slots dropped, "
+            f"polled every {url_type_results['mean_poll_interval_seconds'] or 0:.1f}s for updates every "
+            f"{url_type_results['mean_published_interval_seconds'] or 0:.1f}s, update lag p95 "
+            f"{update_lags.get('p95', 0):.1f}s, max poll delay {url_type_results['max_poll_delay_seconds'] or 0:.2f}s"
+        )
+    logger.info(
+        f"{results['feeds']} feeds: {results['dropped_slots']} of {results['slots']} slots dropped, "
+        f"{results['downloaded_bytes_per_second'] / 1e6:.2f} MB/second downloaded, downloader CPU "
+        f"{results['downloader_cpu_percent']:.1f}% of a core, peak RSS {results['downloader_peak_rss_mb']:.1f} MB"
+    )
+
+    with open(config['results_path'], 'w') as f:
+        json.dump(results, f, indent=2)
+    logger.info(f"Saved load test results to {config['results_path']}")
+
+
+if __name__ == '__main__':
+    main()
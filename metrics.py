@@ -0,0 +1,163 @@
+### Process-wide timers and counters of the downloader and the parsers, exported as a JSON summary
+# and in the Prometheus text format
+
+import json
+import os
+import threading
+import time
+
+from contextlib import contextmanager
+
+from utils import create_folder
+
+# constants
+METRIC_NAME_PREFIX = 'gtfs_rt_to_tides_'
+
+# globals
+# (name, labels) keys to [count, total seconds, max seconds] of timed stages
+global_timers = {}
+# (name, labels) keys to counts
+global_counters = {}
+# the downloader records metrics from its fetch threads
+global_metrics_lock = threading.Lock()
+
+
+def get_metric_key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def observe(name, seconds, **labels):
+    key = get_metric_key(name, labels)
+    with global_metrics_lock:
+        timer = global_timers.get(key)
+        if timer is None:
+            global_timers[key] = [1, seconds, seconds]
+        else:
+            timer[0] += 1
+            timer[1] += seconds
+            timer[2] = max(timer[2], seconds)
+
+
+@contextmanager
+def timed(name, **labels):
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start_time, **labels)
+
+
+def increment(name, amount=1, **labels):
+    key = get_metric_key(name, labels)
+    with global_metrics_lock:
+        global_counters[key] = global_counters.get(key, 0) + amount
+
+
+def reset():
+    with global_metrics_lock:
+        global_timers.clear()
+        global_counters.clear()
+
+
+def build_summary(timers, counters):
+    summary = {'timers': {}, 'counters': {}}
+    for (name, labels), (count, total_seconds, max_seconds) in sorted(timers.items()):
+        summary['timers'].setdefault(name, []).append({
+            'labels': dict(labels),
+            'count': count,
+            'total_seconds': total_seconds,
+            'max_seconds': max_seconds
+        })
+    for (name, labels), value in sorted(counters.items()):
+        summary['counters'].setdefault(name, []).append({'labels': dict(labels), 'value': value})
+    return summary
+
+
+def get_summary():
+    """
+    Return the metrics recorded so far as a dict of timers, with the count, total and max
+    seconds of each, and counters. Each entry lists its values by label set.
+    """
+    with global_metrics_lock:
+        return build_summary(global_timers, global_counters)
+
+
+def merge_summaries(summary, other_summary):
+    """
+    Return the combined summary of the metrics of two summaries, e.g. of separate processes.
+    """
+    timers = {}
+    counters = {}
+    for current_summary in [summary, other_summary]:
+        for name, entries in current_summary['timers'].items():
+            for entry in entries:
+                key = get_metric_key(name, entry['labels'])
+                timer = timers.get(key)
+                if timer is None:
+                    timers[key] = [entry['count'], entry['total_seconds'], entry['max_seconds']]
+                else:
+                    timer[0] += entry['count']
+                    timer[1] += entry['total_seconds']
+                    timer[2] = max(timer[2], entry['max_seconds'])
+        for name, entries in current_summary['counters'].items():
+            for entry in entries:
+                key = get_metric_key(name, entry['labels'])
+                counters[key] = counters.get(key, 0) + entry['value']
+    return build_summary(timers, counters)
+
+
+def format_prometheus_labels(labels):
+    if len(labels) == 0:
+        return ''
+    escaped_labels = [
+        (key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in labels.items()
+    ]
+    return '{' + ','.join(f'{key}="{value}"' for key, value in escaped_labels) + '}'
+
+
+def format_prometheus(summary):
+    # timers are exported as summaries without quantiles plus a gauge of their max
+    lines = []
+    for name, entries in summary['timers'].items():
+        metric_name = f"{METRIC_NAME_PREFIX}{name}_seconds"
+        lines.append(f"# TYPE {metric_name} summary")
+        for entry in entries:
+            labels = format_prometheus_labels(entry['labels'])
+            lines.append(f"{metric_name}_count{labels} {entry['count']}")
+            lines.append(f"{metric_name}_sum{labels} {entry['total_seconds']}")
+        lines.append(f"# TYPE {metric_name}_max gauge")
+        for entry in entries:
+            lines.append(f"{metric_name}_max{format_prometheus_labels(entry['labels'])} {entry['max_seconds']}")
+    for name, entries in summary['counters'].items():
+        metric_name = f"{METRIC_NAME_PREFIX}{name}_total"
+        lines.append(f"# TYPE {metric_name} counter")
+        for entry in entries:
+            lines.append(f"{metric_name}{format_prometheus_labels(entry['labels'])} {entry['value']}")
+    return '\n'.join(lines) + '\n'
+
+
+def write_atomically(path, text):
+    # the node exporter textfile collector may read the file at any time
+    if os.path.dirname(path) != '':
+        create_folder(os.path.dirname(path))
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def write_metrics(config, summary=None):
+    """
+    Write the metrics recorded so far, or the given summary, to the `metrics_json_path` and
+    `metrics_prometheus_path` of a config, if set.
+    """
+    if not config.get('metrics_json_path') and not config.get('metrics_prometheus_path'):
+        return
+
+    if summary is None:
+        summary = get_summary()
+    if config.get('metrics_json_path'):
+        write_atomically(config['metrics_json_path'], json.dumps(summary, indent=2))
+    if config.get('metrics_prometheus_path'):
+        write_atomically(config['metrics_prometheus_path'], format_prometheus(summary))
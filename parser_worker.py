@@ -0,0 +1,163 @@
+### A long-lived parser that runs parse_day jobs from a queue folder, keeping its imports and the
+# schedules of recent jobs loaded between them
+
+import json
+import logging
+import os
+import time
+
+from datetime import datetime, timezone
+
+from metrics import reset, write_metrics
+from tides_engine import parse_day
+from utils import create_folder, load_config
+
+logging.basicConfig(
+    format='%(levelname)s %(asctime)s %(filename)s:%(lineno)d| %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+# constants
+PENDING_FOLDER_NAME = 'pending'
+RUNNING_FOLDER_NAME = 'running'
+DONE_FOLDER_NAME = 'done'
+FAILED_FOLDER_NAME = 'failed'
+JOB_FILE_EXTENSION = '.json'
+DEFAULT_POLL_INTERVAL_SECONDS = 2
+DEFAULT_MAX_LOADED_SCHEDULES = 8
+DEFAULT_MAX_LOADED_SCHEDULE_FEEDS = 2
+# keys of the worker config that aren't defaults for its jobs
+WORKER_CONFIG_KEYS = ['jobs_folder', 'poll_interval_seconds']
+
+
+def submit_job(jobs_folder, job, job_name=None):
+    """
+    Queue a job for the workers of a jobs folder and return its name. Jobs are run in name order,
+    and the default name starts with the time it was submitted.
+    """
+    if job_name is None:
+        job_name = f"{time.time_ns()}-{job.get('feed', 'job')}-{job['date']}"
+    create_folder(os.path.join(jobs_folder, PENDING_FOLDER_NAME))
+    # a worker may pick the job up as soon as it's in the pending folder, so it has to be complete
+    tmp_job_path = os.path.join(jobs_folder, f"{job_name}{JOB_FILE_EXTENSION}.tmp")
+    with open(tmp_job_path, 'w') as f:
+        json.dump(job, f)
+    os.replace(tmp_job_path, os.path.join(jobs_folder, PENDING_FOLDER_NAME, f"{job_name}{JOB_FILE_EXTENSION}"))
+    return job_name
+
+
+def is_process_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def requeue_abandoned_jobs(jobs_folder):
+    # jobs are claimed as running/<pid>-<job file>, put back the ones of workers that died mid-job.
+    # Their runs resume from the last checkpoint.
+    running_folder = os.path.join(jobs_folder, RUNNING_FOLDER_NAME)
+    for filename in sorted(os.listdir(running_folder)):
+        pid, _, job_filename = filename.partition('-')
+        if not pid.isdigit() or is_process_running(int(pid)):
+            continue
+        logger.warning(f"Requeueing job {job_filename} abandoned by worker {pid}")
+        os.replace(
+            os.path.join(running_folder, filename),
+            os.path.join(jobs_folder, PENDING_FOLDER_NAME, job_filename)
+        )
+
+
+def claim_next_job(jobs_folder):
+    """
+    Move the first pending job to the running folder and return its filename and running path,
+    or None if there are no pending jobs. Several workers can share a jobs folder, only the one
+    whose move succeeds runs the job.
+    """
+    pending_folder = os.path.join(jobs_folder, PENDING_FOLDER_NAME)
+    for job_filename in sorted(os.listdir(pending_folder)):
+        if not job_filename.endswith(JOB_FILE_EXTENSION):
+            continue
+        running_path = os.path.join(jobs_folder, RUNNING_FOLDER_NAME, f"{os.getpid()}-{job_filename}")
+        try:
+            os.rename(os.path.join(pending_folder, job_filename), running_path)
+        except FileNotFoundError:
+            # claimed by another worker
+            continue
+        return job_filename, running_path
+    return None
+
+
+def get_job_config(worker_config, job):
+    # jobs are parse_day configs on top of the worker config, and the raw data and output of a
+    # job with a feed are in that feed's folders, like in a backfill
+    job_config = {key: value for key, value in worker_config.items() if key not in WORKER_CONFIG_KEYS}
+    job_config.update(job)
+    feed_name = job_config.pop('feed', None)
+    if feed_name is not None:
+        job_config['raw_data_path'] = os.path.join(job_config['raw_data_path'], feed_name)
+        job_config['tides_output_folder'] = os.path.join(job_config['tides_output_folder'], feed_name)
+    return job_config
+
+
+def run_job(worker_config, jobs_folder, job_filename, running_path):
+    """
+    Run a claimed job and move it to the done or failed folder, along with its result.
+    """
+    job = {}
+    result = {'started_at': datetime.now(timezone.utc).isoformat(), 'worker_pid': os.getpid()}
+    job_start_time = time.time()
+    result_folder_name = DONE_FOLDER_NAME
+    # the metrics of each job are written on their own, like those of a parse_day.py run
+    reset()
+    try:
+        with open(running_path, 'r') as f:
+            job = json.load(f)
+        job_config = get_job_config(worker_config, job)
+        result['snapshots'] = parse_day(job_config)
+        write_metrics(job_config)
+    except Exception as e:
+        logger.exception(f"Failed to run job {job_filename}")
+        result['error'] = repr(e)
+        result_folder_name = FAILED_FOLDER_NAME
+    result['elapsed_seconds'] = time.time() - job_start_time
+    logger.info(f"Finished job {job_filename} in {result['elapsed_seconds']:.2f} seconds")
+
+    result_path = os.path.join(jobs_folder, result_folder_name, job_filename)
+    with open(f"{result_path}.tmp", 'w') as f:
+        json.dump(dict(job, result=result), f, indent=2)
+    os.replace(f"{result_path}.tmp", result_path)
+    os.remove(running_path)
+
+
+def main():
+    config = load_config('parser_worker.py')
+    jobs_folder = config['jobs_folder']
+    poll_interval_seconds = config.get('poll_interval_seconds', DEFAULT_POLL_INTERVAL_SECONDS)
+    for folder_name in [PENDING_FOLDER_NAME, RUNNING_FOLDER_NAME, DONE_FOLDER_NAME, FAILED_FOLDER_NAME]:
+        create_folder(os.path.join(jobs_folder, folder_name))
+
+    # keep the schedules of recent jobs loaded, unless the config says otherwise
+    worker_config = dict(config)
+    worker_config.setdefault('max_loaded_schedules', DEFAULT_MAX_LOADED_SCHEDULES)
+    worker_config.setdefault('max_loaded_schedule_feeds', DEFAULT_MAX_LOADED_SCHEDULE_FEEDS)
+    worker_config.setdefault('keep_schedule_feed_loaded', True)
+
+    requeue_abandoned_jobs(jobs_folder)
+    logger.info(f"Waiting for jobs in {os.path.join(jobs_folder, PENDING_FOLDER_NAME)}")
+    while True:
+        claimed_job = claim_next_job(jobs_folder)
+        if claimed_job is None:
+            time.sleep(poll_interval_seconds)
+            continue
+        job_filename, running_path = claimed_job
+        logger.info(f"Running job {job_filename}")
+        run_job(worker_config, jobs_folder, job_filename, running_path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+### Bounded-memory deduplication of vehicle position pings seen across snapshots
+
+import hashlib
+import struct
+
+# constants
+DEFAULT_PING_DEDUPE_WINDOW_SECONDS = 2 * 60 * 60
+PING_KEY_STRUCT = struct.Struct('<Qdddd')
+
+
+def generate_ping_key(timestamp, latitude, longitude, bearing, speed):
+    # fixed-width 64 bit key of everything that identifies a ping of one vehicle
+    packed = PING_KEY_STRUCT.pack(timestamp, latitude, longitude, bearing, speed)
+    return int.from_bytes(hashlib.blake2b(packed, digest_size=8).digest(), 'little')
+
+
+class PingDeduplicator:
+    """
+    Remembers the keys of the pings seen for each vehicle along with the latest feed timestamp
+    they were seen at, and evicts the keys that haven't been seen for `window_seconds`. Only
+    pings with a remembered key are treated as already seen. A vehicle that keeps repeating a
+    stale ping keeps its key from being evicted, whatever the ping's own timestamp is.
+    """
+    def __init__(self, window_seconds=DEFAULT_PING_DEDUPE_WINDOW_SECONDS):
+        self.window_seconds = window_seconds
+        self.pings_by_vehicle = {}
+        self.feed_timestamp = None
+        self.last_eviction_timestamp = None
+
+    def add(self, vehicle_id, timestamp, latitude, longitude, bearing, speed):
+        """
+        Record a ping and return True if it hasn't been seen before.
+        """
+        key = generate_ping_key(timestamp, latitude, longitude, bearing, speed)
+        vehicle_pings = self.pings_by_vehicle.get(vehicle_id)
+        if vehicle_pings is None:
+            vehicle_pings = self.pings_by_vehicle[vehicle_id] = {}
+        is_new = key not in vehicle_pings
+        vehicle_pings[key] = self.feed_timestamp
+        return is_new
+
+    def advance(self, feed_timestamp):
+        # sweeping every half window keeps at most 1.5 windows of pings in memory
+        self.feed_timestamp = feed_timestamp
+        if self.last_eviction_timestamp is None:
+            self.last_eviction_timestamp = feed_timestamp
+        elif feed_timestamp - self.last_eviction_timestamp >= self.window_seconds / 2:
+            self.evict(feed_timestamp - self.window_seconds)
+            self.last_eviction_timestamp = feed_timestamp
+
+    def evict(self, cutoff_timestamp):
+        for vehicle_id in list(self.pings_by_vehicle.keys()):
+            vehicle_pings = self.pings_by_vehicle[vehicle_id]
+            kept_pings = {
+                key: last_seen_timestamp for key, last_seen_timestamp in vehicle_pings.items()
+                if last_seen_timestamp >= cutoff_timestamp
+            }
+            if len(kept_pings) == 0:
+                del self.pings_by_vehicle[vehicle_id]
+            elif len(kept_pings) < len(vehicle_pings):
+                self.pings_by_vehicle[vehicle_id] = kept_pings
+
+    def __len__(self):
+        return sum(len(vehicle_pings) for vehicle_pings in self.pings_by_vehicle.values())
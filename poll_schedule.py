@@ -0,0 +1,130 @@
+### Adaptive polling of a realtime url, timed to when its producer is expected to publish next
+
+import time
+
+from collections import deque
+
+# constants
+DEFAULT_MIN_POLL_INTERVAL_SECONDS = 2
+DEFAULT_MAX_POLL_INTERVAL_SECONDS = 60
+DEFAULT_INITIAL_POLL_INTERVAL_SECONDS = 20
+# number of recent header timestamps and publish lags the estimates are made from
+NUM_SAMPLES = 8
+# polls are sent a little after an update is expected, to not arrive just before it
+POLL_MARGIN_SECONDS = 0.5
+# polls that find no update retry after this fraction of the update interval, doubling every time
+# up to this many times, by which point the retry is well past the max poll interval
+MISS_RETRY_FRACTION = 0.1
+MAX_MISS_DOUBLINGS = 10
+# probes for a shorter update interval are sent after a run of updates without a miss, which
+# starts at one update and doubles up to this many every time a probe finds nothing new
+MAX_PROBE_AFTER_NUM_UPDATES = 8
+
+
+class AdaptivePollSchedule:
+    """
+    Learns the update interval of a realtime url from the changes of its FeedHeader timestamp
+    and when updates show up after their header timestamp, and schedules the next poll just
+    after the next update is expected, within [min_interval_seconds, max_interval_seconds] of
+    the last poll.
+
+    Polls that only see updates every few polls can't tell a slower feed from an undersampled
+    faster one, so the interval is estimated from the shortest recent gap between header
+    timestamps and a run of polls that all found an update is followed by a probe at half the
+    interval. The runs get longer while probes find nothing new. Polls that find no update retry
+    sooner and back off while the feed stays unchanged.
+    """
+    def __init__(self, url, min_interval_seconds=DEFAULT_MIN_POLL_INTERVAL_SECONDS,
+                 max_interval_seconds=DEFAULT_MAX_POLL_INTERVAL_SECONDS,
+                 initial_interval_seconds=DEFAULT_INITIAL_POLL_INTERVAL_SECONDS):
+        self.url = url
+        self.min_interval_seconds = min_interval_seconds
+        self.max_interval_seconds = max_interval_seconds
+        self.initial_interval_seconds = initial_interval_seconds
+        self.header_timestamps = deque(maxlen=NUM_SAMPLES + 1)
+        self.publish_lags = deque(maxlen=NUM_SAMPLES)
+        self.num_misses = 0
+        self.num_updates_in_a_row = 0
+        self.probe_after_num_updates = 1
+        self.probing = False
+        self.expected_update_time = None
+        # poll right away
+        self.next_poll_time = time.time()
+        self.in_flight = False
+
+    def clamp_interval(self, interval_seconds):
+        return min(max(interval_seconds, self.min_interval_seconds), self.max_interval_seconds)
+
+    def get_update_interval(self):
+        header_timestamps = list(self.header_timestamps)
+        intervals = [
+            next_timestamp - timestamp for timestamp, next_timestamp in zip(header_timestamps, header_timestamps[1:])
+        ]
+        if len(intervals) == 0:
+            return self.clamp_interval(self.initial_interval_seconds)
+        return self.clamp_interval(min(intervals))
+
+    def schedule_next_poll(self, poll_time, next_poll_time):
+        self.next_poll_time = min(
+            max(next_poll_time, poll_time + self.min_interval_seconds),
+            poll_time + self.max_interval_seconds
+        )
+
+    def record_update(self, poll_time, header_timestamp):
+        """
+        Schedule the next poll after a poll at `poll_time` saved an update. The header timestamp
+        is None if the payload couldn't be parsed.
+        """
+        self.num_misses = 0
+        if self.probing:
+            self.probing = False
+            self.probe_after_num_updates = 1
+        update_interval = self.get_update_interval()
+        if header_timestamp is None:
+            self.schedule_next_poll(poll_time, poll_time + update_interval)
+            return
+
+        if len(self.header_timestamps) > 0 and header_timestamp < self.header_timestamps[-1]:
+            # the producer went back in time, e.g. after a restart with a different clock
+            self.header_timestamps.clear()
+            self.publish_lags.clear()
+        if len(self.header_timestamps) == 0 or header_timestamp > self.header_timestamps[-1]:
+            self.header_timestamps.append(header_timestamp)
+            update_interval = self.get_update_interval()
+        # the lag between the header timestamp and when the update was first seen includes part
+        # of the polling interval, so the smallest one is the closest to the publishing delay
+        self.publish_lags.append(poll_time - header_timestamp)
+
+        self.expected_update_time = header_timestamp + min(self.publish_lags) + update_interval
+        self.num_updates_in_a_row += 1
+        if self.num_updates_in_a_row >= self.probe_after_num_updates:
+            self.num_updates_in_a_row = 0
+            self.probing = True
+            self.schedule_next_poll(
+                poll_time,
+                header_timestamp + min(self.publish_lags) + update_interval / 2 + POLL_MARGIN_SECONDS
+            )
+        else:
+            self.schedule_next_poll(poll_time, self.expected_update_time + POLL_MARGIN_SECONDS)
+
+    def record_miss(self, poll_time):
+        """
+        Schedule the next poll after a poll at `poll_time` found no update or failed.
+        """
+        self.num_updates_in_a_row = 0
+        if self.probing:
+            self.probing = False
+            self.probe_after_num_updates = min(self.probe_after_num_updates * 2, MAX_PROBE_AFTER_NUM_UPDATES)
+        next_poll_time = poll_time + self.get_update_interval() * MISS_RETRY_FRACTION * 2 ** self.num_misses
+        self.num_misses = min(self.num_misses + 1, MAX_MISS_DOUBLINGS)
+        if self.expected_update_time is not None and self.expected_update_time > poll_time:
+            # a probe for a shorter interval missed, go back to polling when the update is expected
+            next_poll_time = min(next_poll_time, self.expected_update_time + POLL_MARGIN_SECONDS)
+        self.schedule_next_poll(poll_time, next_poll_time)
+
+    def record_failure(self, poll_time):
+        """
+        Schedule a retry at the max interval after a poll at `poll_time` failed in a way the
+        schedule can't learn from. Doesn't touch the estimates, so it can't fail itself.
+        """
+        self.next_poll_time = poll_time + self.max_interval_seconds
@@ -0,0 +1,159 @@
+### Optional zstd compression of raw GTFS-RT snapshots, with a dictionary trained for each feed and
+# url type. Readers detect compressed payloads by their magic number.
+
+import logging
+import os
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from utils import create_folder
+
+logger = logging.getLogger(__name__)
+
+# constants
+COMPRESSION_ZSTD = 'zstd'
+COMPRESSIONS = [COMPRESSION_ZSTD]
+COMPRESSED_FILE_EXTENSION = '.zst'
+# a GTFS-RT FeedMessage has no field 5, so its payloads can't start like a zstd frame
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+DICTIONARY_FOLDER_NAME = 'dictionaries'
+DICTIONARY_FILE_EXTENSION = '.zdict'
+DEFAULT_COMPRESSION_LEVEL = 3
+DEFAULT_DICTIONARY_SIZE = 112 * 1024
+DEFAULT_DICTIONARY_TRAINING_SAMPLES = 200
+# zstd recommends training on about 100 times the dictionary size
+TRAINING_BYTES_PER_DICTIONARY_BYTE = 100
+
+# globals
+# decompressors of the dictionaries loaded by this process, by dictionary id. Dictionary id 0 is
+# for frames compressed without a dictionary.
+global_decompressors = {}
+
+
+def require_zstandard():
+    if zstandard is None:
+        raise ImportError('zstandard is required to read and write compressed snapshots, install it with pip')
+
+
+def get_dictionary_folder(snapshot_folder):
+    # snapshots are saved to <save_folder>/<feed>/<date>/<url type>, the feed's dictionaries to
+    # <save_folder>/<feed>/dictionaries
+    return os.path.join(
+        os.path.dirname(os.path.dirname(os.path.normpath(snapshot_folder))),
+        DICTIONARY_FOLDER_NAME
+    )
+
+
+def is_compressed(payload):
+    return bytes(payload[:len(ZSTD_MAGIC)]) == ZSTD_MAGIC
+
+
+def load_dictionaries(dictionary_folder):
+    if not os.path.exists(dictionary_folder):
+        return
+    for filename in os.listdir(dictionary_folder):
+        if not filename.endswith(DICTIONARY_FILE_EXTENSION):
+            continue
+        with open(os.path.join(dictionary_folder, filename), 'rb') as f:
+            dictionary = zstandard.ZstdCompressionDict(f.read())
+        if dictionary.dict_id() not in global_decompressors:
+            global_decompressors[dictionary.dict_id()] = zstandard.ZstdDecompressor(dict_data=dictionary)
+
+
+def decompress_snapshot(payload, snapshot_folder):
+    """
+    Return the protobuf payload of a snapshot read from the given folder, decompressing it with
+    the dictionary it was compressed with if needed. Uncompressed payloads are returned as is.
+    """
+    if not is_compressed(payload):
+        return payload
+
+    require_zstandard()
+    dict_id = zstandard.get_frame_parameters(payload).dict_id
+    decompressor = global_decompressors.get(dict_id)
+    if decompressor is None:
+        if dict_id == 0:
+            decompressor = global_decompressors[0] = zstandard.ZstdDecompressor()
+        else:
+            # dictionaries are trained while the downloader runs, so look again for new ones
+            dictionary_folder = get_dictionary_folder(snapshot_folder)
+            load_dictionaries(dictionary_folder)
+            decompressor = global_decompressors.get(dict_id)
+            if decompressor is None:
+                raise ValueError(f"zstd dictionary {dict_id} not found in {dictionary_folder}")
+    return decompressor.decompress(payload)
+
+
+class SnapshotCompressor:
+    """
+    Compresses the snapshots of one feed and url type with the newest dictionary saved for them.
+    Without one, snapshots are compressed without a dictionary and kept as training samples
+    until `num_training_samples` of them, or 100 times the dictionary size, are collected. A
+    dictionary is then trained from them and saved to the feed's dictionary folder, and used
+    from then on.
+    """
+    def __init__(self, dictionary_folder, url_type, level=DEFAULT_COMPRESSION_LEVEL,
+                 dictionary_size=DEFAULT_DICTIONARY_SIZE, num_training_samples=DEFAULT_DICTIONARY_TRAINING_SAMPLES):
+        require_zstandard()
+        self.dictionary_folder = dictionary_folder
+        self.url_type = url_type
+        self.level = level
+        self.dictionary_size = dictionary_size
+        self.num_training_samples = num_training_samples
+        self.samples = []
+        self.num_sample_bytes = 0
+
+        dictionary = self.load_newest_dictionary()
+        self.has_dictionary = dictionary is not None
+        self.compressor = zstandard.ZstdCompressor(level=level, dict_data=dictionary)
+
+    def load_newest_dictionary(self):
+        if not os.path.exists(self.dictionary_folder):
+            return None
+        dictionary_paths = [
+            os.path.join(self.dictionary_folder, filename)
+            for filename in os.listdir(self.dictionary_folder)
+            if filename.startswith(f"{self.url_type}-") and filename.endswith(DICTIONARY_FILE_EXTENSION)
+        ]
+        if len(dictionary_paths) == 0:
+            return None
+        with open(max(dictionary_paths, key=os.path.getmtime), 'rb') as f:
+            return zstandard.ZstdCompressionDict(f.read())
+
+    def compress(self, payload):
+        if not self.has_dictionary:
+            self.samples.append(bytes(payload))
+            self.num_sample_bytes += len(payload)
+            if len(self.samples) >= self.num_training_samples or \
+                    self.num_sample_bytes >= self.dictionary_size * TRAINING_BYTES_PER_DICTIONARY_BYTE:
+                self.train()
+        return self.compressor.compress(payload)
+
+    def train(self):
+        samples = self.samples
+        self.samples = []
+        self.num_sample_bytes = 0
+        try:
+            dictionary = zstandard.train_dictionary(self.dictionary_size, samples, level=self.level)
+        except zstandard.ZstdError as e:
+            # e.g. too few or too similar samples, try again with the next ones
+            logger.warning(f"Unable to train a zstd dictionary for {self.url_type} in {self.dictionary_folder}: {e}")
+            return
+
+        create_folder(self.dictionary_folder)
+        dictionary_path = os.path.join(
+            self.dictionary_folder,
+            f"{self.url_type}-{dictionary.dict_id()}{DICTIONARY_FILE_EXTENSION}"
+        )
+        # readers look dictionaries up by id, so the file has to be complete before it's used
+        tmp_dictionary_path = f"{dictionary_path}.tmp"
+        with open(tmp_dictionary_path, 'wb') as f:
+            f.write(dictionary.as_bytes())
+        os.replace(tmp_dictionary_path, dictionary_path)
+        logger.info(f"Trained zstd dictionary {dictionary_path} from {len(samples)} snapshots")
+
+        self.has_dictionary = True
+        self.compressor = zstandard.ZstdCompressor(level=self.level, dict_data=dictionary)
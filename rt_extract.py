@@ -0,0 +1,244 @@
+### Extraction of the GTFS-RT fields used by the parsers into compact records, with an optional
+# pool of worker processes that decode snapshots in parallel
+
+import multiprocessing
+import zlib
+
+from collections import namedtuple
+from functools import partial
+
+from google.transit import gtfs_realtime_pb2
+
+from rt_storage import SnapshotReader
+from rt_wire import read_header_timestamp
+
+# constants
+DEFAULT_NUM_WORKERS = 1
+DECODE_MODE_FAST = 'fast'
+DECODE_MODE_FULL = 'full'
+MAX_CHUNK_SIZE = 16
+
+VehiclePing = namedtuple('VehiclePing', [
+    'vehicle_id',
+    'timestamp',
+    'latitude',
+    'longitude',
+    'bearing',
+    'speed',
+    'trip_id',
+    'trip_start_date',
+    'trip_schedule_relationship',
+    'current_stop_sequence',
+    'stop_id',
+    'current_status'
+])
+
+# stop_time_updates is a list of (stop_sequence, stop_id, arrival_time, departure_time,
+# schedule_relationship) tuples, with 0 for unset times. The fast decode mode only keeps the
+# updates that can set the first and last stop of the trip, the payload is parsed in full either way.
+TripUpdateRecord = namedtuple('TripUpdateRecord', [
+    'trip_id',
+    'route_id',
+    'vehicle_id',
+    'schedule_relationship',
+    'stop_time_updates'
+])
+
+# globals
+worker_snapshot_reader = None
+
+
+def extract_vehicle_positions(payload):
+    message = gtfs_realtime_pb2.FeedMessage()
+    message.ParseFromString(payload)
+
+    vehicle_pings = []
+    for vehicle_entity in message.entity:
+        vehicle = vehicle_entity.vehicle
+        position = vehicle.position
+        trip = vehicle.trip
+        vehicle_pings.append(VehiclePing(
+            vehicle.vehicle.id,
+            vehicle.timestamp,
+            position.latitude,
+            position.longitude,
+            position.bearing,
+            position.speed,
+            trip.trip_id,
+            trip.start_date,
+            trip.schedule_relationship,
+            vehicle.current_stop_sequence,
+            vehicle.stop_id,
+            vehicle.current_status
+        ))
+    return message.header.timestamp, vehicle_pings
+
+
+def extract_trip_updates(payload, decode_mode=DECODE_MODE_FAST):
+    """
+    Return the header timestamp and a TripUpdateRecord for each entity of the snapshot. Both
+    decode modes parse the whole payload with the protobuf C backend. The fast mode saves the
+    Python-level reading of every stop time update by only converting the first and last ones,
+    unless they aren't sorted by stop_sequence.
+    """
+    message = gtfs_realtime_pb2.FeedMessage()
+    message.ParseFromString(payload)
+
+    trip_updates = [
+        get_trip_update_record(trip_update_entity.trip_update, decode_mode) for trip_update_entity in message.entity
+    ]
+    return message.header.timestamp, trip_updates
+
+
+def get_trip_shard(trip_id, num_shards):
+    # stable across processes and runs, unlike hash()
+    return zlib.crc32(trip_id.encode('utf-8')) % num_shards
+
+
+def extract_trip_update_shards(payload, decode_mode, num_shards):
+    """
+    Return the header timestamp and, for each of `num_shards` shards of the trips by trip id, a
+    (records, entity indexes) tuple of the trip updates of its trips and the index of each of
+    them among all the entities of the snapshot.
+    """
+    message = gtfs_realtime_pb2.FeedMessage()
+    message.ParseFromString(payload)
+
+    shards = [([], []) for _ in range(num_shards)]
+    for entity_index, trip_update_entity in enumerate(message.entity):
+        trip_update = trip_update_entity.trip_update
+        trip_updates, entity_indexes = shards[get_trip_shard(trip_update.trip.trip_id, num_shards)]
+        trip_updates.append(get_trip_update_record(trip_update, decode_mode))
+        entity_indexes.append(entity_index)
+    return message.header.timestamp, shards
+
+
+def get_trip_update_record(trip_update, decode_mode):
+    if decode_mode == DECODE_MODE_FULL:
+        stop_time_updates = [
+            get_stop_time_update_tuple(stop_time_update) for stop_time_update in trip_update.stop_time_update
+        ]
+    else:
+        stop_time_updates = extract_endpoint_stop_time_updates(trip_update.stop_time_update)
+    return TripUpdateRecord(
+        trip_update.trip.trip_id,
+        trip_update.trip.route_id,
+        trip_update.vehicle.id,
+        trip_update.trip.schedule_relationship,
+        stop_time_updates
+    )
+
+
+def get_stop_time_update_tuple(stop_time_update):
+    return (
+        stop_time_update.stop_sequence,
+        stop_time_update.stop_id,
+        stop_time_update.arrival.time,
+        stop_time_update.departure.time,
+        stop_time_update.schedule_relationship
+    )
+
+
+def extract_endpoint_stop_time_updates(stop_time_updates):
+    """
+    Return the stop time updates that decide the first and last stop of a trip, in order.
+
+    The parsers keep the last update with the lowest stop_sequence as the start of a trip and
+    the last update with the highest stop_sequence as its end. GTFS-RT requires updates to be
+    sorted by a unique stop_sequence, so those are usually the first and last updates, which
+    avoids building a tuple for every update of every trip. Updates whose stop_sequences aren't
+    strictly increasing, including updates that leave out stop_sequence, fall back to checking
+    every update.
+    """
+    num_stop_time_updates = len(stop_time_updates)
+    if num_stop_time_updates == 0:
+        return []
+
+    stop_sequences = [stop_time_update.stop_sequence for stop_time_update in stop_time_updates]
+    is_sorted = all(
+        stop_sequence < next_stop_sequence
+        for stop_sequence, next_stop_sequence in zip(stop_sequences, stop_sequences[1:])
+    )
+    if is_sorted:
+        if num_stop_time_updates == 1:
+            return [get_stop_time_update_tuple(stop_time_updates[0])]
+        return [
+            get_stop_time_update_tuple(stop_time_updates[0]),
+            get_stop_time_update_tuple(stop_time_updates[num_stop_time_updates - 1])
+        ]
+
+    return select_endpoint_stop_time_updates([
+        get_stop_time_update_tuple(stop_time_update) for stop_time_update in stop_time_updates
+    ])
+
+
+def select_endpoint_stop_time_updates(stop_time_update_tuples):
+    # the last tuple with the lowest and the last tuple with the highest stop_sequence
+    stop_sequences = [stop_time_update[0] for stop_time_update in stop_time_update_tuples]
+    last_index = len(stop_sequences) - 1
+    reversed_stop_sequences = stop_sequences[::-1]
+    lowest_index = last_index - reversed_stop_sequences.index(min(stop_sequences))
+    highest_index = last_index - reversed_stop_sequences.index(max(stop_sequences))
+    if lowest_index == highest_index:
+        return [stop_time_update_tuples[lowest_index]]
+    return [stop_time_update_tuples[lowest_index], stop_time_update_tuples[highest_index]]
+
+
+def extract_in_window(extract_func, start_timestamp, end_timestamp, payload):
+    # only decode the header of snapshots outside the analysis window, the caller skips them
+    header_timestamp = read_header_timestamp(payload)
+    if header_timestamp < start_timestamp or header_timestamp > end_timestamp:
+        return header_timestamp, None
+    return extract_func(payload)
+
+
+def extract_snapshot(extract_func, source):
+    # runs in a worker process, which keeps its own segments memory mapped between calls
+    global worker_snapshot_reader
+
+    if worker_snapshot_reader is None:
+        worker_snapshot_reader = SnapshotReader()
+    payload = worker_snapshot_reader.read(source)
+    try:
+        return extract_func(payload)
+    finally:
+        if isinstance(payload, memoryview):
+            payload.release()
+
+
+def iter_extracted_snapshots(snapshots, extract_func, num_workers=DEFAULT_NUM_WORKERS,
+                             start_timestamp=None, end_timestamp=None):
+    """
+    Yield (name, header_timestamp, records) tuples for the (name, source) snapshots returned by
+    rt_storage.list_snapshots, in the same order. With more than one worker the snapshots are
+    decoded in a pool of worker processes ahead of the caller and merged back in order, so
+    results are the same as a serial run. If a window is given, snapshots outside of it only
+    have their header decoded and are returned with None records.
+    """
+    if start_timestamp is not None:
+        extract_func = partial(extract_in_window, extract_func, start_timestamp, end_timestamp)
+
+    if num_workers <= 1:
+        reader = SnapshotReader()
+        try:
+            for name, source in snapshots:
+                payload = reader.read(source)
+                try:
+                    header_timestamp, records = extract_func(payload)
+                finally:
+                    if isinstance(payload, memoryview):
+                        payload.release()
+                yield name, header_timestamp, records
+        finally:
+            reader.close()
+        return
+
+    chunk_size = max(1, min(MAX_CHUNK_SIZE, len(snapshots) // (num_workers * 4)))
+    with multiprocessing.Pool(num_workers) as pool:
+        results = pool.imap(
+            partial(extract_snapshot, extract_func),
+            [source for name, source in snapshots],
+            chunksize=chunk_size
+        )
+        for (name, source), (header_timestamp, records) in zip(snapshots, results):
+            yield name, header_timestamp, records
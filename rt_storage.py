@@ -0,0 +1,345 @@
+### Helpers for the raw GTFS-RT snapshots saved by the downloader and read by the parsers
+
+import bisect
+import csv
+import hashlib
+import logging
+import mmap
+import os
+import struct
+
+from google.transit import gtfs_realtime_pb2
+
+from rt_compression import COMPRESSED_FILE_EXTENSION, decompress_snapshot, is_compressed
+from rt_wire import read_header_timestamp
+
+logger = logging.getLogger(__name__)
+
+# constants
+SNAPSHOT_FILE_EXTENSION = '.pb'
+SNAPSHOT_FILE_EXTENSIONS = (SNAPSHOT_FILE_EXTENSION, f"{SNAPSHOT_FILE_EXTENSION}{COMPRESSED_FILE_EXTENSION}")
+SEGMENT_FILE_EXTENSION = '.seg'
+SEGMENT_MAGIC = b'GTFSRTS1'
+SEGMENT_RECORD_PREFIX = struct.Struct('<I')
+SEGMENT_INDEX_ENTRY = struct.Struct('<qQIH')
+SEGMENT_FOOTER = struct.Struct('<QI8s')
+MANIFEST_FILENAME = 'manifest.csv'
+MANIFEST_HEADER = [
+    'filename',
+    'fetch_time',
+    'header_timestamp',
+    'size',
+    'content_hash',
+    'entity_count'
+]
+
+
+def append_manifest_row(folder, row):
+    # the manifest is append-only so a crash can at worst leave a partial last line which
+    # read_manifest ignores
+    manifest_path = os.path.join(folder, MANIFEST_FILENAME)
+    write_header = not os.path.exists(manifest_path)
+    with open(manifest_path, mode='a', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=MANIFEST_HEADER)
+        if write_header:
+            writer.writeheader()
+        writer.writerow(row)
+
+
+def write_manifest(folder, rows):
+    # replaces the manifest of a folder, through a temporary file so a crash keeps the old one
+    manifest_path = os.path.join(folder, MANIFEST_FILENAME)
+    with open(f"{manifest_path}.tmp", mode='w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=MANIFEST_HEADER)
+        writer.writeheader()
+        writer.writerows(rows)
+    os.replace(f"{manifest_path}.tmp", manifest_path)
+
+
+def build_manifest(folder):
+    """
+    Write a manifest for a folder of snapshots saved before the downloader kept manifests. The
+    fetch time is taken from the epoch prefix of each filename.
+    """
+    manifest_path = os.path.join(folder, MANIFEST_FILENAME)
+    with open(manifest_path, mode='w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=MANIFEST_HEADER)
+        writer.writeheader()
+        for filename in sorted(os.listdir(folder)):
+            if not filename.endswith(SNAPSHOT_FILE_EXTENSIONS):
+                continue
+            with open(os.path.join(folder, filename), 'rb') as f:
+                content = f.read()
+            message = gtfs_realtime_pb2.FeedMessage()
+            message.ParseFromString(decompress_snapshot(content, folder))
+            writer.writerow({
+                'filename': filename,
+                'fetch_time': int(filename.split('-')[0]),
+                'header_timestamp': message.header.timestamp,
+                'size': len(content),
+                'content_hash': hashlib.sha256(content).hexdigest(),
+                'entity_count': len(message.entity)
+            })
+
+
+def read_manifest(folder):
+    manifest_path = os.path.join(folder, MANIFEST_FILENAME)
+    if not os.path.exists(manifest_path):
+        return None
+
+    rows = []
+    with open(manifest_path, mode='r', newline='') as file:
+        for row in csv.DictReader(file):
+            if row['entity_count'] in (None, ''):
+                # incomplete trailing line
+                continue
+            row['fetch_time'] = int(row['fetch_time'])
+            row['header_timestamp'] = int(row['header_timestamp'])
+            row['size'] = int(row['size'])
+            row['entity_count'] = int(row['entity_count'])
+            rows.append(row)
+    return rows
+
+
+def snapshots_exist(folder):
+    return os.path.exists(folder) or os.path.exists(get_segment_path(folder))
+
+
+def list_folder_snapshots(folder, start_timestamp, end_timestamp):
+    # returns (name, path) tuples of the loose snapshot files in a folder
+    filenames = [filename for filename in os.listdir(folder) if filename.endswith(SNAPSHOT_FILE_EXTENSIONS)]
+    manifest_rows = read_manifest(folder)
+    if manifest_rows is None:
+        return [(os.path.join(folder, filename), os.path.join(folder, filename)) for filename in filenames]
+
+    # files saved before the manifest was started or whose row was lost in a crash are returned
+    # whatever their header timestamp is, like the files of folders without a manifest
+    header_timestamps = {row['filename']: row['header_timestamp'] for row in manifest_rows}
+    unlisted_filenames = {filename for filename in filenames if filename not in header_timestamps}
+    if len(unlisted_filenames) > 0:
+        logger.warning(
+            f"{len(unlisted_filenames)} snapshots in {folder} aren't in its manifest, "
+            f"including {sorted(unlisted_filenames)[:5]}"
+        )
+    return [
+        (os.path.join(folder, filename), os.path.join(folder, filename))
+        for filename in filenames
+        if filename in unlisted_filenames or start_timestamp <= header_timestamps[filename] <= end_timestamp
+    ]
+
+
+def list_snapshots(folders, start_timestamp, end_timestamp):
+    """
+    Return (name, source) tuples for the snapshots in the given folders that could fall within
+    the [start_timestamp, end_timestamp] window, in fetch order. The source is either the path
+    of a loose file or a (segment_path, offset, length) tuple and can be read with a
+    SnapshotReader. Segments and folders with a manifest only return snapshots whose header
+    timestamp is inside the window. Folders without one return every snapshot, which then has
+    to be decoded to check its header timestamp.
+    """
+    snapshots = {}
+    for folder in folders:
+        if not snapshots_exist(folder):
+            raise FileNotFoundError(f"No snapshots found for {folder}")
+
+        segment_path = get_segment_path(folder)
+        if os.path.exists(segment_path):
+            segment = Segment(segment_path)
+            for filename, offset, length in segment.find(start_timestamp, end_timestamp):
+                snapshots[os.path.join(folder, filename)] = (segment_path, offset, length)
+            segment.close()
+
+        # loose files also cover snapshots saved after the folder was compacted
+        if os.path.exists(folder):
+            for name, path in list_folder_snapshots(folder, start_timestamp, end_timestamp):
+                snapshots[name] = path
+
+    return sorted(snapshots.items())
+
+
+class SnapshotReader:
+    """
+    Reads snapshot payloads from their source, keeping the segments it has read from memory
+    mapped until it is closed. Payloads read from segments are zero-copy memoryviews, unless
+    they're compressed. Compressed payloads are returned decompressed.
+    """
+    def __init__(self):
+        self.segments = {}
+
+    def read(self, source):
+        if isinstance(source, str):
+            with open(source, 'rb') as f:
+                return decompress_snapshot(f.read(), os.path.dirname(source))
+
+        segment_path, offset, length = source
+        segment = self.segments.get(segment_path)
+        if segment is None:
+            segment = self.segments[segment_path] = Segment(segment_path)
+        payload = segment.view[offset:offset + length]
+        if not is_compressed(payload):
+            return payload
+        try:
+            # segments are saved next to the folder they were compacted from
+            return decompress_snapshot(payload, segment_path[:-len(SEGMENT_FILE_EXTENSION)])
+        finally:
+            # the view would otherwise keep the segment from being closed
+            payload.release()
+
+    def close(self):
+        for segment in self.segments.values():
+            segment.close()
+        self.segments = {}
+
+
+def iter_snapshots(folders, start_timestamp, end_timestamp):
+    """
+    Yield (name, payload) tuples for the snapshots returned by list_snapshots. Payloads read
+    from segments are only valid until the next snapshot is requested.
+    """
+    reader = SnapshotReader()
+    try:
+        for name, source in list_snapshots(folders, start_timestamp, end_timestamp):
+            payload = reader.read(source)
+            try:
+                yield name, payload
+            finally:
+                if isinstance(payload, memoryview):
+                    payload.release()
+    finally:
+        reader.close()
+
+
+def get_segment_path(folder):
+    return f"{os.path.normpath(folder)}{SEGMENT_FILE_EXTENSION}"
+
+
+class Segment:
+    """
+    A memory mapped segment archive of the snapshots of one feed, day and url type.
+
+    The file starts with SEGMENT_MAGIC and is followed by one length-prefixed record per
+    snapshot in fetch order. An index of (header timestamp, offset, length, filename) entries
+    sorted by header timestamp comes after the records, and a fixed-size footer holding the
+    index offset and entry count ends the file.
+    """
+    def __init__(self, segment_path):
+        self.file = open(segment_path, 'rb')
+        self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.mmap)
+
+        if self.view[:len(SEGMENT_MAGIC)] != SEGMENT_MAGIC:
+            raise ValueError(f"{segment_path} is not a segment archive")
+        index_offset, entry_count, footer_magic = SEGMENT_FOOTER.unpack_from(
+            self.view, len(self.view) - SEGMENT_FOOTER.size
+        )
+        if footer_magic != SEGMENT_MAGIC:
+            raise ValueError(f"{segment_path} is missing its footer, it may be incomplete")
+
+        self.header_timestamps = []
+        self.entries = []
+        position = index_offset
+        for _ in range(entry_count):
+            header_timestamp, offset, length, filename_length = SEGMENT_INDEX_ENTRY.unpack_from(
+                self.view, position
+            )
+            position += SEGMENT_INDEX_ENTRY.size
+            filename = bytes(self.view[position:position + filename_length]).decode('utf-8')
+            position += filename_length
+            self.header_timestamps.append(header_timestamp)
+            self.entries.append((filename, offset, length))
+
+    def find(self, start_timestamp, end_timestamp):
+        first_index = bisect.bisect_left(self.header_timestamps, start_timestamp)
+        last_index = bisect.bisect_right(self.header_timestamps, end_timestamp)
+        return self.entries[first_index:last_index]
+
+    def find_all(self):
+        return list(zip(self.header_timestamps, self.entries))
+
+    def close(self):
+        self.view.release()
+        self.mmap.close()
+        self.file.close()
+
+
+def write_segment(segment_path, snapshots):
+    """
+    Write a segment archive from a list of (filename, header_timestamp, content) tuples. The
+    segment is written to a temporary file and renamed so a crash never leaves a partial
+    segment in place.
+    """
+    index = []
+    tmp_segment_path = f"{segment_path}.tmp"
+    with open(tmp_segment_path, 'wb') as file:
+        file.write(SEGMENT_MAGIC)
+        for filename, header_timestamp, content in sorted(snapshots, key=lambda snapshot: snapshot[0]):
+            file.write(SEGMENT_RECORD_PREFIX.pack(len(content)))
+            index.append((header_timestamp, file.tell(), len(content), filename))
+            file.write(content)
+
+        index_offset = file.tell()
+        index.sort(key=lambda entry: (entry[0], entry[3]))
+        for header_timestamp, offset, length, filename in index:
+            encoded_filename = filename.encode('utf-8')
+            file.write(SEGMENT_INDEX_ENTRY.pack(header_timestamp, offset, length, len(encoded_filename)))
+            file.write(encoded_filename)
+        file.write(SEGMENT_FOOTER.pack(index_offset, len(index), SEGMENT_MAGIC))
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_segment_path, segment_path)
+
+
+def compact_folder(folder, remove_files=True):
+    """
+    Roll the loose snapshots of a finished feed, day and url type folder into its segment
+    archive, merging with an existing segment if the folder was compacted before. Returns the
+    number of snapshots in the segment.
+    """
+    segment_path = get_segment_path(folder)
+    snapshots = {}
+
+    if os.path.exists(segment_path):
+        segment = Segment(segment_path)
+        for header_timestamp, (filename, offset, length) in segment.find_all():
+            snapshots[filename] = (filename, header_timestamp, bytes(segment.view[offset:offset + length]))
+        segment.close()
+
+    compacted_filenames = []
+    manifest_rows = []
+    if os.path.exists(folder):
+        manifest_rows = read_manifest(folder) or []
+        header_timestamps = {row['filename']: row['header_timestamp'] for row in manifest_rows}
+        for filename in sorted(os.listdir(folder)):
+            if not filename.endswith(SNAPSHOT_FILE_EXTENSIONS):
+                continue
+            with open(os.path.join(folder, filename), 'rb') as f:
+                content = f.read()
+            header_timestamp = header_timestamps.get(filename)
+            if header_timestamp is None:
+                try:
+                    header_timestamp = read_header_timestamp(decompress_snapshot(content, folder))
+                except (IndexError, ValueError):
+                    # leave unparseable snapshots in place for inspection
+                    continue
+            snapshots[filename] = (filename, header_timestamp, content)
+            compacted_filenames.append(filename)
+
+    write_segment(segment_path, list(snapshots.values()))
+
+    if remove_files and os.path.exists(folder):
+        for filename in compacted_filenames:
+            os.remove(os.path.join(folder, filename))
+        manifest_path = os.path.join(folder, MANIFEST_FILENAME)
+        if os.path.exists(manifest_path):
+            # the manifest is kept for the snapshots left in place, with only their rows
+            leftover_filenames = {
+                filename for filename in os.listdir(folder) if filename.endswith(SNAPSHOT_FILE_EXTENSIONS)
+            }
+            if len(leftover_filenames) == 0:
+                os.remove(manifest_path)
+            else:
+                write_manifest(folder, [row for row in manifest_rows if row['filename'] in leftover_filenames])
+        if len(os.listdir(folder)) == 0:
+            os.rmdir(folder)
+
+    return len(snapshots)
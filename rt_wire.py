@@ -0,0 +1,69 @@
+### Minimal protobuf wire format decoding for reading parts of a GTFS-RT FeedMessage without
+# decoding the whole message
+
+# constants
+FEED_MESSAGE_HEADER_FIELD = 1
+FEED_HEADER_TIMESTAMP_FIELD = 3
+WIRE_TYPE_VARINT = 0
+WIRE_TYPE_FIXED64 = 1
+WIRE_TYPE_LENGTH_DELIMITED = 2
+WIRE_TYPE_FIXED32 = 5
+
+
+def read_varint(payload, position):
+    result = 0
+    shift = 0
+    while True:
+        byte = payload[position]
+        position += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, position
+        shift += 7
+        if shift >= 64:
+            raise ValueError('Malformed varint')
+
+
+def skip_field(payload, position, wire_type):
+    if wire_type == WIRE_TYPE_VARINT:
+        return read_varint(payload, position)[1]
+    if wire_type == WIRE_TYPE_FIXED64:
+        return position + 8
+    if wire_type == WIRE_TYPE_LENGTH_DELIMITED:
+        length, position = read_varint(payload, position)
+        return position + length
+    if wire_type == WIRE_TYPE_FIXED32:
+        return position + 4
+    raise ValueError(f"Unsupported wire type {wire_type}")
+
+
+def read_header_timestamp(payload):
+    """
+    Return FeedHeader.timestamp of a serialized FeedMessage, or 0 if it isn't set, by only
+    decoding the header. Producers serialize the header as the first field, so this normally
+    touches a few dozen bytes no matter how many entities the message has.
+    """
+    position = 0
+    payload_length = len(payload)
+    while position < payload_length:
+        key, position = read_varint(payload, position)
+        field_number = key >> 3
+        wire_type = key & 0x7
+        if field_number == FEED_MESSAGE_HEADER_FIELD and wire_type == WIRE_TYPE_LENGTH_DELIMITED:
+            header_length, position = read_varint(payload, position)
+            return read_timestamp_from_header(payload, position, position + header_length)
+        position = skip_field(payload, position, wire_type)
+    return 0
+
+
+def read_timestamp_from_header(payload, position, header_end):
+    timestamp = 0
+    while position < header_end:
+        key, position = read_varint(payload, position)
+        field_number = key >> 3
+        wire_type = key & 0x7
+        if field_number == FEED_HEADER_TIMESTAMP_FIELD and wire_type == WIRE_TYPE_VARINT:
+            timestamp, position = read_varint(payload, position)
+        else:
+            position = skip_field(payload, position, wire_type)
+    return timestamp
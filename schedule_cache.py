@@ -0,0 +1,271 @@
+### A cache of the per-service-date schedule data used by the parsers, keyed by the content hash
+# of the GTFS schedule zip and the service date
+
+import hashlib
+import json
+import logging
+import os
+
+from collections import OrderedDict
+
+import gtfs_kit
+
+from metrics import increment, timed
+from stop_index import StopIndex
+from utils import create_folder
+
+logger = logging.getLogger(__name__)
+
+# constants
+SCHEDULE_CACHE_VERSION = 2
+DEFAULT_SCHEDULE_CACHE_FOLDER = 'schedule_cache'
+DEFAULT_SCHEDULE_CACHE_MAX_ENTRIES = 64
+DEFAULT_MAX_LOADED_FEEDS = 1
+TRIP_STATS_COLUMNS = [
+    'trip_id',
+    'route_id',
+    'shape_id',
+    'block_id',
+    'start_time',
+    'end_time',
+    'start_stop_id',
+    'end_stop_id'
+]
+
+# globals
+# hashes of the zips hashed by this process, by file identity. The downloader hardlinks the same
+# schedule into every date folder, so consecutive dates usually hit this.
+global_file_hashes = {}
+# zip hashes to the gtfs_kit feeds read by load_schedule_for_date with keep_feed set, least
+# recently used first
+global_loaded_feeds = OrderedDict()
+# (zip hash, date) keys to the (schedule artifact, ScheduleLookup) kept by load_schedule_lookup, least
+# recently used first
+global_loaded_schedules = OrderedDict()
+
+
+def hash_file(path):
+    stat = os.stat(path)
+    file_key = (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+    file_hash = global_file_hashes.get(file_key)
+    if file_hash is not None:
+        return file_hash
+
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha256.update(chunk)
+    file_hash = global_file_hashes[file_key] = sha256.hexdigest()
+    return file_hash
+
+
+def compute_schedule_for_date(schedule_feed, gtfs_kit_analysis_date):
+    """
+    Compute the schedule artifact of one service date from a loaded gtfs_kit feed. Trip stats
+    match gtfs_kit.compute_trip_stats, but only the trips active on the date are computed.
+    """
+    trips_on_analysis_date = schedule_feed.get_trips(gtfs_kit_analysis_date)
+    trip_ids_on_analysis_date = trips_on_analysis_date['trip_id'].tolist()
+
+    stop_times = schedule_feed.stop_times[
+        schedule_feed.stop_times['trip_id'].isin(set(trip_ids_on_analysis_date))
+    ].sort_values(['trip_id', 'stop_sequence'])
+    first_stop_times = stop_times.drop_duplicates('trip_id', keep='first')[['trip_id', 'departure_time', 'stop_id']]
+    last_stop_times = stop_times.drop_duplicates('trip_id', keep='last')[['trip_id', 'departure_time', 'stop_id']]
+
+    # like compute_trip_stats, trips without stop times don't get stats
+    trips = trips_on_analysis_date.copy()
+    for column in ['shape_id', 'block_id']:
+        if column not in trips.columns:
+            trips[column] = None
+    trip_stats = (
+        trips[['trip_id', 'route_id', 'shape_id', 'block_id']]
+        .merge(first_stop_times.rename(columns={'departure_time': 'start_time', 'stop_id': 'start_stop_id'}))
+        .merge(last_stop_times.rename(columns={'departure_time': 'end_time', 'stop_id': 'end_stop_id'}))
+    )
+
+    # the stops served on the date and the stop pattern of each trip, for matching vehicle
+    # positions to stops. Patterns are lists of (stop_sequence, index into stops) and are shared by
+    # the trips that serve the same stops in the same order.
+    stop_ids = stop_times['stop_id'].unique().tolist()
+    stop_indexes = {stop_id: stop_index for stop_index, stop_id in enumerate(stop_ids)}
+    stop_locations = schedule_feed.stops.drop_duplicates('stop_id').set_index('stop_id').reindex(stop_ids)
+    stops = [
+        [stop_id, None if latitude != latitude else latitude, None if longitude != longitude else longitude]
+        for stop_id, latitude, longitude in zip(
+            stop_ids,
+            stop_locations['stop_lat'].tolist(),
+            stop_locations['stop_lon'].tolist()
+        )
+    ]
+    stop_patterns = {}
+    trip_stop_patterns = {}
+    trip_ids = stop_times['trip_id'].tolist()
+    stop_sequences = stop_times['stop_sequence'].astype(int).tolist()
+    pattern_stop_indexes = [stop_indexes[stop_id] for stop_id in stop_times['stop_id'].tolist()]
+    trip_start = 0
+    for row_number in range(1, len(trip_ids) + 1):
+        if row_number < len(trip_ids) and trip_ids[row_number] == trip_ids[trip_start]:
+            continue
+        stop_pattern = tuple(zip(
+            stop_sequences[trip_start:row_number],
+            pattern_stop_indexes[trip_start:row_number]
+        ))
+        trip_stop_patterns[trip_ids[trip_start]] = stop_patterns.setdefault(stop_pattern, len(stop_patterns))
+        trip_start = row_number
+
+    # same as gtfs_kit's get_start_and_end_times for the date
+    return {
+        'version': SCHEDULE_CACHE_VERSION,
+        'agency_timezone': schedule_feed.agency.iloc[0].agency_timezone,
+        'start_time': stop_times['departure_time'].dropna().min(),
+        'end_time': stop_times['arrival_time'].dropna().max(),
+        'trip_ids': trip_ids_on_analysis_date,
+        'trip_stats': trip_stats[TRIP_STATS_COLUMNS].to_dict(orient='records'),
+        'stops': stops,
+        'stop_patterns': [list(stop_pattern) for stop_pattern in stop_patterns],
+        'trip_stop_patterns': trip_stop_patterns
+    }
+
+
+def load_schedule_for_date(gtfs_zip_path, analysis_date_str, cache_folder=DEFAULT_SCHEDULE_CACHE_FOLDER,
+                           max_entries=DEFAULT_SCHEDULE_CACHE_MAX_ENTRIES, keep_feed=False,
+                           max_loaded_feeds=DEFAULT_MAX_LOADED_FEEDS):
+    """
+    Return the schedule artifact of a service date, computing and caching it if needed. The
+    artifact is a dict with the agency timezone, the start and end times of service, the ids
+    of the trips active on the date, their stats and stop patterns, and the stops they serve.
+    With `keep_feed` the zips read to compute an artifact stay loaded for computing other dates
+    of the same zips, up to the `max_loaded_feeds` most recently used ones, at the cost of
+    keeping them in memory.
+    """
+    zip_hash = hash_file(gtfs_zip_path)
+    cache_path = os.path.join(cache_folder, f"{zip_hash}-{analysis_date_str}.json")
+
+    if os.path.exists(cache_path):
+        with open(cache_path, 'r') as f:
+            schedule_for_date = json.load(f)
+        if schedule_for_date.get('version') == SCHEDULE_CACHE_VERSION:
+            logger.info(f"Loaded cached schedule data for {analysis_date_str} from {cache_path}")
+            increment('schedule_cache_hits')
+            # bump the modification time to keep recently used entries from being evicted
+            os.utime(cache_path)
+            return schedule_for_date
+
+    logger.info(f"Computing schedule data for {analysis_date_str} from {gtfs_zip_path}")
+    increment('schedule_cache_misses')
+    schedule_feed = global_loaded_feeds.get(zip_hash)
+    if schedule_feed is not None:
+        global_loaded_feeds.move_to_end(zip_hash)
+    else:
+        if not keep_feed:
+            global_loaded_feeds.clear()
+        with timed('schedule_read_feed'):
+            schedule_feed = gtfs_kit.read_feed(gtfs_zip_path, 'm')
+        if keep_feed:
+            global_loaded_feeds[zip_hash] = schedule_feed
+            while len(global_loaded_feeds) > max_loaded_feeds:
+                global_loaded_feeds.popitem(last=False)
+    with timed('schedule_trip_stats'):
+        schedule_for_date = compute_schedule_for_date(schedule_feed, analysis_date_str.replace('-', ''))
+
+    create_folder(cache_folder)
+    # several processes may compute the same entry during a backfill
+    tmp_cache_path = f"{cache_path}.{os.getpid()}.tmp"
+    with open(tmp_cache_path, 'w') as f:
+        json.dump(schedule_for_date, f)
+    os.replace(tmp_cache_path, cache_path)
+    evict_old_entries(cache_folder, max_entries)
+
+    return schedule_for_date
+
+
+def evict_old_entries(cache_folder, max_entries):
+    cache_paths = [
+        os.path.join(cache_folder, filename)
+        for filename in os.listdir(cache_folder)
+        if filename.endswith('.json')
+    ]
+    cache_mtimes = {}
+    for cache_path in cache_paths:
+        try:
+            cache_mtimes[cache_path] = os.path.getmtime(cache_path)
+        except FileNotFoundError:
+            # evicted by another process
+            pass
+    cache_paths = sorted(cache_mtimes, key=cache_mtimes.get, reverse=True)
+    for cache_path in cache_paths[max_entries:]:
+        logger.info(f"Evicting schedule cache entry {cache_path}")
+        try:
+            os.remove(cache_path)
+        except FileNotFoundError:
+            pass
+
+
+class ScheduleLookup:
+    """
+    Hashed lookups into a schedule artifact. Keeps the trip ids of the date in schedule order
+    for passes over every scheduled trip, with O(1) membership and trip stats lookups. The
+    spatial index of the stops is built the first time it's needed.
+    """
+    def __init__(self, schedule_for_date):
+        self.trip_ids = schedule_for_date['trip_ids']
+        self.trip_id_set = set(self.trip_ids)
+        self.trip_stats_by_trip_id = {
+            trip_stats['trip_id']: trip_stats for trip_stats in schedule_for_date['trip_stats']
+        }
+        self.stops = schedule_for_date['stops']
+        self.stop_patterns = schedule_for_date['stop_patterns']
+        self.trip_stop_patterns = schedule_for_date['trip_stop_patterns']
+        self.stop_indexes = {}
+
+    def is_scheduled(self, trip_id):
+        return trip_id in self.trip_id_set
+
+    def get_trip_stats(self, trip_id):
+        return self.trip_stats_by_trip_id.get(trip_id)
+
+    def get_stop_pattern_index(self, trip_id):
+        return self.trip_stop_patterns.get(trip_id)
+
+    def get_stop_index(self, radius_meters):
+        # built once for each match radius
+        stop_index = self.stop_indexes.get(radius_meters)
+        if stop_index is None:
+            with timed('stop_index_build'):
+                stop_index = StopIndex(self.stops, self.stop_patterns, radius_meters)
+            self.stop_indexes[radius_meters] = stop_index
+        return stop_index
+
+
+def load_schedule_lookup(gtfs_zip_path, analysis_date_str, cache_folder=DEFAULT_SCHEDULE_CACHE_FOLDER,
+                         max_entries=DEFAULT_SCHEDULE_CACHE_MAX_ENTRIES, keep_feed=False,
+                         max_loaded_feeds=DEFAULT_MAX_LOADED_FEEDS, max_loaded_schedules=0):
+    """
+    Return the (schedule artifact, ScheduleLookup) of a service date like load_schedule_for_date.
+    Long-lived processes can keep the `max_loaded_schedules` most recently used ones loaded, along
+    with the stop indexes built for them, so later runs of the same zip and date don't read the
+    cache entry again.
+    """
+    key = (hash_file(gtfs_zip_path), analysis_date_str)
+    loaded_schedule = global_loaded_schedules.get(key)
+    if loaded_schedule is not None:
+        logger.info(f"Using loaded schedule data for {analysis_date_str}")
+        increment('schedule_memory_hits')
+        global_loaded_schedules.move_to_end(key)
+        return loaded_schedule
+
+    schedule_for_date = load_schedule_for_date(
+        gtfs_zip_path,
+        analysis_date_str,
+        cache_folder,
+        max_entries,
+        keep_feed,
+        max_loaded_feeds
+    )
+    loaded_schedule = (schedule_for_date, ScheduleLookup(schedule_for_date))
+    if max_loaded_schedules > 0:
+        global_loaded_schedules[key] = loaded_schedule
+        while len(global_loaded_schedules) > max_loaded_schedules:
+            global_loaded_schedules.popitem(last=False)
+    return loaded_schedule
@@ -0,0 +1,136 @@
+### A grid index over the stops of a schedule that matches vehicle positions to the nearby stops of
+# their trips, a whole batch of positions at a time
+
+import math
+
+import numpy
+
+# constants
+EARTH_RADIUS_METERS = 6371008.8
+DEFAULT_STOP_MATCH_RADIUS_METERS = 40
+# a position's own cell and the 8 around it
+NEIGHBOR_CELL_OFFSETS = [(offset_x, offset_y) for offset_x in (-1, 0, 1) for offset_y in (-1, 0, 1)]
+
+
+def is_in_sorted(sorted_values, values):
+    if len(sorted_values) == 0:
+        return numpy.zeros(len(values), dtype=bool)
+    indexes = numpy.minimum(numpy.searchsorted(sorted_values, values), len(sorted_values) - 1)
+    return sorted_values[indexes] == values
+
+
+class StopIndex:
+    """
+    Buckets the stops of a schedule artifact into square cells as wide as the match radius, on an
+    equirectangular projection around their mean latitude, so the stops within the radius of a
+    position are in its cell or one of the 8 around it. Stops without a location are left out.
+
+    Positions are matched to the nearest stop within the radius that the stop pattern of their
+    trip serves, so stops of the opposite direction across the street don't match.
+    """
+    def __init__(self, stops, stop_patterns, radius_meters=DEFAULT_STOP_MATCH_RADIUS_METERS):
+        self.radius_meters = radius_meters
+        self.num_stops = len(stops)
+        latitudes = numpy.array([numpy.nan if latitude is None else latitude for _, latitude, _ in stops], dtype=float)
+        longitudes = numpy.array(
+            [numpy.nan if longitude is None else longitude for _, _, longitude in stops],
+            dtype=float
+        )
+        located = ~numpy.isnan(latitudes) & ~numpy.isnan(longitudes)
+        self.cos_latitude = 1.0
+        if located.any():
+            self.cos_latitude = math.cos(math.radians(float(latitudes[located].mean())))
+        self.stop_x, self.stop_y = self.project(latitudes, longitudes)
+
+        cell_x = numpy.floor(self.stop_x[located] / radius_meters).astype(numpy.int64)
+        cell_y = numpy.floor(self.stop_y[located] / radius_meters).astype(numpy.int64)
+        # keep an empty cell around the stops, so neighbors of positions in the grid stay in it
+        self.min_cell_x = int(cell_x.min()) - 1 if len(cell_x) > 0 else 0
+        self.min_cell_y = int(cell_y.min()) - 1 if len(cell_y) > 0 else 0
+        self.num_cells_x = int(cell_x.max()) - self.min_cell_x + 2 if len(cell_x) > 0 else 0
+        self.num_cells_y = int(cell_y.max()) - self.min_cell_y + 2 if len(cell_y) > 0 else 0
+
+        # stop indexes sorted by cell, with the cells that have stops and where their stops start
+        cell_keys = (cell_x - self.min_cell_x) * self.num_cells_y + (cell_y - self.min_cell_y)
+        cell_order = numpy.argsort(cell_keys, kind='stable')
+        self.cell_stop_indexes = numpy.flatnonzero(located)[cell_order]
+        self.cell_keys, self.cell_starts, self.cell_counts = numpy.unique(
+            cell_keys[cell_order],
+            return_index=True,
+            return_counts=True
+        )
+
+        # (pattern, stop) pairs as pattern index * number of stops + stop index
+        self.pattern_stop_keys = numpy.unique(numpy.array([
+            pattern_index * self.num_stops + stop_index
+            for pattern_index, stop_indexes in enumerate(stop_patterns)
+            for stop_sequence, stop_index in stop_indexes
+        ], dtype=numpy.int64))
+
+    def project(self, latitudes, longitudes):
+        return (
+            EARTH_RADIUS_METERS * numpy.radians(longitudes) * self.cos_latitude,
+            EARTH_RADIUS_METERS * numpy.radians(latitudes)
+        )
+
+    def get_candidates(self, x, y):
+        # (position index, stop index) pairs of the stops in the cells around each position
+        num_positions = len(x)
+        cell_x = numpy.floor(numpy.nan_to_num(x, nan=0.0) / self.radius_meters).astype(numpy.int64) - self.min_cell_x
+        cell_y = numpy.floor(numpy.nan_to_num(y, nan=0.0) / self.radius_meters).astype(numpy.int64) - self.min_cell_y
+        located = ~numpy.isnan(x) & ~numpy.isnan(y)
+
+        position_indexes = []
+        stop_indexes = []
+        for offset_x, offset_y in NEIGHBOR_CELL_OFFSETS:
+            neighbor_x = cell_x + offset_x
+            neighbor_y = cell_y + offset_y
+            in_grid = located & (neighbor_x >= 0) & (neighbor_x < self.num_cells_x) & \
+                (neighbor_y >= 0) & (neighbor_y < self.num_cells_y)
+            neighbor_keys = numpy.where(in_grid, neighbor_x * self.num_cells_y + neighbor_y, -1)
+            cells = numpy.minimum(numpy.searchsorted(self.cell_keys, neighbor_keys), len(self.cell_keys) - 1)
+            counts = numpy.where(in_grid & (self.cell_keys[cells] == neighbor_keys), self.cell_counts[cells], 0)
+            num_candidates = int(counts.sum())
+            if num_candidates == 0:
+                continue
+
+            # expand each position into one pair for every stop of its cell
+            candidate_starts = numpy.repeat(self.cell_starts[cells], counts)
+            offsets_in_cell = numpy.arange(num_candidates) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+            position_indexes.append(numpy.repeat(numpy.arange(num_positions), counts))
+            stop_indexes.append(self.cell_stop_indexes[candidate_starts + offsets_in_cell])
+
+        if len(position_indexes) == 0:
+            return numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int64)
+        return numpy.concatenate(position_indexes), numpy.concatenate(stop_indexes)
+
+    def match(self, latitudes, longitudes, pattern_indexes):
+        """
+        Return the index of the nearest stop within the radius of each position that the stop
+        pattern at the same index serves, or -1 if there is none.
+        """
+        latitudes = numpy.asarray(latitudes, dtype=float)
+        longitudes = numpy.asarray(longitudes, dtype=float)
+        pattern_indexes = numpy.asarray(pattern_indexes, dtype=numpy.int64)
+        matched_stop_indexes = numpy.full(len(latitudes), -1, dtype=numpy.int64)
+        if len(latitudes) == 0 or len(self.cell_keys) == 0:
+            return matched_stop_indexes
+
+        x, y = self.project(latitudes, longitudes)
+        position_indexes, stop_indexes = self.get_candidates(x, y)
+        squared_distances = (self.stop_x[stop_indexes] - x[position_indexes]) ** 2 + \
+            (self.stop_y[stop_indexes] - y[position_indexes]) ** 2
+        candidate_pattern_indexes = pattern_indexes[position_indexes]
+        is_match = (squared_distances <= self.radius_meters ** 2) & (candidate_pattern_indexes >= 0) & is_in_sorted(
+            self.pattern_stop_keys,
+            candidate_pattern_indexes * self.num_stops + stop_indexes
+        )
+        position_indexes = position_indexes[is_match]
+        stop_indexes = stop_indexes[is_match]
+        squared_distances = squared_distances[is_match]
+
+        # the nearest candidate is the first of each position's when sorted by position then distance
+        candidate_order = numpy.lexsort((squared_distances, position_indexes))
+        matched_positions, first_candidates = numpy.unique(position_indexes[candidate_order], return_index=True)
+        matched_stop_indexes[matched_positions] = stop_indexes[candidate_order][first_candidates]
+        return matched_stop_indexes
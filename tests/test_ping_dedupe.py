@@ -0,0 +1,51 @@
+from ping_dedupe import PingDeduplicator
+
+
+def test_pings_without_timestamps_are_kept():
+    # feeds that leave out VehiclePosition.timestamp send 0, pings are still told apart by position
+    deduplicator = PingDeduplicator(window_seconds=3600)
+    num_new_pings = 0
+    for index in range(720):
+        deduplicator.advance(1700000000 + index * 30)
+        num_new_pings += deduplicator.add('bus_1', 0, 37.7 + index * 0.0001, -122.4, 0.0, 0.0)
+    assert num_new_pings == 720
+
+
+def test_pings_with_equal_timestamps():
+    deduplicator = PingDeduplicator(window_seconds=3600)
+    deduplicator.advance(1700000000)
+    assert deduplicator.add('bus_1', 1700000000, 37.7, -122.4, 0.0, 0.0)
+    assert deduplicator.add('bus_1', 1700000000, 37.8, -122.4, 0.0, 0.0)
+    assert deduplicator.add('bus_2', 1700000000, 37.7, -122.4, 0.0, 0.0)
+    deduplicator.advance(1700000030)
+    assert not deduplicator.add('bus_1', 1700000000, 37.7, -122.4, 0.0, 0.0)
+    assert not deduplicator.add('bus_1', 1700000000, 37.8, -122.4, 0.0, 0.0)
+
+
+def test_late_ping_before_evicted_pings_is_kept():
+    deduplicator = PingDeduplicator(window_seconds=3600)
+    deduplicator.advance(1700000000)
+    deduplicator.add('bus_1', 1700000000, 37.7, -122.4, 0.0, 0.0)
+    deduplicator.advance(1700010000)
+    assert len(deduplicator) == 0
+    assert deduplicator.add('bus_1', 1699999000, 37.6, -122.4, 0.0, 0.0)
+
+
+def test_repeated_stale_ping_stays_deduplicated():
+    deduplicator = PingDeduplicator(window_seconds=3600)
+    num_new_pings = 0
+    for index in range(6 * 120):
+        deduplicator.advance(1700000000 + index * 30)
+        num_new_pings += deduplicator.add('bus_1', 1700000000, 37.7, -122.4, 0.0, 0.0)
+    assert num_new_pings == 1
+
+
+def test_memory_stays_bounded():
+    deduplicator = PingDeduplicator(window_seconds=3600)
+    for index in range(6 * 120):
+        feed_timestamp = 1700000000 + index * 30
+        deduplicator.advance(feed_timestamp)
+        for vehicle_index in range(10):
+            deduplicator.add(f"bus_{vehicle_index}", feed_timestamp, 37.7, -122.4, 0.0, 0.0)
+    # at most 1.5 windows of pings
+    assert len(deduplicator) <= 10 * 180
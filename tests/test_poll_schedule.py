@@ -0,0 +1,31 @@
+from poll_schedule import AdaptivePollSchedule
+
+
+def test_long_run_of_misses_stays_within_max_interval():
+    # a feed that stops updating for a day is polled every max interval, without overflowing
+    poll_schedule = AdaptivePollSchedule('https://example.com/trip-updates')
+    poll_schedule.record_update(1700000000, 1699999990)
+    poll_time = 1700000000
+    for _ in range(5000):
+        poll_time = poll_schedule.next_poll_time
+        poll_schedule.record_miss(poll_time)
+        assert poll_time + poll_schedule.min_interval_seconds <= poll_schedule.next_poll_time
+        assert poll_schedule.next_poll_time <= poll_time + poll_schedule.max_interval_seconds
+    assert poll_schedule.next_poll_time == poll_time + poll_schedule.max_interval_seconds
+
+
+def test_update_after_misses_resets_the_backoff():
+    poll_schedule = AdaptivePollSchedule('https://example.com/trip-updates')
+    poll_schedule.record_update(1700000000, 1699999990)
+    for poll_time in range(1700000010, 1700003010, 60):
+        poll_schedule.record_miss(poll_time)
+    poll_schedule.record_update(1700003010, 1700003000)
+    poll_schedule.record_miss(1700003020)
+    # the update interval is clamped to the max interval, the first miss retries after a tenth of it
+    assert poll_schedule.next_poll_time == 1700003020 + 6
+
+
+def test_failure_retries_at_max_interval():
+    poll_schedule = AdaptivePollSchedule('https://example.com/trip-updates', max_interval_seconds=30)
+    poll_schedule.record_failure(1700000000)
+    assert poll_schedule.next_poll_time == 1700000030
@@ -0,0 +1,160 @@
+from types import SimpleNamespace
+
+from google.transit import gtfs_realtime_pb2
+
+from rt_extract import DECODE_MODE_FAST, DECODE_MODE_FULL, extract_in_window, extract_trip_update_shards, \
+    extract_trip_updates, extract_vehicle_positions, get_trip_shard
+from rt_wire import read_header_timestamp
+from tides_tables import TripsPerformedBuilder
+
+HEADER_TIMESTAMP = 1721134800
+# stop_sequences of the stop time updates of each trip, None leaves stop_sequence out
+TRIP_STOP_SEQUENCES = {
+    'sorted': [1, 2, 3, 4],
+    'duplicate_first': [1, 1, 2],
+    'duplicate_last': [1, 2, 2],
+    'unsorted': [1, 5, 3],
+    'descending': [4, 3, 2],
+    'omitted': [None, None, None],
+    'partly_omitted': [None, 2, 3],
+    'single': [7],
+    'no_updates': []
+}
+
+
+def build_trip_updates_payload(header_timestamp, time_offset):
+    message = gtfs_realtime_pb2.FeedMessage()
+    message.header.gtfs_realtime_version = '2.0'
+    message.header.timestamp = header_timestamp
+    for trip_id, stop_sequences in TRIP_STOP_SEQUENCES.items():
+        entity = message.entity.add()
+        entity.id = trip_id
+        entity.trip_update.trip.trip_id = trip_id
+        entity.trip_update.vehicle.id = f"vehicle_{trip_id}"
+        for index, stop_sequence in enumerate(stop_sequences):
+            stop_time_update = entity.trip_update.stop_time_update.add()
+            if stop_sequence is not None:
+                stop_time_update.stop_sequence = stop_sequence
+            stop_time_update.stop_id = f"{trip_id}_stop_{index}"
+            # some updates only have a departure
+            if index % 2 == 0:
+                stop_time_update.arrival.time = header_timestamp + time_offset + index * 60
+            else:
+                stop_time_update.departure.time = header_timestamp + time_offset + index * 60
+    return message.SerializeToString()
+
+
+def build_trips_performed(payloads, decode_mode):
+    analysis_day = SimpleNamespace(
+        date_str='2024-07-16',
+        quiet=True,
+        observed_trip_times={},
+        schedule_lookup=SimpleNamespace(get_trip_stats=lambda trip_id: None)
+    )
+    builder = TripsPerformedBuilder(analysis_day, {})
+    builder.open()
+    for payload in payloads:
+        header_timestamp, trip_updates = extract_trip_updates(payload, decode_mode)
+        builder.process_snapshot(header_timestamp, trip_updates)
+    return [trip_performed.get_row(analysis_day.date_str) for trip_performed in builder.found_trips.values()]
+
+
+def test_fast_and_full_decode_build_the_same_trips_performed():
+    payloads = [
+        build_trip_updates_payload(HEADER_TIMESTAMP + index * 30, time_offset)
+        for index, time_offset in enumerate([600, 300, 900])
+    ]
+    fast_rows = build_trips_performed(payloads, DECODE_MODE_FAST)
+    assert fast_rows == build_trips_performed(payloads, DECODE_MODE_FULL)
+    assert len(fast_rows) == len(TRIP_STOP_SEQUENCES)
+
+
+def test_fast_decode_keeps_the_last_update_with_the_lowest_and_highest_stop_sequence():
+    header_timestamp, trip_updates = extract_trip_updates(
+        build_trip_updates_payload(HEADER_TIMESTAMP, 0),
+        DECODE_MODE_FAST
+    )
+    stop_ids = {
+        trip_update.trip_id: [stop_time_update[1] for stop_time_update in trip_update.stop_time_updates]
+        for trip_update in trip_updates
+    }
+    assert stop_ids['sorted'] == ['sorted_stop_0', 'sorted_stop_3']
+    assert stop_ids['duplicate_first'] == ['duplicate_first_stop_1', 'duplicate_first_stop_2']
+    assert stop_ids['duplicate_last'] == ['duplicate_last_stop_0', 'duplicate_last_stop_2']
+    assert stop_ids['unsorted'] == ['unsorted_stop_0', 'unsorted_stop_1']
+    assert stop_ids['omitted'] == ['omitted_stop_2']
+    assert stop_ids['single'] == ['single_stop_0']
+    assert stop_ids['no_updates'] == []
+
+
+def test_trip_update_shards_split_the_records_of_a_snapshot():
+    payload = build_trip_updates_payload(HEADER_TIMESTAMP, 0)
+    header_timestamp, trip_updates = extract_trip_updates(payload, DECODE_MODE_FAST)
+    shard_header_timestamp, shards = extract_trip_update_shards(payload, DECODE_MODE_FAST, 3)
+    assert shard_header_timestamp == header_timestamp
+    entity_records = {}
+    for shard_index, (shard_trip_updates, entity_indexes) in enumerate(shards):
+        for trip_update, entity_index in zip(shard_trip_updates, entity_indexes):
+            assert get_trip_shard(trip_update.trip_id, 3) == shard_index
+            entity_records[entity_index] = trip_update
+    assert [entity_records[entity_index] for entity_index in sorted(entity_records)] == trip_updates
+
+
+def test_vehicle_positions_extraction_matches_a_full_decode():
+    message = gtfs_realtime_pb2.FeedMessage()
+    message.header.gtfs_realtime_version = '2.0'
+    message.header.timestamp = HEADER_TIMESTAMP
+    for index in range(5):
+        vehicle = message.entity.add(id=str(index)).vehicle
+        vehicle.vehicle.id = f"vehicle_{index}"
+        # the first vehicle only has an id, the others leave out a different field each
+        if index == 0:
+            continue
+        vehicle.position.latitude = 37.7 + index * 0.01
+        vehicle.position.longitude = -122.4 - index * 0.01
+        if index != 1:
+            vehicle.timestamp = HEADER_TIMESTAMP - index
+        if index != 2:
+            vehicle.position.bearing = index * 10
+            vehicle.position.speed = index * 1.5
+        if index != 3:
+            vehicle.trip.trip_id = f"trip_{index}"
+            vehicle.trip.start_date = '20240716'
+            vehicle.trip.schedule_relationship = gtfs_realtime_pb2.TripDescriptor.ADDED
+        if index != 4:
+            vehicle.current_stop_sequence = index
+            vehicle.stop_id = f"stop_{index}"
+            vehicle.current_status = gtfs_realtime_pb2.VehiclePosition.STOPPED_AT
+    payload = message.SerializeToString()
+
+    decoded = gtfs_realtime_pb2.FeedMessage()
+    decoded.ParseFromString(payload)
+    header_timestamp, vehicle_pings = extract_vehicle_positions(payload)
+    assert header_timestamp == HEADER_TIMESTAMP
+    assert len(vehicle_pings) == len(decoded.entity)
+    for ping, entity in zip(vehicle_pings, decoded.entity):
+        vehicle = entity.vehicle
+        assert ping == (
+            vehicle.vehicle.id,
+            vehicle.timestamp,
+            vehicle.position.latitude,
+            vehicle.position.longitude,
+            vehicle.position.bearing,
+            vehicle.position.speed,
+            vehicle.trip.trip_id,
+            vehicle.trip.start_date,
+            vehicle.trip.schedule_relationship,
+            vehicle.current_stop_sequence,
+            vehicle.stop_id,
+            vehicle.current_status
+        )
+
+
+def test_header_only_decode():
+    payload = build_trip_updates_payload(HEADER_TIMESTAMP, 0)
+    assert read_header_timestamp(payload) == HEADER_TIMESTAMP
+    assert read_header_timestamp(memoryview(payload)) == HEADER_TIMESTAMP
+    assert extract_in_window(extract_trip_updates, HEADER_TIMESTAMP + 1, HEADER_TIMESTAMP + 60, payload) == \
+        (HEADER_TIMESTAMP, None)
+    assert extract_in_window(extract_trip_updates, HEADER_TIMESTAMP, HEADER_TIMESTAMP + 60, payload) == \
+        extract_trip_updates(payload)
@@ -0,0 +1,54 @@
+import os
+
+from google.transit import gtfs_realtime_pb2
+
+from rt_storage import MANIFEST_FILENAME, append_manifest_row, compact_folder, list_snapshots, read_manifest
+
+
+def write_snapshot(folder, filename, header_timestamp, in_manifest=True):
+    message = gtfs_realtime_pb2.FeedMessage()
+    message.header.gtfs_realtime_version = '2.0'
+    message.header.timestamp = header_timestamp
+    content = message.SerializeToString()
+    with open(os.path.join(folder, filename), 'wb') as f:
+        f.write(content)
+    if in_manifest:
+        append_manifest_row(folder, {
+            'filename': filename,
+            'fetch_time': header_timestamp,
+            'header_timestamp': header_timestamp,
+            'size': len(content),
+            'content_hash': '',
+            'entity_count': 0
+        })
+
+
+def test_list_snapshots_includes_files_missing_from_the_manifest(tmp_path):
+    folder = str(tmp_path)
+    # saved before the manifest was started
+    write_snapshot(folder, '1000-old.pb', 1000, in_manifest=False)
+    write_snapshot(folder, '1100-in-window.pb', 1100)
+    write_snapshot(folder, '5000-outside-window.pb', 5000)
+    # its manifest row was lost in a crash
+    write_snapshot(folder, '1200-lost-row.pb', 1200, in_manifest=False)
+
+    names = [os.path.basename(name) for name, source in list_snapshots([folder], 900, 2000)]
+    assert names == ['1000-old.pb', '1100-in-window.pb', '1200-lost-row.pb']
+
+
+def test_compact_folder_keeps_the_manifest_of_leftover_snapshots(tmp_path):
+    folder = str(tmp_path / 'trip_updates_url')
+    os.makedirs(folder)
+    write_snapshot(folder, '1000-a.pb', 1000)
+    write_snapshot(folder, '1100-b.pb', 1100)
+    with open(os.path.join(folder, '1200-unparseable.pb'), 'wb') as f:
+        f.write(b'\xff\xff\xff')
+
+    assert compact_folder(folder) == 2
+    assert sorted(os.listdir(folder)) == ['1200-unparseable.pb', MANIFEST_FILENAME]
+    assert read_manifest(folder) == []
+
+    os.remove(os.path.join(folder, '1200-unparseable.pb'))
+    write_snapshot(folder, '1300-c.pb', 1300)
+    assert compact_folder(folder) == 3
+    assert not os.path.exists(folder)
@@ -0,0 +1,12 @@
+from tides_checkpoint import DayCheckpointer
+
+
+def test_checkpoint_of_another_output_format_is_ignored(tmp_path):
+    checkpoint_path = str(tmp_path / 'checkpoint.pickle')
+    table_names = ['vehicle_locations', 'trips_performed']
+    checkpointer = DayCheckpointer(checkpoint_path, 0, '2024-07-16', table_names, 'csv')
+    checkpointer.complete_folder('vehicle_positions_url')
+
+    assert DayCheckpointer(checkpoint_path, 0, '2024-07-16', table_names, 'parquet').load() is None
+    checkpoint = DayCheckpointer(checkpoint_path, 0, '2024-07-16', table_names, 'csv').load()
+    assert checkpoint['completed_folder_names'] == ['vehicle_positions_url']
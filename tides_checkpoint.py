@@ -0,0 +1,105 @@
+### Periodic checkpoints of a parse_day run that a restarted run resumes from
+
+import logging
+import os
+import pickle
+import time
+
+logger = logging.getLogger(__name__)
+
+# constants
+CHECKPOINT_VERSION = 6
+DEFAULT_CHECKPOINT_INTERVAL_SECONDS = 5 * 60
+
+
+def get_checkpoint_filename(table_names):
+    # runs building different tables of the same date keep separate checkpoints
+    return f"checkpoint-{'-'.join(table_names)}.pickle"
+
+
+class DayCheckpointer:
+    """
+    Saves the progress of building a set of tables for a service date: the url type folders
+    that are finished, the last snapshot processed in the current one and the state of its
+    table builders, including the positions of their output files, and the observed trip times
+    shared between the builders of different url types. Output positions only make sense for the
+    output format they were saved with, so a checkpoint of another format is ignored. An
+    interval of None turns checkpoints off.
+    """
+    def __init__(self, checkpoint_path, interval_seconds, date_str, table_names, output_format,
+                 observed_trip_times=None):
+        self.checkpoint_path = checkpoint_path
+        self.interval_seconds = interval_seconds
+        self.date_str = date_str
+        self.table_names = table_names
+        self.output_format = output_format
+        self.observed_trip_times = {} if observed_trip_times is None else observed_trip_times
+        self.completed_folder_names = []
+        self.last_save_time = time.time()
+
+    def load(self):
+        """
+        Return the saved checkpoint of a previous run of the same tables, or None to start over.
+        """
+        if self.interval_seconds is None or not os.path.exists(self.checkpoint_path):
+            return None
+
+        with open(self.checkpoint_path, 'rb') as f:
+            checkpoint = pickle.load(f)
+        if checkpoint.get('version') != CHECKPOINT_VERSION or checkpoint['date'] != self.date_str or \
+                checkpoint['table_names'] != self.table_names or checkpoint['output_format'] != self.output_format:
+            logger.warning(f"Ignoring checkpoint {self.checkpoint_path} saved by a different kind of run")
+            return None
+
+        logger.info(
+            f"Resuming from checkpoint {self.checkpoint_path}, finished {checkpoint['completed_folder_names']} "
+            f"and {checkpoint['folder_name']} up to {checkpoint['last_snapshot_name']}"
+        )
+        self.completed_folder_names = checkpoint['completed_folder_names']
+        return checkpoint
+
+    def maybe_save(self, folder_name, snapshot_name, builders):
+        if self.interval_seconds is None or time.time() - self.last_save_time < self.interval_seconds:
+            return
+
+        self.save({
+            'version': CHECKPOINT_VERSION,
+            'date': self.date_str,
+            'table_names': self.table_names,
+            'output_format': self.output_format,
+            'completed_folder_names': self.completed_folder_names,
+            'folder_name': folder_name,
+            'last_snapshot_name': snapshot_name,
+            'observed_trip_times': self.observed_trip_times,
+            'builder_states': {builder.table_name: builder.get_checkpoint_state() for builder in builders}
+        })
+
+    def complete_folder(self, folder_name):
+        if self.interval_seconds is None:
+            return
+
+        self.completed_folder_names = self.completed_folder_names + [folder_name]
+        self.save({
+            'version': CHECKPOINT_VERSION,
+            'date': self.date_str,
+            'table_names': self.table_names,
+            'output_format': self.output_format,
+            'completed_folder_names': self.completed_folder_names,
+            'folder_name': None,
+            'last_snapshot_name': None,
+            'observed_trip_times': self.observed_trip_times,
+            'builder_states': {}
+        })
+
+    def save(self, checkpoint):
+        tmp_checkpoint_path = f"{self.checkpoint_path}.tmp"
+        with open(tmp_checkpoint_path, 'wb') as f:
+            pickle.dump(checkpoint, f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_checkpoint_path, self.checkpoint_path)
+        self.last_save_time = time.time()
+
+    def remove(self):
+        if os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
@@ -0,0 +1,581 @@
+### Single pass over the raw GTFS-RT data of a service date that feeds every requested TIDES table
+
+import logging
+import multiprocessing
+import os
+import pickle
+import queue
+import time
+
+from datetime import datetime, timedelta
+from functools import partial
+from zoneinfo import ZoneInfo
+
+import gtfs_kit
+
+from rt_extract import DECODE_MODE_FAST, DECODE_MODE_FULL, DEFAULT_NUM_WORKERS, extract_trip_update_shards, \
+    extract_trip_updates, extract_vehicle_positions, iter_extracted_snapshots
+from metrics import increment, observe, timed, write_metrics
+from rt_storage import list_snapshots, snapshots_exist
+from schedule_cache import DEFAULT_MAX_LOADED_FEEDS, DEFAULT_SCHEDULE_CACHE_FOLDER, \
+    DEFAULT_SCHEDULE_CACHE_MAX_ENTRIES, load_schedule_lookup
+from tides_checkpoint import DEFAULT_CHECKPOINT_INTERVAL_SECONDS, DayCheckpointer, get_checkpoint_filename
+from tides_output import DEFAULT_OUTPUT_BATCH_SIZE, DEFAULT_OUTPUT_FORMAT, get_output_filename, \
+    open_table_writer
+from tides_tables import TRIP_UPDATES_FOLDER_NAME, VEHICLE_POSITIONS_FOLDER_NAME, ObservedStopVisitsBuilder, \
+    StopVisitsBuilder, TripsPerformedBuilder, VehicleLocationsBuilder
+from utils import create_folder
+
+logger = logging.getLogger(__name__)
+
+# constants
+DATE_FORMAT = "%Y-%m-%d"
+ANALYSIS_WINDOW_PADDING = timedelta(hours=2)
+TABLE_BUILDERS = {
+    builder_class.table_name: builder_class
+    for builder_class in [VehicleLocationsBuilder, TripsPerformedBuilder, StopVisitsBuilder, ObservedStopVisitsBuilder]
+}
+# stop visits are only built when asked for, predicted ones need every stop time update decoded
+DEFAULT_TABLES = ['vehicle_locations', 'trips_performed']
+# url type folders in the order they are read
+FOLDER_NAMES = [VEHICLE_POSITIONS_FOLDER_NAME, TRIP_UPDATES_FOLDER_NAME]
+DEFAULT_FOLLOW_POLL_INTERVAL_SECONDS = 20
+DEFAULT_FOLLOW_FLUSH_INTERVAL_SECONDS = 5 * 60
+DEFAULT_NUM_TRIP_UPDATE_SHARDS = 1
+# snapshots queued up for each shard worker
+SHARD_QUEUE_SIZE = 64
+SHARD_WORKER_CHECK_INTERVAL_SECONDS = 1
+
+
+class AnalysisDay:
+    """
+    The schedule, timezone and analysis window of a service date, loaded once and shared by
+    every table builder.
+    """
+    def __init__(self, config):
+        self.raw_data_folder = config['raw_data_path']
+        self.date_str = config['date']
+        self.date_obj = datetime.strptime(self.date_str, DATE_FORMAT)
+        self.tides_output_folder = config['tides_output_folder']
+        self.output_format = config.get('output_format', DEFAULT_OUTPUT_FORMAT)
+        self.output_batch_size = config.get('output_batch_size', DEFAULT_OUTPUT_BATCH_SIZE)
+        # quiet runs don't log or print anything per file, trip or ping
+        self.quiet = config.get('quiet', False)
+
+        # get the trips and start and end time for the analysis date
+        logger.info(f"Loading GTFS Schedule data for {self.date_str}")
+        with timed('schedule_load'):
+            schedule_for_date, self.schedule_lookup = load_schedule_lookup(
+                os.path.join(self.raw_data_folder, self.date_str, 'schedule', 'gtfs.zip'),
+                self.date_str,
+                config.get('schedule_cache_folder', DEFAULT_SCHEDULE_CACHE_FOLDER),
+                config.get('schedule_cache_max_entries', DEFAULT_SCHEDULE_CACHE_MAX_ENTRIES),
+                config.get('keep_schedule_feed_loaded', False),
+                config.get('max_loaded_schedule_feeds', DEFAULT_MAX_LOADED_FEEDS),
+                config.get('max_loaded_schedules', 0)
+            )
+        self.agency_tz = ZoneInfo(schedule_for_date['agency_timezone'])
+        # (departure from the first stop, arrival at the last stop) of each trip seen in the
+        # vehicle positions, filled in by the observed stop visits builder
+        self.observed_trip_times = {}
+        start_seconds = gtfs_kit.timestr_to_seconds(schedule_for_date['start_time'])
+        self.end_seconds = gtfs_kit.timestr_to_seconds(schedule_for_date['end_time'])
+        analysis_start_datetime = self.date_obj + timedelta(seconds=start_seconds) - ANALYSIS_WINDOW_PADDING
+        analysis_start_datetime = analysis_start_datetime.replace(tzinfo=self.agency_tz)
+        self.start_timestamp = analysis_start_datetime.timestamp()
+        analysis_end_datetime = self.date_obj + timedelta(seconds=self.end_seconds) + ANALYSIS_WINDOW_PADDING
+        analysis_end_datetime = analysis_end_datetime.replace(tzinfo=self.agency_tz)
+        self.end_timestamp = analysis_end_datetime.timestamp()
+
+    def get_snapshot_folders(self, folder_name):
+        snapshot_folders = [os.path.join(self.raw_data_folder, self.date_str, folder_name)]
+
+        # add extra days as needed and as available
+        files_end_seconds = 86400
+        while files_end_seconds < self.end_seconds:
+            files_date_obj = self.date_obj + timedelta(seconds=files_end_seconds)
+            cur_date_str = files_date_obj.strftime(DATE_FORMAT)
+            next_dir = os.path.join(self.raw_data_folder, cur_date_str, folder_name)
+            logger.info(f"Also adding some files for {cur_date_str} for late/long trips")
+            if snapshots_exist(next_dir):
+                snapshot_folders.append(next_dir)
+            else:
+                break
+            files_end_seconds += 86400
+
+        return snapshot_folders
+
+    def get_output_path(self, filename):
+        create_folder(os.path.join(self.tides_output_folder, self.date_str))
+        return os.path.join(self.tides_output_folder, self.date_str, filename)
+
+    def open_table_writer(self, table_name, columns, atomic=False, resume_position=None):
+        return open_table_writer(
+            self.get_output_path(get_output_filename(table_name, self.output_format)),
+            columns,
+            self.agency_tz,
+            self.output_format,
+            self.output_batch_size,
+            atomic,
+            resume_position
+        )
+
+
+def get_trip_updates_decode_mode(builders, config):
+    if any(builder.requires_all_stop_time_updates for builder in builders):
+        return DECODE_MODE_FULL
+    return config.get('decode_mode', DECODE_MODE_FAST)
+
+
+def get_extract_func(folder_name, builders, config):
+    if folder_name == VEHICLE_POSITIONS_FOLDER_NAME:
+        return extract_vehicle_positions
+    return partial(extract_trip_updates, decode_mode=get_trip_updates_decode_mode(builders, config))
+
+
+def process_snapshots(analysis_day, snapshots, builders, extract_func, num_workers, checkpointer=None,
+                      folder_name=None):
+    """
+    Decode the given snapshots, in worker processes if configured, and pass the ones inside the
+    analysis window to the builders in order, stopping at the first snapshot after the window.
+    Returns the number of snapshots passed to the builders. If a checkpointer is given, it may
+    save a checkpoint after each snapshot.
+
+    Decode time is the time spent waiting for the next decoded snapshot, which with workers is
+    the part of decoding that isn't hidden behind the builders.
+    """
+    quiet = analysis_day.quiet
+    num_processed_snapshots = 0
+    num_skipped_snapshots = 0
+    num_entities = 0
+    build_seconds = {builder.table_name: 0.0 for builder in builders}
+    decode_start_time = time.perf_counter()
+    extracted_snapshots = iter_extracted_snapshots(
+        snapshots,
+        extract_func,
+        num_workers,
+        analysis_day.start_timestamp,
+        analysis_day.end_timestamp
+    )
+    try:
+        for rt_file, header_timestamp, records in extracted_snapshots:
+            observe('decode', time.perf_counter() - decode_start_time, url_type=folder_name)
+            if not quiet:
+                logger.info(f"Parsing file {rt_file}")
+
+            # determine if message should be analyzed
+            # don't analyze if earlier than analysis start time
+            if header_timestamp < analysis_day.start_timestamp:
+                if not quiet:
+                    logger.info("Skipping file, before start of analysis timeperiod")
+                num_skipped_snapshots += 1
+                decode_start_time = time.perf_counter()
+                continue
+
+            # if after analysis end time, stop analyzing files
+            if header_timestamp > analysis_day.end_timestamp:
+                logger.info("Reached end of analysis timeperiod")
+                num_skipped_snapshots += 1
+                break
+
+            for builder in builders:
+                build_start_time = time.perf_counter()
+                builder.process_snapshot(header_timestamp, records)
+                build_seconds[builder.table_name] += time.perf_counter() - build_start_time
+            num_processed_snapshots += 1
+            num_entities += len(records)
+
+            if checkpointer is not None:
+                checkpointer.maybe_save(folder_name, rt_file, builders)
+            decode_start_time = time.perf_counter()
+    finally:
+        extracted_snapshots.close()
+        # build times are added up locally to keep two lock round trips per builder out of the loop
+        for table_name, seconds in build_seconds.items():
+            observe('build', seconds, table=table_name)
+        increment('snapshots_processed', num_processed_snapshots, url_type=folder_name)
+        increment('snapshots_skipped_outside_window', num_skipped_snapshots, url_type=folder_name)
+        increment('entities_processed', num_entities, url_type=folder_name)
+    return num_processed_snapshots
+
+
+def extract_serialized_trip_update_shards(decode_mode, num_shards, payload):
+    # runs in the decode workers, which pickle the records of each shard so that the parent only
+    # passes bytes on to the shard workers
+    header_timestamp, shards = extract_trip_update_shards(payload, decode_mode, num_shards)
+    return header_timestamp, [pickle.dumps(shard, protocol=pickle.HIGHEST_PROTOCOL) for shard in shards]
+
+
+def build_trip_update_shard(analysis_day, config, table_names, shard_index, shard_queue, result_queue):
+    """
+    Runs in a shard worker process. Build the given tables from the (snapshot number, header
+    timestamp, pickled records and entity indexes) items of the shard queue until it gets None.
+    Then put the position of the first update of each trip of the shard as a (snapshot number,
+    entity index) tuple, the state of each builder, the number of trip updates and the build
+    time of each table on the result queue, or None if building failed.
+    """
+    try:
+        builders = [TABLE_BUILDERS[table_name](analysis_day, config) for table_name in table_names]
+        for builder in builders:
+            builder.open()
+
+        first_update_positions = {}
+        num_entities = 0
+        build_seconds = {table_name: 0.0 for table_name in table_names}
+        while True:
+            item = shard_queue.get()
+            if item is None:
+                break
+            snapshot_number, header_timestamp, serialized_shard = item
+            trip_updates, entity_indexes = pickle.loads(serialized_shard)
+
+            for trip_update, entity_index in zip(trip_updates, entity_indexes):
+                if trip_update.trip_id not in first_update_positions:
+                    first_update_positions[trip_update.trip_id] = (snapshot_number, entity_index)
+            for builder in builders:
+                build_start_time = time.perf_counter()
+                builder.process_snapshot(header_timestamp, trip_updates)
+                build_seconds[builder.table_name] += time.perf_counter() - build_start_time
+            num_entities += len(trip_updates)
+
+        builder_states = {builder.table_name: builder.get_checkpoint_state() for builder in builders}
+        result_queue.put((shard_index, (first_update_positions, builder_states, num_entities, build_seconds)))
+    except Exception:
+        logger.exception(f"Failed to build trip updates shard {shard_index}")
+        result_queue.put((shard_index, None))
+
+
+def put_shard_item(shard_queue, shard_process, item):
+    # a shard worker that died would otherwise leave the parent waiting on its full queue forever
+    while True:
+        try:
+            shard_queue.put(item, timeout=SHARD_WORKER_CHECK_INTERVAL_SECONDS)
+            return
+        except queue.Full:
+            if not shard_process.is_alive():
+                raise RuntimeError(
+                    f"{shard_process.name} stopped with exit code {shard_process.exitcode} before the end of the "
+                    f"snapshots, see its logged error"
+                )
+
+
+def get_shard_results(result_queue, shard_processes):
+    shard_results = [None] * len(shard_processes)
+    for _ in shard_processes:
+        while True:
+            try:
+                shard_index, shard_result = result_queue.get(timeout=SHARD_WORKER_CHECK_INTERVAL_SECONDS)
+                break
+            except queue.Empty:
+                for shard_index, shard_process in enumerate(shard_processes):
+                    if shard_results[shard_index] is None and not shard_process.is_alive():
+                        raise RuntimeError(f"{shard_process.name} exited with code {shard_process.exitcode}")
+        if shard_result is None:
+            raise RuntimeError(f"{shard_processes[shard_index].name} failed")
+        shard_results[shard_index] = shard_result
+    return shard_results
+
+
+def process_sharded_snapshots(analysis_day, snapshots, builders, config, num_shards, folder_name):
+    """
+    Build the tables of trip updates builders with a worker process for each of `num_shards`
+    shards of the trips, by hash of their trip id. Each snapshot is decoded once, in the decode
+    workers if configured, and the trip updates of each shard are passed on in order to its
+    worker, which owns the aggregation state of the shard's trips. The builders are then opened
+    with their merged states, with the trips in the order a serial run finds them, so they write
+    the same output. Returns the number of snapshots passed to the builders.
+
+    Build time is summed over the shard workers. Decode time is the time spent waiting for the
+    next decoded snapshot, as in process_snapshots.
+    """
+    quiet = analysis_day.quiet
+    table_names = [builder.table_name for builder in builders]
+    decode_mode = get_trip_updates_decode_mode(builders, config)
+    logger.info(f"Building {table_names} from {len(snapshots)} files in {num_shards} trip id shards")
+
+    result_queue = multiprocessing.Queue()
+    shard_queues = [multiprocessing.Queue(SHARD_QUEUE_SIZE) for _ in range(num_shards)]
+    shard_processes = [
+        multiprocessing.Process(
+            target=build_trip_update_shard,
+            args=(analysis_day, config, table_names, shard_index, shard_queues[shard_index], result_queue),
+            name=f"Trip updates shard worker {shard_index}"
+        )
+        for shard_index in range(num_shards)
+    ]
+    for shard_process in shard_processes:
+        shard_process.start()
+
+    num_processed_snapshots = 0
+    num_skipped_snapshots = 0
+    decode_start_time = time.perf_counter()
+    extracted_snapshots = iter_extracted_snapshots(
+        snapshots,
+        partial(extract_serialized_trip_update_shards, decode_mode, num_shards),
+        config.get('num_workers', DEFAULT_NUM_WORKERS),
+        analysis_day.start_timestamp,
+        analysis_day.end_timestamp
+    )
+    try:
+        for snapshot_number, (rt_file, header_timestamp, serialized_shards) in enumerate(extracted_snapshots):
+            observe('decode', time.perf_counter() - decode_start_time, url_type=folder_name)
+            if not quiet:
+                logger.info(f"Parsing file {rt_file}")
+
+            # the same window checks as process_snapshots
+            if header_timestamp < analysis_day.start_timestamp:
+                if not quiet:
+                    logger.info("Skipping file, before start of analysis timeperiod")
+                num_skipped_snapshots += 1
+                decode_start_time = time.perf_counter()
+                continue
+            if header_timestamp > analysis_day.end_timestamp:
+                logger.info("Reached end of analysis timeperiod")
+                num_skipped_snapshots += 1
+                break
+
+            # every shard gets every snapshot, so their builders see the same header timestamps
+            for shard_index, serialized_shard in enumerate(serialized_shards):
+                put_shard_item(
+                    shard_queues[shard_index],
+                    shard_processes[shard_index],
+                    (snapshot_number, header_timestamp, serialized_shard)
+                )
+            num_processed_snapshots += 1
+            decode_start_time = time.perf_counter()
+
+        for shard_queue, shard_process in zip(shard_queues, shard_processes):
+            put_shard_item(shard_queue, shard_process, None)
+        shard_results = get_shard_results(result_queue, shard_processes)
+    except BaseException:
+        for shard_process in shard_processes:
+            shard_process.terminate()
+        raise
+    finally:
+        extracted_snapshots.close()
+        for shard_process in shard_processes:
+            shard_process.join()
+
+    first_update_positions = {}
+    for shard_first_update_positions, _, _, _ in shard_results:
+        first_update_positions.update(shard_first_update_positions)
+    trip_ids = sorted(first_update_positions, key=first_update_positions.get)
+    for builder in builders:
+        builder.open(builder.merge_shard_states(
+            [builder_states[builder.table_name] for _, builder_states, _, _ in shard_results],
+            trip_ids
+        ))
+
+    for table_name in table_names:
+        observe('build', sum(shard_result[3][table_name] for shard_result in shard_results), table=table_name)
+    increment('snapshots_processed', num_processed_snapshots, url_type=folder_name)
+    increment('snapshots_skipped_outside_window', num_skipped_snapshots, url_type=folder_name)
+    increment('entities_processed', sum(shard_result[2] for shard_result in shard_results), url_type=folder_name)
+    return num_processed_snapshots
+
+
+def stream_folder(analysis_day, folder_name, builders, config, checkpointer=None, checkpoint=None):
+    # iterate through downloaded raw GTFS-RT data of one url type for the analysis date
+    logger.info(f"queueing up {folder_name} files for analysis date")
+
+    # use the segment indexes and downloader's manifests where available to only queue files in
+    # the analysis window
+    with timed('listing', url_type=folder_name):
+        snapshots = list_snapshots(
+            analysis_day.get_snapshot_folders(folder_name),
+            analysis_day.start_timestamp,
+            analysis_day.end_timestamp
+        )
+
+    num_shards = config.get('num_trip_update_shards', DEFAULT_NUM_TRIP_UPDATE_SHARDS)
+    if folder_name == TRIP_UPDATES_FOLDER_NAME and num_shards > 1 and checkpoint is None and \
+            all(builder.can_shard() for builder in builders):
+        # the state of the builders is spread over the shard workers, so this isn't checkpointed
+        num_processed_snapshots = process_sharded_snapshots(
+            analysis_day,
+            snapshots,
+            builders,
+            config,
+            num_shards,
+            folder_name
+        )
+    else:
+        if checkpoint is None:
+            for builder in builders:
+                builder.open()
+        else:
+            # snapshots are listed in name order, so continue after the last checkpointed one
+            snapshots = [
+                (name, source) for name, source in snapshots if name > checkpoint['last_snapshot_name']
+            ]
+            for builder in builders:
+                builder.open(checkpoint['builder_states'][builder.table_name])
+
+        num_processed_snapshots = process_snapshots(
+            analysis_day,
+            snapshots,
+            builders,
+            get_extract_func(folder_name, builders, config),
+            config.get('num_workers', DEFAULT_NUM_WORKERS),
+            checkpointer,
+            folder_name
+        )
+
+    for builder in builders:
+        with timed('write', table=builder.table_name):
+            builder.close()
+    return num_processed_snapshots
+
+
+def get_table_builders(analysis_day, config, table_names):
+    if table_names is None:
+        table_names = config.get('tables', DEFAULT_TABLES)
+    unknown_table_names = [table_name for table_name in table_names if table_name not in TABLE_BUILDERS]
+    if len(unknown_table_names) > 0:
+        raise ValueError(f"Unknown TIDES tables {unknown_table_names}, expected some of {list(TABLE_BUILDERS)}")
+    return [TABLE_BUILDERS[table_name](analysis_day, config) for table_name in table_names]
+
+
+def parse_day(config, table_names=None):
+    """
+    Build the given TIDES tables for the service date of a parser config. The schedule is loaded
+    once and each url type's snapshots are read and decoded once for all the tables built from
+    them. Progress is checkpointed every `checkpoint_interval_seconds` and a run of the same
+    tables that was interrupted is resumed from its last checkpoint. Returns the number of
+    snapshots processed.
+    """
+    analysis_day = AnalysisDay(config)
+    builders = get_table_builders(analysis_day, config, table_names)
+    built_table_names = [builder.table_name for builder in builders]
+    checkpointer = DayCheckpointer(
+        analysis_day.get_output_path(get_checkpoint_filename(built_table_names)),
+        config.get('checkpoint_interval_seconds', DEFAULT_CHECKPOINT_INTERVAL_SECONDS),
+        analysis_day.date_str,
+        built_table_names,
+        analysis_day.output_format,
+        analysis_day.observed_trip_times
+    )
+    checkpoint = checkpointer.load()
+    if checkpoint is not None:
+        analysis_day.observed_trip_times.update(checkpoint['observed_trip_times'])
+
+    num_processed_snapshots = 0
+    for folder_name in FOLDER_NAMES:
+        folder_builders = [builder for builder in builders if builder.folder_name == folder_name]
+        if len(folder_builders) == 0:
+            continue
+        if checkpoint is not None and folder_name in checkpoint['completed_folder_names']:
+            logger.info(f"Skipping {folder_name} files, their tables were finished before the checkpoint")
+            continue
+
+        folder_checkpoint = None
+        if checkpoint is not None and checkpoint['folder_name'] == folder_name:
+            folder_checkpoint = checkpoint
+        num_processed_snapshots += stream_folder(
+            analysis_day,
+            folder_name,
+            folder_builders,
+            config,
+            checkpointer,
+            folder_checkpoint
+        )
+        checkpointer.complete_folder(folder_name)
+
+    checkpointer.remove()
+    return num_processed_snapshots
+
+
+class FollowedFolder:
+    """
+    The snapshots of one url type that a followed analysis day has already processed.
+    """
+    def __init__(self, analysis_day, folder_name, builders, config):
+        self.analysis_day = analysis_day
+        self.folder_name = folder_name
+        self.builders = builders
+        self.extract_func = get_extract_func(folder_name, builders, config)
+        self.num_workers = config.get('num_workers', DEFAULT_NUM_WORKERS)
+        self.processed_names = set()
+
+    def process_new_snapshots(self):
+        analysis_day = self.analysis_day
+
+        # the folders of the date and the next one are created by the downloader as it goes
+        snapshot_folders = [
+            folder for folder in analysis_day.get_snapshot_folders(self.folder_name) if snapshots_exist(folder)
+        ]
+        with timed('listing', url_type=self.folder_name):
+            new_snapshots = [
+                (name, source)
+                for name, source in list_snapshots(
+                    snapshot_folders,
+                    analysis_day.start_timestamp,
+                    analysis_day.end_timestamp
+                )
+                if name not in self.processed_names
+            ]
+        if len(new_snapshots) == 0:
+            return
+
+        logger.info(f"Found {len(new_snapshots)} new {self.folder_name} files")
+        process_snapshots(
+            analysis_day,
+            new_snapshots,
+            self.builders,
+            self.extract_func,
+            self.num_workers,
+            folder_name=self.folder_name
+        )
+        self.processed_names.update(name for name, source in new_snapshots)
+
+
+def follow_day(config, table_names=None):
+    """
+    Build the given TIDES tables for a service date while the downloader is still saving its
+    snapshots. New snapshots are applied to the builders as they show up, partial output is
+    written every `flush_interval_seconds` and the final output is written once the analysis
+    window has ended and its last snapshots have been processed.
+    """
+    poll_interval_seconds = config.get('poll_interval_seconds', DEFAULT_FOLLOW_POLL_INTERVAL_SECONDS)
+    flush_interval_seconds = config.get('flush_interval_seconds', DEFAULT_FOLLOW_FLUSH_INTERVAL_SECONDS)
+
+    analysis_day = AnalysisDay(config)
+    builders = get_table_builders(analysis_day, config, table_names)
+    built_table_names = [builder.table_name for builder in builders]
+    if 'observed_stop_visits' in built_table_names and 'trips_performed' in built_table_names and \
+            config.get('completed_trip_flush_delay_seconds') is not None:
+        # the observed trip times are only known once the observed stop visits are written at the
+        # end, so trips written before that would miss them
+        logger.warning('Not writing completed trips early, as observed stop visits are built alongside them')
+        config = dict(config, completed_trip_flush_delay_seconds=None)
+        builders = get_table_builders(analysis_day, config, table_names)
+    followed_folders = []
+    for folder_name in FOLDER_NAMES:
+        folder_builders = [builder for builder in builders if builder.folder_name == folder_name]
+        if len(folder_builders) > 0:
+            followed_folders.append(FollowedFolder(analysis_day, folder_name, folder_builders, config))
+
+    for builder in builders:
+        builder.open()
+
+    last_flush_time = time.time()
+    while True:
+        # check before polling so the last poll picks up every snapshot of the window
+        window_ended = time.time() > analysis_day.end_timestamp
+        for followed_folder in followed_folders:
+            followed_folder.process_new_snapshots()
+        if window_ended:
+            break
+
+        if time.time() - last_flush_time >= flush_interval_seconds:
+            logger.info('Writing partial TIDES data')
+            for builder in builders:
+                builder.flush()
+            write_metrics(config)
+            last_flush_time = time.time()
+
+        time.sleep(poll_interval_seconds)
+
+    for builder in builders:
+        with timed('write', table=builder.table_name):
+            builder.close()
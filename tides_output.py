@@ -0,0 +1,306 @@
+### Batched writers of TIDES tables to CSV, Parquet or Arrow IPC files
+
+import csv
+import logging
+import os
+
+from datetime import datetime
+
+import numpy
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+from metrics import increment
+
+logger = logging.getLogger(__name__)
+
+# constants
+OUTPUT_FORMAT_CSV = 'csv'
+OUTPUT_FORMAT_PARQUET = 'parquet'
+OUTPUT_FORMAT_ARROW = 'arrow'
+OUTPUT_FORMATS = [OUTPUT_FORMAT_CSV, OUTPUT_FORMAT_PARQUET, OUTPUT_FORMAT_ARROW]
+DEFAULT_OUTPUT_FORMAT = OUTPUT_FORMAT_CSV
+DEFAULT_OUTPUT_BATCH_SIZE = 64 * 1024
+
+# column types. Timestamps are given to the writers as epoch seconds and dates as YYYY-MM-DD
+# strings, None or '' is a missing value.
+COLUMN_TYPE_STRING = 'string'
+COLUMN_TYPE_INT = 'int'
+COLUMN_TYPE_FLOAT = 'float'
+COLUMN_TYPE_DATE = 'date'
+COLUMN_TYPE_TIMESTAMP = 'timestamp'
+# UTC offsets of timestamps are looked up once for each hour of epoch time
+OFFSET_CACHE_BUCKET_SECONDS = 3600
+
+
+def get_output_filename(table_name, output_format):
+    return f"{table_name}.{output_format}"
+
+
+def get_write_path(path, atomic):
+    # atomic writers write to a temporary file that replaces the output once closed, so readers
+    # never see a partly written table
+    if atomic:
+        return f"{path}.tmp"
+    return path
+
+
+def finish_write(path, atomic):
+    if atomic:
+        os.replace(get_write_path(path, atomic), path)
+
+
+def get_part_path(path, part_number):
+    return f"{path}.part{part_number}"
+
+
+class TimestampFormatter:
+    """
+    Formats epoch seconds as ISO 8601 strings in a timezone, like
+    datetime.fromtimestamp(timestamp, tz).isoformat(), converting whole lists of timestamps at
+    once. The UTC offset of each hour is looked up once and cached across batches. Timestamps in
+    an hour that has a DST transition in it are converted one by one.
+    """
+    def __init__(self, tz):
+        self.tz = tz
+        # hour bucket to the (offset seconds, offset suffix) of the hour, None if it changes
+        self.bucket_offsets = {}
+
+    def get_bucket_offset(self, bucket):
+        bucket_offset = self.bucket_offsets.get(bucket, False)
+        if bucket_offset is not False:
+            return bucket_offset
+
+        bucket_start = bucket * OFFSET_CACHE_BUCKET_SECONDS
+        start_datetime = datetime.fromtimestamp(bucket_start, tz=self.tz)
+        end_datetime = datetime.fromtimestamp(bucket_start + OFFSET_CACHE_BUCKET_SECONDS - 1, tz=self.tz)
+        if start_datetime.utcoffset() != end_datetime.utcoffset():
+            bucket_offset = None
+        else:
+            # the suffix isoformat gives the offset, e.g. -07:00
+            bucket_offset = (
+                int(start_datetime.utcoffset().total_seconds()),
+                start_datetime.isoformat()[len('YYYY-MM-DDTHH:MM:SS'):]
+            )
+        self.bucket_offsets[bucket] = bucket_offset
+        return bucket_offset
+
+    def format(self, timestamps):
+        if len(timestamps) == 0:
+            return []
+
+        timestamps = numpy.asarray(timestamps, dtype=numpy.int64)
+        buckets, bucket_indexes = numpy.unique(timestamps // OFFSET_CACHE_BUCKET_SECONDS, return_inverse=True)
+        bucket_offsets = [self.get_bucket_offset(int(bucket)) for bucket in buckets]
+        offsets = numpy.array([offset[0] if offset else 0 for offset in bucket_offsets], dtype=numpy.int64)
+        suffixes = numpy.array([offset[1] if offset else '' for offset in bucket_offsets])
+
+        local_datetimes = (timestamps + offsets[bucket_indexes]).astype('datetime64[s]')
+        formatted = numpy.char.add(numpy.datetime_as_string(local_datetimes), suffixes[bucket_indexes]).tolist()
+        if None in bucket_offsets:
+            for index, bucket_index in enumerate(bucket_indexes):
+                if bucket_offsets[bucket_index] is None:
+                    formatted[index] = datetime.fromtimestamp(int(timestamps[index]), tz=self.tz).isoformat()
+        return formatted
+
+
+class CsvTableWriter:
+    """
+    Writes rows to a CSV file in batches, formatting the timestamps of each batch as ISO 8601
+    strings in the agency timezone. A writer resumed from a checkpoint position truncates the
+    file back to it and appends from there.
+    """
+    def __init__(self, path, columns, agency_tz, batch_size=DEFAULT_OUTPUT_BATCH_SIZE, atomic=False,
+                 resume_position=None):
+        self.path = path
+        self.filename = os.path.basename(path)
+        self.atomic = atomic
+        self.timestamp_formatter = TimestampFormatter(agency_tz)
+        self.batch_size = batch_size
+        self.timestamp_indexes = [
+            index for index, (name, column_type) in enumerate(columns) if column_type == COLUMN_TYPE_TIMESTAMP
+        ]
+        self.rows = []
+        if resume_position is None:
+            self.file = open(get_write_path(path, atomic), mode='w', newline='')
+            self.writer = csv.writer(self.file)
+            self.writer.writerow([name for name, column_type in columns])
+        else:
+            self.file = open(get_write_path(path, atomic), mode='r+', newline='')
+            self.file.seek(resume_position)
+            self.file.truncate()
+            self.writer = csv.writer(self.file)
+
+    def write_row(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        # timestamps are only formatted here, a column of a whole batch at a time
+        rows = self.rows
+        for index in self.timestamp_indexes:
+            row_numbers = [
+                row_number for row_number, row in enumerate(rows) if row[index] is not None and row[index] != ''
+            ]
+            formatted_timestamps = self.timestamp_formatter.format(
+                [rows[row_number][index] for row_number in row_numbers]
+            )
+            for row_number, formatted_timestamp in zip(row_numbers, formatted_timestamps):
+                rows[row_number][index] = formatted_timestamp
+        self.writer.writerows(rows)
+        increment('rows_written', len(self.rows), file=self.filename)
+        self.rows = []
+        self.file.flush()
+
+    def checkpoint(self):
+        # make the rows written so far durable and return the position to resume from
+        self.flush()
+        os.fsync(self.file.fileno())
+        return self.file.tell()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+        finish_write(self.path, self.atomic)
+
+
+class ArrowTableWriter:
+    """
+    Accumulates rows in typed columns and writes them as record batches to a Parquet or Arrow
+    IPC file. Timestamps are stored as timezone-aware timestamps in the agency timezone.
+
+    These files can't be appended to once closed, so each checkpoint closes the current part
+    file and starts a new one. Closing the writer rewrites the row groups of every part into
+    the output file, and a writer resumed from a checkpoint keeps the parts completed by then.
+    """
+    def __init__(self, path, columns, agency_tz, output_format, batch_size=DEFAULT_OUTPUT_BATCH_SIZE,
+                 atomic=False, resume_position=None):
+        if pyarrow is None:
+            raise ImportError(f"pyarrow is required to write {output_format} output, install it with pip")
+
+        self.path = path
+        self.filename = os.path.basename(path)
+        self.atomic = atomic
+        self.output_format = output_format
+        self.batch_size = batch_size
+        self.column_types = [column_type for name, column_type in columns]
+        self.schema = pyarrow.schema([
+            (name, self.get_arrow_type(column_type, agency_tz)) for name, column_type in columns
+        ])
+        self.column_values = [[] for _ in columns]
+        self.num_rows = 0
+
+        # remove parts written after the checkpoint that is resumed from
+        self.num_parts = resume_position or 0
+        stale_part_number = self.num_parts
+        while os.path.exists(get_part_path(path, stale_part_number)):
+            os.remove(get_part_path(path, stale_part_number))
+            stale_part_number += 1
+        self.writer = self.open_file(get_part_path(path, self.num_parts))
+
+    def open_file(self, file_path):
+        if self.output_format == OUTPUT_FORMAT_PARQUET:
+            return pyarrow.parquet.ParquetWriter(file_path, self.schema)
+        return pyarrow.ipc.new_file(file_path, self.schema)
+
+    def iter_part_batches(self, part_path):
+        if self.output_format == OUTPUT_FORMAT_PARQUET:
+            parquet_file = pyarrow.parquet.ParquetFile(part_path)
+            for row_group_index in range(parquet_file.num_row_groups):
+                # parquet stores second timestamps as milliseconds
+                yield parquet_file.read_row_group(row_group_index).cast(self.schema)
+        else:
+            with pyarrow.ipc.open_file(part_path) as reader:
+                for batch_index in range(reader.num_record_batches):
+                    yield reader.get_batch(batch_index)
+
+    @staticmethod
+    def get_arrow_type(column_type, agency_tz):
+        if column_type == COLUMN_TYPE_TIMESTAMP:
+            return pyarrow.timestamp('s', tz=agency_tz.key)
+        return {
+            COLUMN_TYPE_STRING: pyarrow.string(),
+            COLUMN_TYPE_INT: pyarrow.int64(),
+            COLUMN_TYPE_FLOAT: pyarrow.float64(),
+            COLUMN_TYPE_DATE: pyarrow.date32()
+        }[column_type]
+
+    def write_row(self, row):
+        for values, value in zip(self.column_values, row):
+            values.append(value)
+        self.num_rows += 1
+        if self.num_rows >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.num_rows == 0:
+            return
+
+        arrays = []
+        for values, column_type, field in zip(self.column_values, self.column_types, self.schema):
+            # missing values also include NaNs of schedule fields that are blank in the GTFS
+            values = [None if value == '' or value != value else value for value in values]
+            if column_type == COLUMN_TYPE_DATE:
+                arrays.append(pyarrow.array(values, type=pyarrow.string()).cast(field.type))
+            elif column_type == COLUMN_TYPE_STRING:
+                arrays.append(pyarrow.array(
+                    [value if value is None else str(value) for value in values],
+                    type=field.type
+                ))
+            else:
+                arrays.append(pyarrow.array(values, type=field.type))
+        self.writer.write_batch(pyarrow.record_batch(arrays, schema=self.schema))
+        increment('rows_written', self.num_rows, file=self.filename)
+
+        self.column_values = [[] for _ in self.column_values]
+        self.num_rows = 0
+
+    def checkpoint(self):
+        # complete the current part and return the number of completed parts to resume from
+        self.flush()
+        self.writer.close()
+        self.num_parts += 1
+        self.writer = self.open_file(get_part_path(self.path, self.num_parts))
+        return self.num_parts
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+        part_paths = [get_part_path(self.path, part_number) for part_number in range(self.num_parts + 1)]
+        if len(part_paths) == 1:
+            os.replace(part_paths[0], get_write_path(self.path, self.atomic))
+        else:
+            writer = self.open_file(get_write_path(self.path, self.atomic))
+            for part_path in part_paths:
+                for batch in self.iter_part_batches(part_path):
+                    if self.output_format == OUTPUT_FORMAT_PARQUET:
+                        writer.write_table(batch)
+                    else:
+                        writer.write_batch(batch)
+            writer.close()
+            for part_path in part_paths:
+                os.remove(part_path)
+        finish_write(self.path, self.atomic)
+
+
+def open_table_writer(path, columns, agency_tz, output_format=DEFAULT_OUTPUT_FORMAT,
+                      batch_size=DEFAULT_OUTPUT_BATCH_SIZE, atomic=False, resume_position=None):
+    """
+    Open a writer for a table with the given (name, column type) columns. Rows are lists of
+    values in column order passed to write_row and the writer must be closed to write the last
+    batch. Flushing a CSV writer makes the rows written so far readable, Parquet and Arrow files
+    can only be read once closed. Atomic writers only replace the file at `path` when closed.
+    checkpoint() returns a position that a later writer can be resumed from with
+    `resume_position`, dropping anything written after it.
+    """
+    if output_format == OUTPUT_FORMAT_CSV:
+        return CsvTableWriter(path, columns, agency_tz, batch_size, atomic, resume_position)
+    if output_format in (OUTPUT_FORMAT_PARQUET, OUTPUT_FORMAT_ARROW):
+        return ArrowTableWriter(path, columns, agency_tz, output_format, batch_size, atomic, resume_position)
+    raise ValueError(f"Unknown output format {output_format}, expected one of {OUTPUT_FORMATS}")
@@ -0,0 +1,835 @@
+### Builders of the TIDES tables that tides_engine feeds with the records extracted from each
+# snapshot of a service date
+
+import logging
+
+from bisect import bisect_left
+from datetime import timedelta
+
+import gtfs_kit
+
+from google.transit import gtfs_realtime_pb2
+
+from metrics import increment, timed
+from ping_dedupe import DEFAULT_PING_DEDUPE_WINDOW_SECONDS, PingDeduplicator
+from stop_index import DEFAULT_STOP_MATCH_RADIUS_METERS
+from tides_output import COLUMN_TYPE_DATE, COLUMN_TYPE_FLOAT, COLUMN_TYPE_INT, COLUMN_TYPE_STRING, \
+    COLUMN_TYPE_TIMESTAMP
+
+logger = logging.getLogger(__name__)
+
+# constants
+VEHICLE_POSITIONS_FOLDER_NAME = 'vehicle_positions_url'
+TRIP_UPDATES_FOLDER_NAME = 'trip_updates_url'
+VEHICLE_LOCATIONS_COLUMNS = [
+    ('location_ping', COLUMN_TYPE_STRING),
+    ('service_date', COLUMN_TYPE_DATE),
+    ('event_timestamp', COLUMN_TYPE_TIMESTAMP),
+    ('trip_id_performed', COLUMN_TYPE_STRING),
+    ('trip_id_scheduled', COLUMN_TYPE_STRING),
+    ('trip_stop_sequence', COLUMN_TYPE_INT),
+    ('scheduled_stop_sequence', COLUMN_TYPE_INT),
+    ('vehicle_id', COLUMN_TYPE_STRING),
+    ('stop_id', COLUMN_TYPE_STRING),
+    ('current_status', COLUMN_TYPE_INT),
+    ('latitude', COLUMN_TYPE_FLOAT),
+    ('longitude', COLUMN_TYPE_FLOAT),
+    ('heading', COLUMN_TYPE_FLOAT),
+    ('speed', COLUMN_TYPE_FLOAT),
+    ('schedule_relationship', COLUMN_TYPE_INT)
+]
+VEHICLE_LOCATIONS_HEADER = [name for name, column_type in VEHICLE_LOCATIONS_COLUMNS]
+TRIPS_PERFORMED_COLUMNS = [
+    ('service_date', COLUMN_TYPE_DATE),
+    ('trip_id_performed', COLUMN_TYPE_STRING),
+    ('vehicle_id', COLUMN_TYPE_STRING),
+    ('trip_id_scheduled', COLUMN_TYPE_STRING),
+    ('route_id', COLUMN_TYPE_STRING),
+    ('shape_id', COLUMN_TYPE_STRING),
+    ('block_id', COLUMN_TYPE_STRING),
+    ('trip_start_stop_id', COLUMN_TYPE_STRING),
+    ('trip_end_stop_id', COLUMN_TYPE_STRING),
+    ('schedule_trip_start', COLUMN_TYPE_TIMESTAMP),
+    ('schedule_trip_end', COLUMN_TYPE_TIMESTAMP),
+    ('actual_trip_start', COLUMN_TYPE_TIMESTAMP),
+    ('actual_trip_end', COLUMN_TYPE_TIMESTAMP),
+    ('trip_type', COLUMN_TYPE_STRING),
+    ('schedule_relationship', COLUMN_TYPE_STRING)
+]
+TRIPS_PERFORMED_HEADER = [name for name, column_type in TRIPS_PERFORMED_COLUMNS]
+STOP_VISITS_COLUMNS = [
+    ('service_date', COLUMN_TYPE_DATE),
+    ('trip_id_performed', COLUMN_TYPE_STRING),
+    ('trip_stop_sequence', COLUMN_TYPE_INT),
+    ('scheduled_stop_sequence', COLUMN_TYPE_INT),
+    ('vehicle_id', COLUMN_TYPE_STRING),
+    ('dwell', COLUMN_TYPE_INT),
+    ('stop_id', COLUMN_TYPE_STRING),
+    ('actual_arrival_time', COLUMN_TYPE_TIMESTAMP),
+    ('actual_departure_time', COLUMN_TYPE_TIMESTAMP),
+    ('schedule_relationship', COLUMN_TYPE_STRING)
+]
+STOP_VISITS_HEADER = [name for name, column_type in STOP_VISITS_COLUMNS]
+TRIP_SCHEDULE_RELATIONSHIP_NAMES = {
+    value: name.capitalize() for name, value in gtfs_realtime_pb2.TripDescriptor.ScheduleRelationship.items()
+}
+TRIP_SCHEDULE_RELATIONSHIP_CANCELED = gtfs_realtime_pb2.TripDescriptor.ScheduleRelationship.Value('CANCELED')
+# number of vehicle positions matched to stops at a time
+STOP_MATCH_BATCH_SIZE = 64 * 1024
+# seconds of feed time between looks for completed trips to write early
+COMPLETED_TRIPS_CHECK_INTERVAL_SECONDS = 5 * 60
+STOP_SCHEDULE_RELATIONSHIP_SKIPPED = gtfs_realtime_pb2.TripUpdate.StopTimeUpdate.ScheduleRelationship.Value('SKIPPED')
+
+
+def gtfs_to_datetime(date_obj, gtfs_time, tz):
+    dt = date_obj + timedelta(seconds=gtfs_kit.timestr_to_seconds(gtfs_time))
+    dt = dt.replace(tzinfo=tz)
+    return dt
+
+
+def gtfs_to_timestamp(date_obj, gtfs_time, tz):
+    return int(gtfs_to_datetime(date_obj, gtfs_time, tz).timestamp())
+
+
+class TableBuilder:
+    """
+    Builds one TIDES table of a service date. The engine opens every builder of the url type
+    folder it is reading, passes it the records of each snapshot inside the analysis window in
+    file order and closes it once the window has been read. A builder opened with the state it
+    returned from get_checkpoint_state continues from that point.
+    """
+    table_name = None
+    folder_name = None
+    # trip updates builders that need every stop time update instead of just the first and last
+    requires_all_stop_time_updates = False
+
+    def __init__(self, analysis_day, config):
+        self.analysis_day = analysis_day
+        self.config = config
+
+    def open(self, checkpoint_state=None):
+        pass
+
+    def process_snapshot(self, header_timestamp, records):
+        raise NotImplementedError
+
+    def get_checkpoint_state(self):
+        # a picklable snapshot of everything needed to continue building the table
+        return None
+
+    def flush(self):
+        # write the output built so far, while snapshots are still being added
+        pass
+
+    def close(self):
+        pass
+
+    def can_shard(self):
+        # whether the table can be built by separate builders for the trips of each trip id shard
+        return False
+
+    def merge_shard_states(self, shard_states, trip_ids):
+        """
+        Return the checkpoint state of a builder that processed every snapshot, from the states
+        of builders that processed the trips of one shard each. `trip_ids` are all the trips in
+        the order they were first seen.
+        """
+        raise NotImplementedError
+
+
+def generate_vehicle_ping_id(ping):
+    try:
+        return (
+            f"id:{ping.vehicle_id}_position:{ping.latitude},{ping.longitude}-"
+            f"{ping.bearing}-{ping.speed}_T{ping.timestamp}"
+        )
+    except Exception as e:
+        logger.warning(f"Skipping ping that an id couldn't be generated for: {ping} ({e})")
+        return None
+
+
+def write_vehicle_location_row(analysis_date_str, writer, ping_id, ping, schedule_lookup):
+    # create default values for trip-less ping
+    service_date = ''
+    trip_id_performed = ''
+    trip_id_scheduled = ''
+    trip_stop_sequence = ''
+    scheduled_stop_sequence = ''
+    stop_id = ''
+    current_status = ''
+    schedule_relationship = ''
+
+    # check for trip
+    trip_id = ping.trip_id
+    if trip_id != '':
+        service_date = analysis_date_str
+        trip_id_performed = trip_id
+        trip_stop_sequence = ping.current_stop_sequence
+        stop_id = ping.stop_id
+        current_status = ping.current_status
+        schedule_relationship = ping.trip_schedule_relationship
+
+        if schedule_lookup.is_scheduled(trip_id):
+            trip_id_scheduled = trip_id
+            scheduled_stop_sequence = trip_stop_sequence
+
+    # write row
+    writer.write_row([
+        ping_id,
+        service_date,
+        ping.timestamp,
+        trip_id_performed,
+        trip_id_scheduled,
+        trip_stop_sequence,
+        scheduled_stop_sequence,
+        ping.vehicle_id,
+        stop_id,
+        current_status,
+        ping.latitude,
+        ping.longitude,
+        ping.bearing,
+        ping.speed,
+        schedule_relationship
+    ])
+
+
+class VehicleLocationsBuilder(TableBuilder):
+    table_name = 'vehicle_locations'
+    folder_name = VEHICLE_POSITIONS_FOLDER_NAME
+
+    def open(self, checkpoint_state=None):
+        if checkpoint_state is None:
+            # keep track of recently seen pings to skip pings repeated across snapshots
+            self.ping_deduplicator = PingDeduplicator(
+                self.config.get('ping_dedupe_window_seconds', DEFAULT_PING_DEDUPE_WINDOW_SECONDS)
+            )
+            self.num_pings = 0
+            self.warned_about_trip_start_date = False
+            output_position = None
+        else:
+            self.ping_deduplicator = checkpoint_state['ping_deduplicator']
+            self.num_pings = checkpoint_state['num_pings']
+            self.warned_about_trip_start_date = checkpoint_state['warned_about_trip_start_date']
+            output_position = checkpoint_state['output_position']
+
+        # open output file and write data as it comes
+        self.writer = self.analysis_day.open_table_writer(
+            self.table_name,
+            VEHICLE_LOCATIONS_COLUMNS,
+            resume_position=output_position
+        )
+
+    def process_snapshot(self, header_timestamp, vehicle_pings):
+        analysis_day = self.analysis_day
+        self.ping_deduplicator.advance(header_timestamp)
+        num_new_pings = 0
+
+        for ping in vehicle_pings:
+            # check if vehicle ping has been observed before
+            if self.ping_deduplicator.add(
+                ping.vehicle_id,
+                ping.timestamp,
+                ping.latitude,
+                ping.longitude,
+                ping.bearing,
+                ping.speed
+            ):
+                num_new_pings += 1
+                ping_id = generate_vehicle_ping_id(ping)
+                if ping_id is None:
+                    continue
+                write_vehicle_location_row(
+                    analysis_day.date_str,
+                    self.writer,
+                    ping_id,
+                    ping,
+                    analysis_day.schedule_lookup
+                )
+                self.num_pings += 1
+                if self.num_pings % 100 == 0 and not analysis_day.quiet:
+                    print(f"Found {self.num_pings} pings")
+                if ping.trip_start_date != '' and not self.warned_about_trip_start_date:
+                    # only warn once, every ping of a feed that sets start dates would match
+                    logger.warning(
+                        f"Ping has a trip start date which isn't checked against the service date yet: {ping}"
+                    )
+                    self.warned_about_trip_start_date = True
+
+        increment('vehicle_pings_deduplicated', len(vehicle_pings) - num_new_pings)
+
+    def get_checkpoint_state(self):
+        return {
+            'ping_deduplicator': self.ping_deduplicator,
+            'num_pings': self.num_pings,
+            'warned_about_trip_start_date': self.warned_about_trip_start_date,
+            'output_position': self.writer.checkpoint()
+        }
+
+    def flush(self):
+        self.writer.flush()
+
+    def close(self):
+        self.writer.close()
+        logger.info(f"Finished analyzing vehicle data, found {self.num_pings} total pings")
+
+
+class TripPerformed:
+    """
+    What the trip updates have shown of one trip so far. Times are epoch seconds and the
+    schedule relationship is a TripDescriptor enum value, both only formatted once the trip's row
+    is written. Trips that weren't found have a schedule relationship of None.
+    """
+    __slots__ = [
+        'trip_id',
+        'vehicle_id',
+        'is_scheduled',
+        'route_id',
+        'shape_id',
+        'block_id',
+        'trip_start_stop_id',
+        'trip_end_stop_id',
+        'schedule_trip_start',
+        'schedule_trip_end',
+        'actual_trip_start',
+        'actual_trip_end',
+        'schedule_relationship',
+        'lowest_stop_sequence',
+        'highest_stop_sequence'
+    ]
+
+    def __init__(self, trip_id, vehicle_id, route_id, is_scheduled=False, shape_id=None, block_id=None,
+                 schedule_trip_start=None, schedule_trip_end=None):
+        self.trip_id = trip_id
+        self.vehicle_id = vehicle_id
+        self.is_scheduled = is_scheduled
+        self.route_id = route_id
+        self.shape_id = shape_id
+        self.block_id = block_id
+        self.schedule_trip_start = schedule_trip_start
+        self.schedule_trip_end = schedule_trip_end
+        # to be filled in later by subsequent RT data
+        self.trip_start_stop_id = None
+        self.trip_end_stop_id = None
+        self.actual_trip_start = None
+        self.actual_trip_end = None
+        self.schedule_relationship = None
+        self.lowest_stop_sequence = None
+        self.highest_stop_sequence = None
+
+    def get_row(self, service_date, observed_trip_times=None):
+        # observed (start, end) times from vehicle positions take precedence over trip updates
+        actual_trip_start = self.actual_trip_start
+        actual_trip_end = self.actual_trip_end
+        if observed_trip_times is not None:
+            actual_trip_start = observed_trip_times[0] or actual_trip_start
+            actual_trip_end = observed_trip_times[1] or actual_trip_end
+
+        if self.schedule_relationship is None:
+            schedule_relationship = 'Missing'
+            trip_type = None
+        else:
+            schedule_relationship = TRIP_SCHEDULE_RELATIONSHIP_NAMES[self.schedule_relationship]
+            trip_type = None if self.schedule_relationship == TRIP_SCHEDULE_RELATIONSHIP_CANCELED else 'In service'
+        return [
+            service_date,
+            self.trip_id,
+            self.vehicle_id,
+            self.trip_id if self.is_scheduled else None,
+            self.route_id,
+            self.shape_id,
+            self.block_id,
+            self.trip_start_stop_id,
+            self.trip_end_stop_id,
+            self.schedule_trip_start,
+            self.schedule_trip_end,
+            actual_trip_start,
+            actual_trip_end,
+            trip_type,
+            schedule_relationship
+        ]
+
+
+class TripsPerformedBuilder(TableBuilder):
+    """
+    Builds trips performed from the first and last stop time updates of each trip, or the
+    departure from the first stop and arrival at the last stop observed in the vehicle positions
+    if observed stop visits are built in the same run. With
+    `completed_trip_flush_delay_seconds` set, trips whose feed has moved that far past their end
+    are written out as the snapshots are read and dropped from memory, and later updates of them
+    are ignored. Otherwise every trip is kept until the table is written.
+    """
+    table_name = 'trips_performed'
+    folder_name = TRIP_UPDATES_FOLDER_NAME
+
+    def open(self, checkpoint_state=None):
+        self.completed_trip_flush_delay_seconds = self.config.get('completed_trip_flush_delay_seconds')
+        if checkpoint_state is None:
+            # trips found so far by trip id
+            self.found_trips = dict()
+            self.latest_header_timestamp = None
+            # ids of the trips already written out
+            self.flushed_trip_ids = set()
+            self.last_completed_trips_check_timestamp = None
+            output_position = None
+        else:
+            self.found_trips = checkpoint_state['found_trips']
+            self.latest_header_timestamp = checkpoint_state['latest_header_timestamp']
+            self.flushed_trip_ids = checkpoint_state['flushed_trip_ids']
+            self.last_completed_trips_check_timestamp = checkpoint_state['last_completed_trips_check_timestamp']
+            output_position = checkpoint_state['output_position']
+
+        self.writer = None
+        if self.completed_trip_flush_delay_seconds is not None:
+            # completed trips are written as they come, the rest when the builder is closed
+            self.writer = self.analysis_day.open_table_writer(
+                self.table_name,
+                TRIPS_PERFORMED_COLUMNS,
+                resume_position=output_position
+            )
+
+    def get_checkpoint_state(self):
+        return {
+            'found_trips': self.found_trips,
+            'latest_header_timestamp': self.latest_header_timestamp,
+            'flushed_trip_ids': self.flushed_trip_ids,
+            'last_completed_trips_check_timestamp': self.last_completed_trips_check_timestamp,
+            'output_position': None if self.writer is None else self.writer.checkpoint()
+        }
+
+    def create_trip_performed(self, trip_update):
+        analysis_day = self.analysis_day
+        scheduled_trip_stats = analysis_day.schedule_lookup.get_trip_stats(trip_update.trip_id)
+        if scheduled_trip_stats is None:
+            return TripPerformed(trip_update.trip_id, trip_update.vehicle_id, trip_update.route_id)
+
+        return TripPerformed(
+            trip_update.trip_id,
+            trip_update.vehicle_id,
+            trip_update.route_id or scheduled_trip_stats['route_id'],
+            is_scheduled=True,
+            shape_id=scheduled_trip_stats['shape_id'],
+            block_id=scheduled_trip_stats['block_id'],
+            schedule_trip_start=gtfs_to_timestamp(
+                analysis_day.date_obj,
+                scheduled_trip_stats['start_time'],
+                analysis_day.agency_tz
+            ),
+            schedule_trip_end=gtfs_to_timestamp(
+                analysis_day.date_obj,
+                scheduled_trip_stats['end_time'],
+                analysis_day.agency_tz
+            )
+        )
+
+    def process_snapshot(self, header_timestamp, trip_updates):
+        found_trips = self.found_trips
+        if self.latest_header_timestamp is None or header_timestamp > self.latest_header_timestamp:
+            self.latest_header_timestamp = header_timestamp
+
+        for trip_update in trip_updates:
+            trip_performed = found_trips.get(trip_update.trip_id)
+            if trip_performed is None:
+                if trip_update.trip_id in self.flushed_trip_ids:
+                    increment('trip_updates_after_flush')
+                    continue
+                if not self.analysis_day.quiet:
+                    print(f"Found new trip with id `{trip_update.trip_id}`")
+                # create new trip record
+                trip_performed = self.create_trip_performed(trip_update)
+                found_trips[trip_update.trip_id] = trip_performed
+
+            trip_performed.schedule_relationship = trip_update.schedule_relationship
+
+            for stop_sequence, stop_id, arrival_time, departure_time, _ in trip_update.stop_time_updates:
+                timestamp = arrival_time or departure_time
+                if trip_performed.lowest_stop_sequence is None or stop_sequence <= trip_performed.lowest_stop_sequence:
+                    # overwrite stats about the start of the trip
+                    trip_performed.lowest_stop_sequence = stop_sequence
+                    trip_performed.trip_start_stop_id = stop_id
+                    trip_performed.actual_trip_start = timestamp
+
+                if trip_performed.highest_stop_sequence is None or \
+                        stop_sequence >= trip_performed.highest_stop_sequence:
+                    # overwrite stats about the end of the trip
+                    trip_performed.highest_stop_sequence = stop_sequence
+                    trip_performed.trip_end_stop_id = stop_id
+                    trip_performed.actual_trip_end = timestamp
+
+        if self.writer is not None:
+            self.flush_completed_trips()
+
+    def flush_completed_trips(self):
+        latest_header_timestamp = self.latest_header_timestamp
+        last_check_timestamp = self.last_completed_trips_check_timestamp
+        if last_check_timestamp is not None and \
+                latest_header_timestamp - last_check_timestamp < COMPLETED_TRIPS_CHECK_INTERVAL_SECONDS:
+            return
+        self.last_completed_trips_check_timestamp = latest_header_timestamp
+
+        completed_before_timestamp = latest_header_timestamp - self.completed_trip_flush_delay_seconds
+        completed_trip_ids = []
+        for trip_id, trip_performed in self.found_trips.items():
+            end_timestamp = trip_performed.actual_trip_end or trip_performed.schedule_trip_end
+            if end_timestamp and end_timestamp < completed_before_timestamp:
+                completed_trip_ids.append(trip_id)
+
+        analysis_day = self.analysis_day
+        for trip_id in completed_trip_ids:
+            self.writer.write_row(self.found_trips.pop(trip_id).get_row(
+                analysis_day.date_str,
+                analysis_day.observed_trip_times.get(trip_id)
+            ))
+            self.flushed_trip_ids.add(trip_id)
+        increment('trips_flushed_early', len(completed_trip_ids))
+
+    def create_missing_trip_performed(self, trip_id):
+        analysis_day = self.analysis_day
+        scheduled_trip_stats = analysis_day.schedule_lookup.get_trip_stats(trip_id)
+        return TripPerformed(
+            trip_id,
+            None,
+            scheduled_trip_stats['route_id'],
+            is_scheduled=True,
+            shape_id=scheduled_trip_stats['shape_id'],
+            block_id=scheduled_trip_stats['block_id'],
+            schedule_trip_start=gtfs_to_timestamp(
+                analysis_day.date_obj,
+                scheduled_trip_stats['start_time'],
+                analysis_day.agency_tz
+            ),
+            schedule_trip_end=gtfs_to_timestamp(
+                analysis_day.date_obj,
+                scheduled_trip_stats['end_time'],
+                analysis_day.agency_tz
+            )
+        )
+
+    def write_trips(self, writer, missing_before_timestamp=None):
+        """
+        Write the trips found so far that weren't written yet followed by the scheduled trips
+        that weren't found. If `missing_before_timestamp` is given, only scheduled trips that
+        should have ended before it are reported as missing.
+        """
+        analysis_day = self.analysis_day
+        found_trips = self.found_trips
+
+        for trip_id, trip_performed in found_trips.items():
+            writer.write_row(trip_performed.get_row(
+                analysis_day.date_str,
+                analysis_day.observed_trip_times.get(trip_id)
+            ))
+
+        # add missing trips
+        for trip_id in analysis_day.schedule_lookup.trip_ids:
+            if trip_id in self.flushed_trip_ids:
+                continue
+            if trip_id not in found_trips:
+                trip_performed = self.create_missing_trip_performed(trip_id)
+                if missing_before_timestamp is None or trip_performed.schedule_trip_end < missing_before_timestamp:
+                    writer.write_row(trip_performed.get_row(analysis_day.date_str))
+
+    def write_table(self, atomic=False, missing_before_timestamp=None):
+        writer = self.analysis_day.open_table_writer(self.table_name, TRIPS_PERFORMED_COLUMNS, atomic)
+        logger.info(f"Writing TIDES data to {writer.path}")
+        self.write_trips(writer, missing_before_timestamp)
+        writer.close()
+
+        logger.info(f"Finished writing TIDES data")
+
+    def flush(self):
+        if self.writer is not None:
+            # partial output only has the trips that were completed so far
+            self.writer.flush()
+        elif self.latest_header_timestamp is not None:
+            self.write_table(atomic=True, missing_before_timestamp=self.latest_header_timestamp)
+
+    def close(self):
+        if self.writer is None:
+            self.write_table()
+            return
+
+        logger.info(f"Writing TIDES data to {self.writer.path}")
+        self.write_trips(self.writer)
+        self.writer.close()
+        logger.info(f"Finished writing TIDES data, {len(self.flushed_trip_ids)} trips were written early")
+
+    def can_shard(self):
+        # trips written early depend on the progress of every trip, so early writes need one builder
+        return self.config.get('completed_trip_flush_delay_seconds') is None
+
+    def merge_shard_states(self, shard_states, trip_ids):
+        found_trips = {}
+        for shard_state in shard_states:
+            found_trips.update(shard_state['found_trips'])
+        header_timestamps = [
+            shard_state['latest_header_timestamp'] for shard_state in shard_states
+            if shard_state['latest_header_timestamp'] is not None
+        ]
+        return {
+            'found_trips': {trip_id: found_trips[trip_id] for trip_id in trip_ids},
+            'latest_header_timestamp': max(header_timestamps, default=None),
+            'flushed_trip_ids': set(),
+            'last_completed_trips_check_timestamp': None,
+            'output_position': None
+        }
+
+
+class StopVisitsBuilder(TableBuilder):
+    """
+    Builds stop visits from the last prediction made for each stop of each trip, which for a
+    stop the vehicle has already served is the time it was observed there.
+    """
+    table_name = 'stop_visits'
+    folder_name = TRIP_UPDATES_FOLDER_NAME
+    requires_all_stop_time_updates = True
+
+    def open(self, checkpoint_state=None):
+        if checkpoint_state is None:
+            # latest (vehicle_id, stop_time_update) for each (stop_sequence, stop_id) of each trip
+            self.stop_visits_by_trip = dict()
+        else:
+            self.stop_visits_by_trip = checkpoint_state['stop_visits_by_trip']
+
+    def get_checkpoint_state(self):
+        return {'stop_visits_by_trip': self.stop_visits_by_trip}
+
+    def process_snapshot(self, header_timestamp, trip_updates):
+        for trip_update in trip_updates:
+            stop_visits = self.stop_visits_by_trip.get(trip_update.trip_id)
+            if stop_visits is None:
+                stop_visits = self.stop_visits_by_trip[trip_update.trip_id] = dict()
+            for stop_time_update in trip_update.stop_time_updates:
+                stop_visits[(stop_time_update[0], stop_time_update[1])] = (trip_update.vehicle_id, stop_time_update)
+
+    def write_table(self, atomic=False):
+        analysis_day = self.analysis_day
+
+        writer = analysis_day.open_table_writer(self.table_name, STOP_VISITS_COLUMNS, atomic)
+        logger.info(f"Writing TIDES data to {writer.path}")
+        num_stop_visits = 0
+        for trip_id, stop_visits in self.stop_visits_by_trip.items():
+            is_scheduled = analysis_day.schedule_lookup.is_scheduled(trip_id)
+            for stop_key in sorted(stop_visits):
+                vehicle_id, stop_time_update = stop_visits[stop_key]
+                stop_sequence, stop_id, arrival_time, departure_time, schedule_relationship = stop_time_update
+                if arrival_time == 0 and departure_time == 0 and \
+                        schedule_relationship != STOP_SCHEDULE_RELATIONSHIP_SKIPPED:
+                    # nothing was predicted for the stop
+                    continue
+
+                dwell = ''
+                if arrival_time != 0 and departure_time != 0:
+                    dwell = departure_time - arrival_time
+
+                writer.write_row([
+                    analysis_day.date_str,
+                    trip_id,
+                    stop_sequence,
+                    stop_sequence if is_scheduled else '',
+                    vehicle_id,
+                    dwell,
+                    stop_id,
+                    arrival_time or '',
+                    departure_time or '',
+                    gtfs_realtime_pb2.TripUpdate.StopTimeUpdate.ScheduleRelationship.Name(
+                        schedule_relationship
+                    ).capitalize()
+                ])
+                num_stop_visits += 1
+        writer.close()
+
+        logger.info(f"Finished writing TIDES data, found {num_stop_visits} stop visits")
+
+    def flush(self):
+        self.write_table(atomic=True)
+
+    def close(self):
+        self.write_table()
+
+    def can_shard(self):
+        return True
+
+    def merge_shard_states(self, shard_states, trip_ids):
+        stop_visits_by_trip = {}
+        for shard_state in shard_states:
+            stop_visits_by_trip.update(shard_state['stop_visits_by_trip'])
+        return {'stop_visits_by_trip': {trip_id: stop_visits_by_trip[trip_id] for trip_id in trip_ids}}
+
+
+class TripStopVisits:
+    """
+    The stops the vehicle of one trip was observed at so far, as [stop index, arrival time,
+    departure time] visits in time order. A visit lasts from the first to the last of a run of
+    positions matched to the same stop.
+    """
+    __slots__ = ['vehicle_id', 'last_timestamp', 'at_stop', 'visits']
+
+    def __init__(self, vehicle_id):
+        self.vehicle_id = vehicle_id
+        self.last_timestamp = 0
+        self.at_stop = False
+        self.visits = []
+
+
+def assign_stop_visits(stop_pattern, stop_positions, visits):
+    """
+    Return [pattern position, arrival time, departure time] for the visits that fit a trip's stop
+    pattern in order, given the positions of each stop in the pattern. Stops visited again
+    without visiting another one in between count as one visit, and visits to a stop the trip
+    has already passed are dropped, e.g. for a position matched to a stop of a loop early.
+    """
+    assigned_visits = []
+    next_position = 0
+    for stop_index, arrival_time, departure_time in visits:
+        if len(assigned_visits) > 0 and stop_pattern[assigned_visits[-1][0]][1] == stop_index:
+            assigned_visits[-1][2] = departure_time
+            continue
+        positions = stop_positions[stop_index]
+        position_index = bisect_left(positions, next_position)
+        if position_index == len(positions):
+            continue
+        assigned_visits.append([positions[position_index], arrival_time, departure_time])
+        next_position = positions[position_index] + 1
+    return assigned_visits
+
+
+class ObservedStopVisitsBuilder(TableBuilder):
+    """
+    Builds stop visits from the vehicle positions of scheduled trips, matching positions in
+    batches to the stops of their trip within `stop_match_radius_meters` with the schedule's
+    spatial stop index. Also gives the trips performed built in the same run the observed start
+    and end of each trip.
+    """
+    table_name = 'observed_stop_visits'
+    folder_name = VEHICLE_POSITIONS_FOLDER_NAME
+
+    def open(self, checkpoint_state=None):
+        self.stop_index = self.analysis_day.schedule_lookup.get_stop_index(
+            self.config.get('stop_match_radius_meters', DEFAULT_STOP_MATCH_RADIUS_METERS)
+        )
+        # positions of each stop in each stop pattern, by pattern index
+        self.pattern_stop_positions = {}
+        if checkpoint_state is None:
+            self.trip_stop_visits = dict()
+            self.pending_positions = []
+        else:
+            self.trip_stop_visits = checkpoint_state['trip_stop_visits']
+            self.pending_positions = checkpoint_state['pending_positions']
+
+    def get_checkpoint_state(self):
+        return {
+            'trip_stop_visits': self.trip_stop_visits,
+            'pending_positions': self.pending_positions
+        }
+
+    def process_snapshot(self, header_timestamp, vehicle_pings):
+        schedule_lookup = self.analysis_day.schedule_lookup
+        for ping in vehicle_pings:
+            pattern_index = schedule_lookup.get_stop_pattern_index(ping.trip_id)
+            if pattern_index is None or ping.timestamp == 0:
+                continue
+            trip_stop_visits = self.trip_stop_visits.get(ping.trip_id)
+            if trip_stop_visits is None:
+                trip_stop_visits = self.trip_stop_visits[ping.trip_id] = TripStopVisits(ping.vehicle_id)
+            elif ping.timestamp <= trip_stop_visits.last_timestamp:
+                # repeated in a later snapshot, or older than what was seen already
+                continue
+            trip_stop_visits.last_timestamp = ping.timestamp
+            trip_stop_visits.vehicle_id = ping.vehicle_id
+            self.pending_positions.append((ping.trip_id, ping.timestamp, ping.latitude, ping.longitude, pattern_index))
+
+        if len(self.pending_positions) >= STOP_MATCH_BATCH_SIZE:
+            self.match_pending_positions()
+
+    def match_pending_positions(self):
+        pending_positions = self.pending_positions
+        if len(pending_positions) == 0:
+            return
+        self.pending_positions = []
+
+        with timed('stop_match'):
+            matched_stop_indexes = self.stop_index.match(
+                [position[2] for position in pending_positions],
+                [position[3] for position in pending_positions],
+                [position[4] for position in pending_positions]
+            ).tolist()
+        increment(
+            'vehicle_positions_matched_to_stops',
+            sum(1 for stop_index in matched_stop_indexes if stop_index >= 0)
+        )
+
+        # the positions of each trip are pending in time order
+        trip_stop_visits_by_trip_id = self.trip_stop_visits
+        for (trip_id, timestamp, _, _, _), stop_index in zip(pending_positions, matched_stop_indexes):
+            trip_stop_visits = trip_stop_visits_by_trip_id[trip_id]
+            if stop_index < 0:
+                trip_stop_visits.at_stop = False
+            elif trip_stop_visits.at_stop and trip_stop_visits.visits[-1][0] == stop_index:
+                trip_stop_visits.visits[-1][2] = timestamp
+            else:
+                trip_stop_visits.visits.append([stop_index, timestamp, timestamp])
+                trip_stop_visits.at_stop = True
+
+    def get_stop_positions(self, pattern_index):
+        stop_positions = self.pattern_stop_positions.get(pattern_index)
+        if stop_positions is None:
+            stop_positions = self.pattern_stop_positions[pattern_index] = dict()
+            stop_pattern = self.analysis_day.schedule_lookup.stop_patterns[pattern_index]
+            for position, (stop_sequence, stop_index) in enumerate(stop_pattern):
+                stop_positions.setdefault(stop_index, []).append(position)
+        return stop_positions
+
+    def write_table(self, atomic=False):
+        analysis_day = self.analysis_day
+        schedule_lookup = analysis_day.schedule_lookup
+        self.match_pending_positions()
+
+        writer = analysis_day.open_table_writer(self.table_name, STOP_VISITS_COLUMNS, atomic)
+        logger.info(f"Writing TIDES data to {writer.path}")
+        num_stop_visits = 0
+        for trip_id in schedule_lookup.trip_ids:
+            trip_stop_visits = self.trip_stop_visits.get(trip_id)
+            if trip_stop_visits is None or len(trip_stop_visits.visits) == 0:
+                continue
+
+            pattern_index = schedule_lookup.get_stop_pattern_index(trip_id)
+            stop_pattern = schedule_lookup.stop_patterns[pattern_index]
+            assigned_visits = assign_stop_visits(
+                stop_pattern,
+                self.get_stop_positions(pattern_index),
+                trip_stop_visits.visits
+            )
+            for position, arrival_time, departure_time in assigned_visits:
+                stop_sequence, stop_index = stop_pattern[position]
+                writer.write_row([
+                    analysis_day.date_str,
+                    trip_id,
+                    stop_sequence,
+                    stop_sequence,
+                    trip_stop_visits.vehicle_id,
+                    departure_time - arrival_time,
+                    schedule_lookup.stops[stop_index][0],
+                    arrival_time,
+                    departure_time,
+                    'Scheduled'
+                ])
+                num_stop_visits += 1
+
+            # the departure from the first stop and arrival at the last one, if they were seen
+            observed_trip_start = None
+            observed_trip_end = None
+            if len(assigned_visits) > 0 and assigned_visits[0][0] == 0:
+                observed_trip_start = assigned_visits[0][2]
+            if len(assigned_visits) > 0 and assigned_visits[-1][0] == len(stop_pattern) - 1:
+                observed_trip_end = assigned_visits[-1][1]
+            if observed_trip_start is not None or observed_trip_end is not None:
+                analysis_day.observed_trip_times[trip_id] = (observed_trip_start, observed_trip_end)
+        writer.close()
+
+        logger.info(f"Finished writing TIDES data, found {num_stop_visits} observed stop visits")
+
+    def flush(self):
+        self.write_table(atomic=True)
+
+    def close(self):
+        self.write_table()